@@ -1,13 +1,25 @@
 from bs4 import BeautifulSoup as bs
-from psycopg import AsyncConnection, OperationalError, DatabaseError
+from aiohttp import ClientSession
+from psycopg import OperationalError, DatabaseError
+from psycopg_pool import AsyncConnectionPool
 from typing import Dict, List
-from sql import insertCompoundDatabase, connectFoodDatabase
+from sql import insertCompoundDatabase, insertClassDatabase, getFoodIdsDatabase, deleteCompoundRows, \
+    getFoodCompoundRows, upsertFoodCompounds, deleteFoodCompounds
+from ledger import CrawlLedger
+from work_queue import WorkQueue
+from delta import HashStore, fooDBParts
+from compound_index import compound_index
+import struct
+from writer import BatchWriter
 import settings
-from utility import get_page_text
-import asyncio
+from utility import get_page_text, revalidating
+from pipeline import runCrawl, runParser
+from metrics import timed
+from xpath_spec import Field, Rows, apply, parse
 
 from logger import logger
 
+@timed("extract.FooDB")
 def getName(soup):
     name = soup.find("name")
     if not name or not name.string:
@@ -15,6 +27,7 @@ def getName(soup):
         return
     return name.string.strip()
 
+@timed("extract.FooDB")
 def getClass(soup):
     met_class = soup.find("class")
     if not met_class or not met_class.string:
@@ -22,33 +35,28 @@ def getClass(soup):
         return
     return met_class.string.strip()
 
-def getFoods(soup):
+def filterFoods(rows: List[Dict]) -> Dict:
     foods = {}
-    food_table = soup.find("foods")
-    
     no_data_foods = []
     zeroed_foods = []
-    for row in food_table.find_all("food"):
-        name_tag = row.find("name")
-        if not name_tag or not name_tag.string:
+    for row in rows:
+        name = row.get("name")
+        if name is None:
             logger.warning(" No Food Name")
             continue
-        name = name_tag.string.strip()
-        average_value = row.find("average_value")
-        max_value = row.find("max_value")
-        min_value = row.find("min_value")
-        
-        if  (not average_value or not average_value.string) \
-        and (not max_value or not max_value.string) \
-        and (not min_value or not min_value.string):
+        average_value = row.get("average_value")
+        max_value = row.get("max_value")
+        min_value = row.get("min_value")
+
+        if not average_value and not max_value and not min_value:
             no_data_foods.append(name)
             continue
-        
+
         foods[name] = {}
         try:
-            foods[name]["average_value"] = float(average_value.string)
-            foods[name]["max_value"] = float(max_value.string)
-            foods[name]["min_value"] = float(min_value.string)
+            foods[name]["average_value"] = float(average_value)
+            foods[name]["max_value"] = float(max_value)
+            foods[name]["min_value"] = float(min_value)
             if foods[name]["min_value"] == 0.0 and foods[name]["max_value"] == 0.0:
                 zeroed_foods.append(name)
                 del foods[name]
@@ -59,50 +67,169 @@ def getFoods(soup):
         logger.info(f" Foods with no data: {no_data_foods}")
     if zeroed_foods:
         logger.info(f" Foods with 0 min/max/average: {zeroed_foods}")
-        
+
     return foods
 
+@timed("extract.FooDB")
+def getFoods(soup):
+    rows = []
+    for row in soup.find("foods").find_all("food"):
+        values = {}
+        for tag in ("name", "average_value", "max_value", "min_value"):
+            found = row.find(tag)
+            values[tag] = found.string if found and found.string else None
+        if values["name"] is not None:
+            values["name"] = values["name"].strip()
+        rows.append(values)
+    return filterFoods(rows)
+
+FOODB_RECORD = {
+    "name": Field("(//name)[1]", transform=str.strip),
+    "class": Field("(//class)[1]", transform=str.strip),
+    "foods": Rows("(//foods)[1]", ".//food", {
+        "name": Field(".//name", transform=str.strip),
+        "average_value": Field(".//average_value"),
+        "max_value": Field(".//max_value"),
+        "min_value": Field(".//min_value"),
+    }),
+}
+
+@timed("extract.FooDB")
+def getCatalogIds(page_text: str, features: str = "html.parser") -> List[str]:
+    soup = bs(page_text, features)
+    rows = soup.find_all("a", class_="btn-show")
+    return [link.text for link in rows]
+
+@timed("extract.FooDB")
+def extractFooDBRecord(page_text: str) -> Dict:
+    record = apply(FOODB_RECORD, parse(page_text))
+    for field, warning in (("name", " No name"), ("class", " No class")):
+        if record.get(field) is None:
+            logger.warning(warning)
+            record[field] = None
+    if "foods" not in record:
+        raise ValueError("No foods in document")
+    record["foods"] = filterFoods(record["foods"])
+    return record
+
+@timed("extract.FooDB")
+def extractFooDBRecordSoup(page_text: str, features: str = "xml") -> Dict:
+    soup = bs(page_text, features=features)
+    return {
+        "name": getName(soup),
+        "class": getClass(soup),
+        "foods": getFoods(soup),
+    }
+
+async def writeFooDBRecord(pool: AsyncConnectionPool, writer: BatchWriter, id: str, record: Dict, replace: bool = False):
+    name, met_class, foods = record["name"], record["class"], record["foods"]
+    try:
+        await insertClassDatabase(pool, met_class)
+        food_ids = await getFoodIdsDatabase(pool, foods)
+        async with pool.connection() as conn:
+            async with conn.transaction(), conn.cursor() as cur:
+                compound_id, inserted = await insertCompoundDatabase(conn, cur, id, name, met_class, False)
+                # The ledger can be empty for a compound written before, after a reset or by an older crawler
+                if replace or not inserted:
+                    await deleteCompoundRows(conn, cur, compound_id, ["food_compounds"])
+        compound_index.add(compound_id, name, id)
+    except (OperationalError, DatabaseError) as e:
+        logger.error(f" {id}: {e}")
+        return
+    for food, value in foods.items():
+        writer.addFoodCompound(compound_id, food_ids[food], value["average_value"], value["max_value"], value["min_value"])
+    return compound_id
         
-async def parseFooDBId(conn: AsyncConnection, id: str):
-    async with conn.cursor() as cur:
-        logger.info(f" Parsing FooDB with id: {id}")
-        url = settings.FOODB_MET_PAGE + id
-        page_text = await get_page_text(url)
-        soup = bs(page_text, features="xml")
-        try:
-            name = getName(soup)
-            met_class = getClass(soup)
-            foods = getFoods(soup)
-            
-        #     logger.debug(f"""
-        # Information for {id}:
-        # fooDB Name: {name}
-        # Class: {met_class}
-        # Associated Foods: {foods}
-        #         """)
-        except Exception as e:
-            logger.error(f" {id}: {e}")
-            return
+def _real(value):
+    # food_compounds stores REAL, so values are compared at single precision
+    return None if value is None else struct.unpack("f", struct.pack("f", value))[0]
+
+async def refreshFooDBRecord(pool: AsyncConnectionPool, writer: BatchWriter, hashes: HashStore, id: str, record: Dict):
+    parts = fooDBParts(record)
+    changed = hashes.changed(id, parts)
+    if changed is None:
+        compound_id = await writeFooDBRecord(pool, writer, id, record, True)
+    elif not changed:
+        return hashes.compoundId(id)
+    else:
+        compound_id = hashes.compoundId(id)
+        name, met_class, foods = record["name"], record["class"], record["foods"]
         try:
-            compound_id = await insertCompoundDatabase(conn, cur, id, name, met_class, False, True)
-            for food, value in foods.items():
-                await connectFoodDatabase(conn, cur, compound_id, food, value["average_value"], value["max_value"], value["min_value"])
-            return compound_id
+            await insertClassDatabase(pool, met_class)
+            food_ids = await getFoodIdsDatabase(pool, foods)
+            async with pool.connection() as conn:
+                async with conn.transaction(), conn.cursor() as cur:
+                    if "compound" in changed:
+                        compound_id, _ = await insertCompoundDatabase(conn, cur, id, name, met_class, False)
+                    if "foods" in changed:
+                        current = await getFoodCompoundRows(conn, cur, compound_id)
+                        wanted = {
+                            food_ids[food]: (value["average_value"], value["max_value"], value["min_value"])
+                            for food, value in foods.items()
+                        }
+                        upserts = [
+                            (compound_id, food_id, *values) for food_id, values in wanted.items()
+                            if tuple(map(_real, values)) != current.get(food_id)
+                        ]
+                        removed = [food_id for food_id in current if food_id not in wanted]
+                        if upserts:
+                            await upsertFoodCompounds(conn, cur, upserts)
+                        if removed:
+                            await deleteFoodCompounds(conn, cur, compound_id, removed)
+                        logger.debug(f" {id}: {len(upserts)} food rows upserted, {len(removed)} deleted")
+            if "compound" in changed:
+                compound_index.add(compound_id, name, id)
         except (OperationalError, DatabaseError) as e:
             logger.error(f" {id}: {e}")
-            await conn.rollback()
-
-async def crawlFooDB(conn: AsyncConnection):
-    for page_num in range(settings.FOODB_START_PAGE, settings.FOODB_TOTAL_PAGES+1):
-        url = settings.FOODB_CATALOG_PAGE + str(page_num)
-        page_text = await get_page_text(url)
-        soup = bs(page_text, "html.parser")
+            return
+    if compound_id is not None:
+        hashes.stage(compound_id, id, parts)
+    return compound_id
         
-        rows = soup.find_all("a", class_="btn-show")
-        ids = [link.text for link in rows]
-
-        logger.info(f" Got ID's for page {page_num}")
-        logger.info(f" ----------------------------------------------------------")
-    
-        cur = conn.cursor()
-        await asyncio.gather(*[parseFooDBId(conn, id) for id in ids])
\ No newline at end of file
+async def parseFooDBId(pool: AsyncConnectionPool, session: ClientSession, writer: BatchWriter, id: str):
+    logger.debug(f" Parsing FooDB with id: {id}")
+    url = settings.FOODB_MET_PAGE + id
+    try:
+        page_text = await get_page_text(session, url)
+        record = await runParser(extractFooDBRecord, page_text)
+    except Exception as e:
+        logger.error(f" {id}: {e}")
+        return
+    return await writeFooDBRecord(pool, writer, id, record)
+
+async def crawlFooDB(pool: AsyncConnectionPool, session: ClientSession, refresh: bool = False, sharded: bool = False):
+    # A refresh re-walks every compound and only writes what changed since the stored content hashes,
+    # revalidating cached pages with the site instead of trusting their age.
+    # A sharded crawl only takes the pages no other worker has claimed.
+    hashes = HashStore(pool, "FooDB")
+    ledger = None if refresh else (WorkQueue if sharded else CrawlLedger)(pool, "FooDB")
+    if refresh:
+        await hashes.load()
+    writer = BatchWriter(pool, ledger=ledger, hashes=hashes, upsert=sharded)
+
+    async def write(id: str, record: Dict):
+        logger.debug(f" Parsing FooDB with id: {id}")
+        if refresh:
+            compound_id = await refreshFooDBRecord(pool, writer, hashes, id, record)
+        else:
+            compound_id = await writeFooDBRecord(pool, writer, id, record, ledger.isRetry("compound", id))
+            if compound_id is not None:
+                hashes.stage(compound_id, id, fooDBParts(record))
+        if compound_id is not None:
+            writer.complete(compound_id, id)
+        await writer.flushIfFull()
+        await hashes.flushIfFull()
+        return compound_id
+
+    with revalidating(refresh):
+        await runCrawl(
+            "FooDB", session, range(settings.FOODB_START_PAGE, settings.FOODB_TOTAL_PAGES+1),
+            lambda page_num: settings.FOODB_CATALOG_PAGE + str(page_num), getCatalogIds,
+            lambda id: settings.FOODB_MET_PAGE + id, extractFooDBRecord, write, ledger,
+        )
+    await writer.flush()
+    await hashes.flush()
+    if ledger is not None:
+        await ledger.flush()
+    if refresh:
+        hashes.logStats()
@@ -1,28 +1,38 @@
 from bs4 import BeautifulSoup as bs, Tag
+from aiohttp import ClientSession
+from client import createSession
 from FooDB import parseFooDBId
 from logger import logger
-from psycopg import AsyncConnection, OperationalError, DatabaseError
-from sql import insertCompoundDatabase, insertBioSpecDatabase, insertConcentrationDatabase, getCompoundIdFromFooDBId, updateHmdbId, getCompoundIdAndFooDBIdFromName
-import psycopg
+from psycopg import OperationalError, DatabaseError
+from psycopg_pool import AsyncConnectionPool
+from sql import createPool, insertCompoundDatabase, insertBioSpecDatabase, updateHmdbId, deleteCompoundRows, \
+    getBiospecimenIds, deleteBiospecimens
+from compound_index import compound_index
+from ledger import CrawlLedger
+from work_queue import WorkQueue
+from delta import HashStore, hmdbParts
+from writer import BatchWriter
 from dotenv import load_dotenv
 import pandas as pd
-import os
-from utility import get_page_text, populate_databases
+from utility import get_page_text, revalidating, populate_databases
 from typing import cast
 import asyncio
 
-from typing import List
+from typing import Dict, List
 import settings
+from pipeline import runCrawl, runParser, shutdownParseExecutor
+from hmdb_stream import extractHMDBRecordStreaming
+from metrics import timed
 
-semaphore = asyncio.Semaphore(10)
-
+@timed("extract.HMDB")
 def getName(soup: bs) -> str:
     name: Tag = cast(Tag, soup.find("name"))
     if not name or not name.string:
         logger.warning(" No name")
         return ""
-    return name.string
+    return str(name.string)
 
+@timed("extract.HMDB")
 def getBiospecimens(soup: bs):
     location_tags = soup.find("biospecimen_locations")
     if not location_tags:
@@ -31,6 +41,7 @@ def getBiospecimens(soup: bs):
     locations = [loc.text for loc in location_tags.find_all("biospecimen")]
     return locations
 
+@timed("extract.HMDB")
 def getConcentrations(soup: bs, normal = True):
     conc_table = soup.find("normal_concentrations") if normal else soup.find("abnormal_concentrations")
     
@@ -83,7 +94,7 @@ def getConcentrations(soup: bs, normal = True):
                             unquantified_values.append(name)
                         tag_value = None
                 else:
-                    tag_value = tag.string
+                    tag_value = str(tag.string)
                 
                 concentration[name] = tag_value
         if isQuantified:
@@ -94,95 +105,176 @@ def getConcentrations(soup: bs, normal = True):
     return concentrations
     
 
-async def parseHMDBId(conn: AsyncConnection, id: str):
-    async with conn.cursor() as cur:
-        async with semaphore:
-            logger.info(f" Parsing HMDB with id: {id}")
-            compound_id = None
-            
-            url = settings.HMDB_MET_PAGE + id + ".xml"
-            print(f"With Url {url}")
-            page_text = await get_page_text(url)
-            soup = bs(page_text, features="xml")
+@timed("extract.HMDB")
+def getCatalogIds(page_text: str, features: str = "html.parser") -> List[str]:
+    soup = bs(page_text, features)
+    met_link = soup.find_all("td", class_="metabolite-link")
+    return [link.a.text for link in met_link]
 
-            name = getName(soup)
-            biospecimens = getBiospecimens(soup)
-            concentrations = getConcentrations(soup, True)
-            abconcentrations = getConcentrations(soup, False)
-            
-            result = await getCompoundIdAndFooDBIdFromName(conn, cur, name)
-            if result:
-                compound_id, db_foodb_id = result
-            foodb_id_tag = soup.find("foodb_id")
+@timed("extract.HMDB")
+def extractHMDBRecord(page_text: str, features: str = "xml") -> Dict:
+    soup = bs(page_text, features=features)
+    foodb_id_tag = soup.find("foodb_id")
+    return {
+        "name": getName(soup),
+        "foodb_id": str(foodb_id_tag.string) if foodb_id_tag and foodb_id_tag.string else None,
+        "biospecimens": getBiospecimens(soup),
+        "concentrations": getConcentrations(soup, True),
+        "abconcentrations": getConcentrations(soup, False),
+    }
 
-            if foodb_id_tag and foodb_id_tag.string:
-                parsed_foodb_id = foodb_id_tag.string
-                if not compound_id:
-                    logger.info(f" Couldn't find from name {name}. Using parsed foodb_id {parsed_foodb_id}")
-                    compound_id = await getCompoundIdFromFooDBId(conn, cur, parsed_foodb_id)
-                    if not compound_id:
-                        compound_id = await parseFooDBId(conn, parsed_foodb_id)
-                elif db_foodb_id != parsed_foodb_id:
-                    logger.error(f" {id}: Issue aligning metabolite {name} with id { db_foodb_id } in database and parsed foodb_id {parsed_foodb_id}")
-                    return
-            
+async def writeHMDBRecord(pool: AsyncConnectionPool, session: ClientSession, writer: BatchWriter, id: str, record: Dict, replace: bool = False):
+    compound_id = None
+    name = record["name"]
+    parsed_foodb_id = record["foodb_id"]
+    biospecimens = record["biospecimens"]
+    concentrations = record["concentrations"]
+    abconcentrations = record["abconcentrations"]
+    
+    async with compound_index.lock(name):
+        compound_id = compound_index.byName(name)
+        if compound_id is not None:
+            if parsed_foodb_id and not compound_index.hasFooDBId(compound_id, parsed_foodb_id):
+                logger.error(f" {id}: Issue aligning metabolite {name} with id { compound_index.fooDBId(compound_id) } in database and parsed foodb_id {parsed_foodb_id}")
+                return
+        elif parsed_foodb_id:
+            logger.debug(f" Couldn't find from name {name}. Using parsed foodb_id {parsed_foodb_id}")
+            compound_id = compound_index.byFooDBId(parsed_foodb_id)
             if not compound_id:
-                logger.warning(f" {id}: No fooDB ID. Creating compound without fooDB ID")
-                compound_id = await insertCompoundDatabase(conn, cur, id, name, None, True, False)
-            else:
-                await updateHmdbId(conn, cur, compound_id, id)
+                async with compound_index.fooDBLock(parsed_foodb_id):
+                    # Another metabolite with this foodb_id may have fetched it while we waited
+                    compound_id = compound_index.byFooDBId(parsed_foodb_id)
+                    if not compound_id:
+                        compound_id = await parseFooDBId(pool, session, writer, parsed_foodb_id)
 
-            if not biospecimens:
-                logger.warning(f"{id}: No Biospecimens")
-            else: 
-                try:
-                    for biospec in biospecimens:
-                        await insertBioSpecDatabase(conn, cur, compound_id, biospec)
-                    
-                except (OperationalError, DatabaseError) as e:
-                    logger.error(f" {id}: Error inserting biospecimen: {e}")
-                    await conn.rollback()
-            
-            if not concentrations:
-                logger.info(" Concentrations missing")
-            else:
-                for concentration in concentrations:
-                    await insertConcentrationDatabase(conn, cur, compound_id, concentration)
-            
-            if not abconcentrations:
-                logger.info(" Abnormal Concentrations missing")
-            else:
-                for abconcentration in abconcentrations:
-                    await insertConcentrationDatabase(conn, cur, compound_id, abconcentration)
+        try:
+            biospec_ids = [await insertBioSpecDatabase(pool, biospec) for biospec in biospecimens or []]
+            created = not compound_id
+            # A compound already carrying this hmdb_id holds the rows of an earlier crawl, which the ledger
+            # does not know about after a reset or on a database an older crawler filled
+            written = not created and compound_index.hasHMDBId(compound_id, id)
+            async with pool.connection() as conn:
+                async with conn.transaction(), conn.cursor() as cur:
+                    if created:
+                        logger.warning(f" {id}: No fooDB ID. Creating compound without fooDB ID")
+                        compound_id, inserted = await insertCompoundDatabase(conn, cur, id, name, None, True)
+                        written = not inserted
+                    elif not written:
+                        await updateHmdbId(conn, cur, compound_id, id)
+                    if replace or written:
+                        await deleteCompoundRows(conn, cur, compound_id, ["compound_biospecimens", "concentration"])
+            compound_index.add(compound_id, name if created else None, hmdb_id=id)
+        except (OperationalError, DatabaseError) as e:
+            logger.error(f" {id}: {e}")
+            return
+
+    if not biospecimens:
+        logger.warning(f"{id}: No Biospecimens")
+    else: 
+        for biospec_id in biospec_ids:
+            writer.addBiospecimen(compound_id, biospec_id)
     
+    if not concentrations:
+        logger.debug(" Concentrations missing")
+    else:
+        for concentration in concentrations:
+            await writer.addConcentration(compound_id, concentration)
+    
+    if not abconcentrations:
+        logger.debug(" Abnormal Concentrations missing")
+    else:
+        for abconcentration in abconcentrations:
+            await writer.addConcentration(compound_id, abconcentration)
+    return compound_id
 
-async def crawlHMDB(conn: AsyncConnection) -> None:
-    for page_num in range(settings.HMDB_START_PAGE, settings.HMDB_TOTAL_PAGES+1):
-        url = settings.HMDB_CATALOG_PAGE + str(page_num)
-        page = await get_page_text(url)
-        soup = bs(page.text, "html.parser")
-        met_link = soup.find_all("td", class_="metabolite-link")
-        ids = [link.a.text for link in met_link]
-        
-        logger.info(f" Got ID's for page {page_num}")
-        logger.info(f" ----------------------------------------------------------")
+async def refreshHMDBRecord(pool: AsyncConnectionPool, session: ClientSession, writer: BatchWriter, hashes: HashStore, id: str, record: Dict):
+    parts = hmdbParts(record)
+    changed = hashes.changed(id, parts)
+    if changed is None or "compound" in changed:
+        compound_id = await writeHMDBRecord(pool, session, writer, id, record, True)
+    elif not changed:
+        return hashes.compoundId(id)
+    else:
+        compound_id = hashes.compoundId(id)
+        added = []
+        try:
+            biospec_ids = [await insertBioSpecDatabase(pool, biospec) for biospec in record["biospecimens"] or []]
+            async with pool.connection() as conn:
+                async with conn.transaction(), conn.cursor() as cur:
+                    if "biospecimens" in changed:
+                        current = await getBiospecimenIds(conn, cur, compound_id)
+                        removed = [biospec_id for biospec_id in current if biospec_id not in biospec_ids]
+                        added = [biospec_id for biospec_id in biospec_ids if biospec_id not in current]
+                        if removed:
+                            await deleteBiospecimens(conn, cur, compound_id, removed)
+                    if "concentrations" in changed:
+                        # Concentrations have no natural key, so the compound's rows are replaced
+                        await deleteCompoundRows(conn, cur, compound_id, ["concentration"])
+        except (OperationalError, DatabaseError) as e:
+            logger.error(f" {id}: {e}")
+            return
+        for biospec_id in added:
+            writer.addBiospecimen(compound_id, biospec_id)
+        if "concentrations" in changed:
+            for concentration in (record["concentrations"] or []) + (record["abconcentrations"] or []):
+                await writer.addConcentration(compound_id, concentration)
+    if compound_id is not None:
+        hashes.stage(compound_id, id, parts)
+    return compound_id
 
-        
-        for id in ids:
-            await asyncio.gather(*[parseHMDBId(conn, id) for id in ids])
+async def parseHMDBId(pool: AsyncConnectionPool, session: ClientSession, writer: BatchWriter, id: str):
+    logger.debug(f" Parsing HMDB with id: {id}")
+    url = settings.HMDB_MET_PAGE + id + ".xml"
+    page_text = await get_page_text(session, url)
+    record = await runParser(extractHMDBRecordStreaming, page_text)
+    return await writeHMDBRecord(pool, session, writer, id, record)
+
+async def crawlHMDB(pool: AsyncConnectionPool, session: ClientSession, refresh: bool = False, sharded: bool = False) -> None:
+    hashes = HashStore(pool, "HMDB")
+    ledger = None if refresh else (WorkQueue if sharded else CrawlLedger)(pool, "HMDB")
+    if refresh:
+        await hashes.load()
+    writer = BatchWriter(pool, ledger=ledger, hashes=hashes, upsert=sharded)
+
+    async def write(id: str, record: Dict):
+        logger.debug(f" Parsing HMDB with id: {id}")
+        if refresh:
+            compound_id = await refreshHMDBRecord(pool, session, writer, hashes, id, record)
+        else:
+            compound_id = await writeHMDBRecord(pool, session, writer, id, record, ledger.isRetry("compound", id))
+            if compound_id is not None:
+                hashes.stage(compound_id, id, hmdbParts(record))
+        if compound_id is not None:
+            writer.complete(compound_id, id)
+        await writer.flushIfFull()
+        await hashes.flushIfFull()
+        return compound_id
+
+    with revalidating(refresh):
+        await runCrawl(
+            "HMDB", session, range(settings.HMDB_START_PAGE, settings.HMDB_TOTAL_PAGES+1),
+            lambda page_num: settings.HMDB_CATALOG_PAGE + str(page_num), getCatalogIds,
+            lambda id: settings.HMDB_MET_PAGE + id + ".xml", extractHMDBRecordStreaming, write, ledger,
+        )
+    await writer.flush()
+    await hashes.flush()
+    if ledger is not None:
+        await ledger.flush()
+    if refresh:
+        hashes.logStats()
                       
     
 async def main():
     csv = pd.read_csv("data/Missing_HMDB_IDS.csv")
-    async with await psycopg.AsyncConnection.connect(dbname = os.getenv('PSQL_DATABASE'), 
-                        user = os.getenv('PSQL_USERNAME'), 
-                        host= os.getenv('PSQL_HOST'),
-                        password = os.getenv('PSQL_PASSWORD'),
-                        port = 5432) as conn:
+    async with createPool() as pool, createSession() as session:
         # print(csv)
         repopulate_foodmap = True
-        await populate_databases(conn, repopulate_foodmap)
-        await asyncio.gather(*[parseHMDBId(conn, str(id)) for id in csv["hmdb_id"]])
+        async with pool.connection() as conn:
+            await populate_databases(conn, session, repopulate_foodmap)
+        writer = BatchWriter(pool)
+        await asyncio.gather(*[parseHMDBId(pool, session, writer, str(id)) for id in csv["hmdb_id"]])
+        await writer.flush()
+    shutdownParseExecutor()
 
 if __name__ == "__main__":
     load_dotenv()
@@ -0,0 +1,136 @@
+import argparse
+import asyncio
+import json
+import os
+import resource
+import tempfile
+import time
+from dotenv import load_dotenv
+from psycopg import AsyncConnection
+from psycopg.conninfo import make_conninfo
+from typing import Dict
+import settings
+
+import metrics
+from client import createSession
+from FooDB import crawlFooDB
+from HMDB import crawlHMDB
+from mock_server import Fixtures, addFixtureArguments, pointSettings, startServer
+from pipeline import shutdownParseExecutor
+from sql import createPool
+from utility import populate_databases
+
+TABLES = ("food_category", "food", "compound_class", "compound", "food_compounds", "biospecimen",
+          "compound_biospecimens", "concentration", "reference")
+
+async def _maintenance() -> AsyncConnection:
+    conninfo = make_conninfo(dbname="postgres", user=os.getenv('PSQL_USERNAME'), host=os.getenv('PSQL_HOST'),
+                             password=os.getenv('PSQL_PASSWORD'), port=5432)
+    return await AsyncConnection.connect(conninfo, autocommit=True)
+
+async def createDatabase(name: str):
+    conn = await _maintenance()
+    try:
+        await conn.execute(f"DROP DATABASE IF EXISTS {name} WITH (FORCE)")
+        await conn.execute(f"CREATE DATABASE {name}")
+    finally:
+        await conn.close()
+
+async def dropDatabase(name: str):
+    conn = await _maintenance()
+    try:
+        await conn.execute(f"DROP DATABASE IF EXISTS {name} WITH (FORCE)")
+    finally:
+        await conn.close()
+
+def _latency(stage: str) -> Dict[str, float]:
+    histogram = metrics.histograms.get(stage)
+    if histogram is None:
+        return {"p50_ms": 0.0, "p99_ms": 0.0}
+    return {"p50_ms": histogram.quantile(0.5) * 1000, "p99_ms": histogram.quantile(0.99) * 1000}
+
+def summarize(source: str, seconds: float) -> Dict:
+    fetches = metrics.histograms.get("http.get_page_text")
+    pages = fetches.count if fetches else 0
+    compounds = metrics.counters.get(f"{source}.write.done", 0)
+    return {
+        "seconds": seconds,
+        "pages": pages,
+        "pages_per_second": pages / seconds,
+        "compounds": compounds,
+        "compounds_per_second": compounds / seconds,
+        "failed": sum(metrics.counters.get(f"{source}.{stage}.failed", 0) for stage in ("catalog", "fetch", "parse", "write")),
+        "fetch": _latency("http.get_page_text"),
+        "insert_compound": _latency("sql.insertCompoundDatabase"),
+        "insert_batch": _latency("sql.flushBatch"),
+    }
+
+async def runBenchmark(fixtures: Fixtures, database: str, latency: float, keep: bool) -> Dict:
+    runner, base = await startServer(fixtures, latency=latency)
+    pointSettings(fixtures, base)
+    os.environ["PSQL_DATABASE"] = database
+    await createDatabase(database)
+    results: Dict = {"database": database, "foodb_compounds": len(fixtures.foodb_ids), "hmdb_compounds": len(fixtures.hmdb_ids)}
+    try:
+        async with createPool() as pool, createSession() as session:
+            async with pool.connection() as conn:
+                await populate_databases(conn, session, True)
+            for source, crawl in (("FooDB", crawlFooDB), ("HMDB", crawlHMDB)):
+                metrics.clear()
+                start = time.perf_counter()
+                await crawl(pool, session)
+                results[source] = summarize(source, time.perf_counter() - start)
+            async with pool.connection() as conn:
+                results["rows"] = {}
+                for table in TABLES:
+                    cur = await conn.execute(f"SELECT count(*) FROM {table}")
+                    results["rows"][table] = (await cur.fetchone())[0]
+    finally:
+        # Parse workers only count towards RUSAGE_CHILDREN once they have exited
+        shutdownParseExecutor()
+        await runner.cleanup()
+        if not keep:
+            await dropDatabase(database)
+    # ru_maxrss is in kilobytes on Linux
+    results["peak_rss_mb"] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    results["peak_worker_rss_mb"] = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024
+    return results
+
+def printResults(results: Dict):
+    print(f"{'':<8}{'seconds':>9}{'pages/s':>10}{'cmpd/s':>10}{'failed':>8}{'fetch p50':>11}{'fetch p99':>11}"
+          f"{'insert p50':>12}{'insert p99':>12}{'batch p99':>11}")
+    for source in ("FooDB", "HMDB"):
+        result = results[source]
+        print(f"{source:<8}{result['seconds']:>9.2f}{result['pages_per_second']:>10.1f}{result['compounds_per_second']:>10.1f}"
+              f"{result['failed']:>8}{result['fetch']['p50_ms']:>9.1f}ms{result['fetch']['p99_ms']:>9.1f}ms"
+              f"{result['insert_compound']['p50_ms']:>10.1f}ms{result['insert_compound']['p99_ms']:>10.1f}ms"
+              f"{result['insert_batch']['p99_ms']:>9.1f}ms")
+    print(f"Peak RSS {results['peak_rss_mb']:.0f} MB, parse workers {results['peak_worker_rss_mb']:.0f} MB")
+    print("Rows: " + ", ".join(f"{table} {count}" for table, count in results["rows"].items()))
+
+async def main():
+    parser = argparse.ArgumentParser(description="Crawl FooDB and HMDB fixtures from a local mock server into a throwaway database")
+    addFixtureArguments(parser)
+    parser.add_argument("--database", default="foodb_benchmark", help="Database to create for the run, dropped afterwards")
+    parser.add_argument("--keep", action="store_true", help="Keep the database after the run")
+    parser.add_argument("--rate", type=float, default=1000.0, help="Requests per second allowed against the mock")
+    parser.add_argument("--output", help="Also write the results to this JSON file")
+    args = parser.parse_args()
+
+    load_dotenv()
+    # The mock is local, so the per-host limits would measure the rate limiter rather than the crawler
+    settings.HTTP_RATE_PER_HOST = args.rate
+    settings.HTTP_BURST_PER_HOST = max(settings.HTTP_BURST_PER_HOST, int(args.rate))
+    settings.HTTP_CACHE_POLICY = "off"
+
+    fixtures = Fixtures(args.dump, args.hmdb_ids, args.compounds, args.seed)
+    with tempfile.TemporaryDirectory(prefix="foodb_benchmark") as directory:
+        settings.FOOD_MAP_PATH = os.path.join(directory, "food_map")
+        results = await runBenchmark(fixtures, args.database, args.latency, args.keep)
+    printResults(results)
+    if args.output:
+        with open(args.output, "w") as file:
+            json.dump(results, file, indent=2)
+
+if __name__ == "__main__":
+    asyncio.run(main())
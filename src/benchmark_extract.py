@@ -0,0 +1,197 @@
+import argparse
+import json
+import logging
+import os
+import time
+import tracemalloc
+import warnings
+import lxml.html
+from bs4 import XMLParsedAsHTMLWarning
+from lxml import etree
+from typing import Callable, Dict, List, Optional, Tuple
+import settings
+
+import FooDB
+import HMDB
+import cache
+from hmdb_stream import extractHMDBRecordStreaming
+from mock_server import Fixtures, fooDBCatalogPage, fooDBCompoundXml, hmdbCatalogPage, hmdbMetaboliteXml, CATALOG_PAGE_SIZE
+
+try:
+    from lxml.cssselect import CSSSelector
+except ImportError:
+    CSSSelector = None
+
+FOODB_CATALOG_XPATH = etree.XPath("//a[contains(concat(' ', normalize-space(@class), ' '), ' btn-show ')]")
+HMDB_CATALOG_XPATH = etree.XPath("//td[contains(concat(' ', normalize-space(@class), ' '), ' metabolite-link ')]")
+
+def fooDBCatalogXPath(page_text: str) -> List[str]:
+    return [link.text_content() for link in FOODB_CATALOG_XPATH(lxml.html.fromstring(page_text))]
+
+def hmdbCatalogXPath(page_text: str) -> List[str]:
+    return [cell.find(".//a").text_content() for cell in HMDB_CATALOG_XPATH(lxml.html.fromstring(page_text))]
+
+# kind -> backend -> extractor. The first backend of each kind is the one the crawler uses and the reference
+# the others are checked against.
+EXTRACTORS: Dict[str, Dict[str, Callable[[str], object]]] = {
+    "foodb": {
+        "lxml xpath spec": FooDB.extractFooDBRecord,
+        "bs lxml-xml": lambda text: FooDB.extractFooDBRecordSoup(text, "lxml-xml"),
+        "bs html.parser": lambda text: FooDB.extractFooDBRecordSoup(text, "html.parser"),
+        "bs lxml": lambda text: FooDB.extractFooDBRecordSoup(text, "lxml"),
+    },
+    "hmdb": {
+        "lxml iterparse": extractHMDBRecordStreaming,
+        "bs lxml-xml": lambda text: HMDB.extractHMDBRecord(text, "lxml-xml"),
+        "bs html.parser": lambda text: HMDB.extractHMDBRecord(text, "html.parser"),
+        "bs lxml": lambda text: HMDB.extractHMDBRecord(text, "lxml"),
+    },
+    "foodb_catalog": {
+        "bs html.parser": lambda text: FooDB.getCatalogIds(text, "html.parser"),
+        "bs lxml": lambda text: FooDB.getCatalogIds(text, "lxml"),
+        "bs lxml-xml": lambda text: FooDB.getCatalogIds(text, "lxml-xml"),
+        "lxml xpath": fooDBCatalogXPath,
+    },
+    "hmdb_catalog": {
+        "bs html.parser": lambda text: HMDB.getCatalogIds(text, "html.parser"),
+        "bs lxml": lambda text: HMDB.getCatalogIds(text, "lxml"),
+        "bs lxml-xml": lambda text: HMDB.getCatalogIds(text, "lxml-xml"),
+        "lxml xpath": hmdbCatalogXPath,
+    },
+}
+
+if CSSSelector is not None:
+    FOODB_CATALOG_CSS = CSSSelector("a.btn-show")
+    HMDB_CATALOG_CSS = CSSSelector("td.metabolite-link a")
+    EXTRACTORS["foodb_catalog"]["lxml cssselect"] = lambda text: [link.text_content() for link in FOODB_CATALOG_CSS(lxml.html.fromstring(text))]
+    EXTRACTORS["hmdb_catalog"]["lxml cssselect"] = lambda text: [link.text_content() for link in HMDB_CATALOG_CSS(lxml.html.fromstring(text))]
+
+def _kind(url: str) -> Optional[str]:
+    if url.startswith(settings.FOODB_CATALOG_PAGE):
+        return "foodb_catalog"
+    if url.startswith(settings.HMDB_CATALOG_PAGE):
+        return "hmdb_catalog"
+    if url.startswith(settings.FOODB_MET_PAGE):
+        return "foodb"
+    if url.startswith(settings.HMDB_MET_PAGE):
+        return "hmdb"
+    return None
+
+def corpusFromCache(directory: str, limit: Optional[int]) -> Dict[str, List[str]]:
+    # Pages saved by earlier crawls, read through the HTTP cache's own index
+    settings.HTTP_CACHE_DIR = directory
+    corpus: Dict[str, List[str]] = {kind: [] for kind in EXTRACTORS}
+    for root, _, files in os.walk(os.path.join(directory, "urls")):
+        for file in files:
+            with open(os.path.join(root, file)) as meta:
+                url = json.load(meta)["url"]
+            kind = _kind(url)
+            if kind is None or (limit and len(corpus[kind]) >= limit):
+                continue
+            entry = cache._lookup(url)
+            if entry is not None:
+                corpus[kind].append(entry["text"])
+    return corpus
+
+def corpusFromFixtures(dump_path: str, hmdb_ids_path: str, limit: Optional[int], seed: int) -> Dict[str, List[str]]:
+    fixtures = Fixtures(dump_path, hmdb_ids_path, limit, seed)
+    hmdb_ids = fixtures.hmdb_ids[:limit]
+    return {
+        "foodb": [fooDBCompoundXml(fixtures, id) for id in fixtures.foodb_ids],
+        "hmdb": [hmdbMetaboliteXml(fixtures, id) for id in hmdb_ids],
+        "foodb_catalog": [fooDBCatalogPage(fixtures, page) for page in range(1, fixtures.pages(fixtures.foodb_ids) + 1)],
+        "hmdb_catalog": [hmdbCatalogPage(fixtures, page) for page in range(1, -(-len(hmdb_ids) // CATALOG_PAGE_SIZE) + 1)],
+    }
+
+def timeExtractor(extract: Callable[[str], object], documents: List[str], repeats: int) -> float:
+    # Best pass of repeats, in ns per document
+    best = None
+    for _ in range(repeats):
+        start = time.perf_counter_ns()
+        for document in documents:
+            extract(document)
+        elapsed = time.perf_counter_ns() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best / len(documents)
+
+def measureAllocations(extract: Callable[[str], object], documents: List[str]) -> Tuple[float, float]:
+    # Mean peak and mean retained Python heap per document. tracemalloc only sees the Python allocator,
+    # so memory libxml2 allocates for its own trees is not counted.
+    tracemalloc.start()
+    peaks = retained = 0
+    try:
+        for document in documents:
+            before = tracemalloc.get_traced_memory()[0]
+            tracemalloc.reset_peak()
+            result = extract(document)
+            current, peak = tracemalloc.get_traced_memory()
+            peaks += peak - before
+            retained += current - before
+            del result
+    finally:
+        tracemalloc.stop()
+    return peaks / len(documents), retained / len(documents)
+
+def benchmark(corpus: Dict[str, List[str]], repeats: int, only: Optional[List[str]] = None) -> List[Dict]:
+    results = []
+    for kind, backends in EXTRACTORS.items():
+        documents = corpus.get(kind) or []
+        if not documents or (only and kind not in only):
+            continue
+        reference = None
+        for backend, extract in backends.items():
+            result = {"kind": kind, "backend": backend, "documents": len(documents)}
+            try:
+                outputs = [extract(document) for document in documents]
+            except Exception as e:
+                result["error"] = repr(e)
+                results.append(result)
+                continue
+            if reference is None:
+                reference = outputs
+            result["mismatches"] = sum(output != expected for output, expected in zip(outputs, reference))
+            result["ns_per_document"] = timeExtractor(extract, documents, repeats)
+            result["peak_bytes_per_document"], result["retained_bytes_per_document"] = measureAllocations(extract, documents)
+            results.append(result)
+    return results
+
+def printResults(results: List[Dict]):
+    print(f"{'kind':<15}{'backend':<17}{'docs':>6}{'us/doc':>11}{'speedup':>9}{'peak KiB':>10}{'identical':>11}")
+    baseline: Dict[str, float] = {}
+    for result in results:
+        if "error" in result:
+            print(f"{result['kind']:<15}{result['backend']:<17}{result['documents']:>6}  failed: {result['error'][:60]}")
+            continue
+        ns = result["ns_per_document"]
+        baseline.setdefault(result["kind"], ns)
+        identical = "yes" if not result["mismatches"] else f"{result['mismatches']} differ"
+        print(f"{result['kind']:<15}{result['backend']:<17}{result['documents']:>6}{ns / 1000:>11.1f}"
+              f"{baseline[result['kind']] / ns:>8.2f}x{result['peak_bytes_per_document'] / 1024:>10.1f}{identical:>11}")
+
+def main():
+    parser = argparse.ArgumentParser(description="Time the FooDB and HMDB extractors with every parser backend on the same pages")
+    parser.add_argument("--cache", help="HTTP cache directory of an earlier crawl to take the pages from")
+    parser.add_argument("--dump", default="../sql/foodb_20250416.sql", help="pg_dump to generate pages from when there is no --cache")
+    parser.add_argument("--hmdb-ids", default="../data/Missing_HMDB_IDS.csv", help="HMDB ids to generate pages for when there is no --cache")
+    parser.add_argument("--documents", type=int, default=200, help="Documents per kind")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--repeats", type=int, default=5, help="Timed passes over the corpus, the best is reported")
+    parser.add_argument("--kind", action="append", choices=list(EXTRACTORS), help="Only benchmark these kinds of page")
+    parser.add_argument("--output", help="Also write the results to this JSON file")
+    args = parser.parse_args()
+
+    # Warnings about missing fields would otherwise be timed along with the parsing
+    logging.getLogger().setLevel(logging.ERROR)
+    warnings.filterwarnings("ignore", category=XMLParsedAsHTMLWarning)
+    if args.cache:
+        corpus = corpusFromCache(args.cache, args.documents)
+    else:
+        corpus = corpusFromFixtures(args.dump, args.hmdb_ids, args.documents, args.seed)
+    results = benchmark(corpus, args.repeats, args.kind)
+    printResults(results)
+    if args.output:
+        with open(args.output, "w") as file:
+            json.dump(results, file, indent=2)
+
+if __name__ == "__main__":
+    main()
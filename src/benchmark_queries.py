@@ -0,0 +1,96 @@
+import argparse
+import asyncio
+import statistics
+from dotenv import load_dotenv
+from psycopg import AsyncConnection
+from typing import Dict, List, Optional, Tuple
+
+from export_to_json import BIOSPECIMEN_QUERY, FOOD_CATEGORY_QUERY
+from sql import createPool
+from migrations import INDEXES, migrate
+
+# Exports plus the lookups and cascading deletes the crawler runs per compound. Each is timed with
+# EXPLAIN ANALYZE inside a transaction that is rolled back, so the deletes leave the data alone and
+# the "before" runs can drop the indexes without touching the schema.
+QUERIES = {
+    "export biospecimen": BIOSPECIMEN_QUERY.format(biospecimen="%(biospecimen_id)s"),
+    "export food category": FOOD_CATEGORY_QUERY.replace(":name", "%(category)s"),
+    "compound biospecimens": "SELECT biospecimen_id FROM compound_biospecimens WHERE compound_id = %(compound_id)s",
+    "compounds in biospecimen": "SELECT compound_id FROM compound_biospecimens WHERE biospecimen_id = %(biospecimen_id)s",
+    "compound food rows": "SELECT food_id, average_value, max_value, min_value FROM food_compounds WHERE compound_id = %(compound_id)s",
+    "foods compounds": "SELECT compound_id FROM food_compounds WHERE food_id = %(food_id)s",
+    "replace concentrations": "DELETE FROM concentration WHERE compound_id = %(compound_id)s",
+    "delete compound": "DELETE FROM compound WHERE id = %(compound_id)s",
+    "delete food": "DELETE FROM food WHERE id = %(food_id)s",
+}
+
+async def sampleParams(conn: AsyncConnection) -> Dict:
+    # The compound with the most concentration rows and the most used food, biospecimen and category
+    params_select = """
+        SELECT
+            (SELECT compound_id FROM concentration GROUP BY compound_id ORDER BY count(*) DESC LIMIT 1),
+            (SELECT food_id FROM food_compounds GROUP BY food_id ORDER BY count(*) DESC LIMIT 1),
+            (SELECT biospecimen_id FROM compound_biospecimens GROUP BY biospecimen_id ORDER BY count(*) DESC LIMIT 1),
+            (SELECT fc.name FROM food f JOIN food_category fc ON fc.id = f.category_id
+                JOIN food_compounds fcs ON fcs.food_id = f.id GROUP BY fc.name ORDER BY count(*) DESC LIMIT 1)
+    """
+    cur = await conn.execute(params_select)
+    compound_id, food_id, biospecimen_id, category = await cur.fetchone()
+    if compound_id is None:
+        cur = await conn.execute("SELECT id FROM compound ORDER BY id LIMIT 1")
+        row = await cur.fetchone()
+        compound_id = row[0] if row else 0
+    return {"compound_id": compound_id, "food_id": food_id or 0, "biospecimen_id": biospecimen_id or 0, "category": category or ""}
+
+async def timeQuery(conn: AsyncConnection, query: str, params: Dict, indexed: bool) -> Tuple[float, str]:
+    async with conn.transaction(force_rollback=True):
+        if not indexed:
+            for index_name in INDEXES:
+                await conn.execute(f"DROP INDEX IF EXISTS {index_name}")
+        cur = await conn.execute("EXPLAIN (ANALYZE, FORMAT JSON) " + query, params)
+        plan = (await cur.fetchone())[0][0]
+    return plan["Execution Time"], _scans(plan["Plan"])
+
+def _scans(node: Dict) -> str:
+    # The scan nodes of the plan, which is where a missing index shows up
+    scans: List[str] = []
+    stack = [node]
+    while stack:
+        node = stack.pop()
+        if "Scan" in node["Node Type"] and "Relation Name" in node:
+            scans.append(f"{node['Node Type']} on {node['Relation Name']}")
+        stack.extend(node.get("Plans", []))
+    return ", ".join(sorted(set(scans)))
+
+async def benchmark(conn: AsyncConnection, repeats: int, only: Optional[List[str]] = None):
+    params = await sampleParams(conn)
+    print(f"Parameters: {params}")
+    print(f"{'query':<26}{'before ms':>12}{'after ms':>12}{'speedup':>10}")
+    for name, query in QUERIES.items():
+        if only and name not in only:
+            continue
+        timings = {}
+        scans = {}
+        for indexed in (False, True):
+            runs = [await timeQuery(conn, query, params, indexed) for _ in range(repeats)]
+            timings[indexed] = statistics.median(ms for ms, _ in runs)
+            scans[indexed] = runs[-1][1]
+        speedup = timings[False] / timings[True] if timings[True] else float("inf")
+        print(f"{name:<26}{timings[False]:>12.3f}{timings[True]:>12.3f}{speedup:>9.1f}x")
+        if scans[False] != scans[True]:
+            print(f"    before: {scans[False]}")
+            print(f"    after:  {scans[True]}")
+
+async def main():
+    parser = argparse.ArgumentParser(description="EXPLAIN ANALYZE the export and crawler queries with and without the secondary indexes")
+    parser.add_argument("--repeats", type=int, default=5, help="Runs per query, the median is reported")
+    parser.add_argument("--query", action="append", choices=list(QUERIES), help="Only run these queries")
+    args = parser.parse_args()
+
+    load_dotenv()
+    async with createPool() as pool, pool.connection() as conn:
+        await migrate(conn)
+        await benchmark(conn, args.repeats, args.query)
+
+if __name__ == "__main__":
+    asyncio.run(main())
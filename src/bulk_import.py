@@ -0,0 +1,217 @@
+import argparse
+import asyncio
+import csv
+import os
+import sys
+from dotenv import load_dotenv
+from psycopg import AsyncCursor
+from psycopg_pool import AsyncConnectionPool
+from typing import Callable, Dict, List, Optional, Tuple
+import settings
+
+from hmdb_stream import iterHMDBRecords
+from logger import logger
+from compound_index import compound_index
+from sql import createPool, insertBioSpecDatabase, populateCompoundIndex
+from migrations import deferredIndexes, migrate
+from writer import BatchWriter, allocateIds
+
+# Columns read from the FooDB CSV export (Food.csv, Compound.csv, Content.csv)
+FOODB_FOOD_COLUMNS = ("id", "name", "food_group")
+FOODB_COMPOUND_COLUMNS = ("id", "public_id", "name", "klass")
+FOODB_CONTENT_COLUMNS = ("source_id", "food_id", "standard_content")
+
+NUMERIC = "'^[-+]?([0-9]+\\.?[0-9]*|\\.[0-9]+)([eE][-+]?[0-9]+)?$'"
+
+async def _copyCsv(cur: AsyncCursor, path: str, table: str, columns: Tuple[str, ...],
+                   keep: Optional[Callable[[Dict[str, str]], bool]] = None) -> int:
+    count = 0
+    with open(path, newline="", encoding="utf-8") as file:
+        reader = csv.DictReader(file)
+        async with cur.copy(f"COPY {table} ({', '.join(columns)}) FROM STDIN") as copy:
+            for row in reader:
+                if keep is None or keep(row):
+                    await copy.write_row([row.get(col) or None for col in columns])
+                    count += 1
+    return count
+
+async def importFooDB(pool: AsyncConnectionPool, foodb_dir: str):
+    # The raw CSV rows are streamed into temporary tables and aggregated in Postgres, so the
+    # importer's memory use does not depend on the size of the export
+    csv.field_size_limit(sys.maxsize)
+    async with pool.connection() as conn:
+        async with conn.transaction(), conn.cursor() as cur:
+            await cur.execute(f"""
+                CREATE TEMP TABLE foodb_food ({', '.join(f'{col} TEXT' for col in FOODB_FOOD_COLUMNS)}) ON COMMIT DROP;
+                CREATE TEMP TABLE foodb_compound ({', '.join(f'{col} TEXT' for col in FOODB_COMPOUND_COLUMNS)}) ON COMMIT DROP;
+                CREATE TEMP TABLE foodb_content ({', '.join(f'{col} TEXT' for col in FOODB_CONTENT_COLUMNS)}) ON COMMIT DROP;
+            """)
+            foods = await _copyCsv(cur, os.path.join(foodb_dir, "Food.csv"), "foodb_food", FOODB_FOOD_COLUMNS)
+            compounds = await _copyCsv(cur, os.path.join(foodb_dir, "Compound.csv"), "foodb_compound", FOODB_COMPOUND_COLUMNS)
+            contents = await _copyCsv(cur, os.path.join(foodb_dir, "Content.csv"), "foodb_content", FOODB_CONTENT_COLUMNS,
+                                      lambda row: row.get("source_type") == "Compound")
+            logger.info(f" Loaded {foods} foods, {compounds} compounds and {contents} compound contents from {foodb_dir}")
+
+            await cur.execute(f"""
+                CREATE TEMP TABLE foodb_quantified ON COMMIT DROP AS
+                SELECT source_id, food_id, standard_content::real AS content
+                FROM foodb_content
+                WHERE standard_content ~ {NUMERIC}
+            """)
+            await cur.execute("""
+                INSERT INTO food_category (name)
+                SELECT DISTINCT coalesce(food_group, 'UNKNOWN') FROM foodb_food
+                WHERE length(coalesce(food_group, 'UNKNOWN')) <= 50
+                ON CONFLICT (name) DO NOTHING
+            """)
+            await cur.execute("""
+                INSERT INTO food (category_id, name)
+                SELECT DISTINCT ON (ff.name) fc.id, ff.name FROM foodb_food ff
+                JOIN food_category fc ON fc.name = coalesce(ff.food_group, 'UNKNOWN')
+                WHERE length(ff.name) <= 50
+                ON CONFLICT (name) DO NOTHING
+            """)
+            await cur.execute("""
+                INSERT INTO compound_class (name)
+                SELECT DISTINCT c.klass FROM foodb_compound c
+                WHERE c.klass IS NOT NULL AND length(c.klass) <= 50
+                AND EXISTS (SELECT 1 FROM foodb_quantified q WHERE q.source_id = c.id)
+                ON CONFLICT (name) DO NOTHING
+            """)
+            await cur.execute("""
+                INSERT INTO compound (class_id, name, foodb_id)
+                SELECT DISTINCT ON (c.name) cc.id, c.name, c.public_id FROM foodb_compound c
+                LEFT JOIN compound_class cc ON cc.name = c.klass
+                WHERE length(c.name) <= 100 AND length(c.public_id) <= 9
+                AND EXISTS (SELECT 1 FROM foodb_quantified q WHERE q.source_id = c.id)
+                ORDER BY c.name, c.public_id
+                ON CONFLICT DO NOTHING
+            """)
+            logger.info(f" Inserted {cur.rowcount} FooDB compounds")
+            # Same per-food aggregate the compound pages show, minus the all-zero rows getFoods drops.
+            # All three values come from standard_content, orig_min and orig_max are in each source's own unit
+            await cur.execute("""
+                INSERT INTO food_compounds (compound_id, food_id, average_value, max_value, min_value)
+                SELECT c.id, f.id, avg(q.content), max(q.content), min(q.content)
+                FROM foodb_quantified q
+                JOIN foodb_compound fc ON fc.id = q.source_id
+                JOIN compound c ON c.foodb_id = fc.public_id
+                JOIN foodb_food ff ON ff.id = q.food_id
+                JOIN food f ON f.name = ff.name
+                GROUP BY c.id, f.id
+                HAVING NOT (max(q.content) = 0 AND min(q.content) = 0)
+                ON CONFLICT DO NOTHING
+            """)
+            logger.info(f" Inserted {cur.rowcount} food compound rows")
+
+def _keepHMDBRecord(record: Dict) -> bool:
+    # Mirrors the filters in settings.HMDB_CATALOG_PAGE: quantified, detected in blood, found in food
+    if not record["foodb_id"]:
+        return False
+    if settings.HMDB_DUMP_BIOSPECIMEN not in (record["biospecimens"] or []):
+        return False
+    return bool(record["concentrations"] or record["abconcentrations"])
+
+async def _writeHMDBBatch(pool: AsyncConnectionPool, writer: BatchWriter, batch: List[Tuple[str, Dict]]):
+    new_compounds: List[Tuple[str, str, Optional[str]]] = []
+    new_by_key: Dict[str, int] = {}
+    hmdb_updates = []
+    resolved = []
+    skipped = 0
+    for hmdb_id, record in batch:
+        name, foodb_id = record["name"], record["foodb_id"]
+        # Same limits as the FooDB half, the compound columns are VARCHAR(100), CHAR(11) and CHAR(9)
+        if not name or len(name) > 100 or len(hmdb_id) > 11 or len(foodb_id) > 9:
+            logger.warning(f" {hmdb_id}: Skipping metabolite {name!r} with foodb_id {foodb_id} that does not fit the compound table")
+            skipped += 1
+            continue
+        compound_id = compound_index.byName(name)
+        if compound_id is not None:
+            if not compound_index.hasFooDBId(compound_id, foodb_id):
+                logger.error(f" {hmdb_id}: Issue aligning metabolite {name} with id {compound_index.fooDBId(compound_id)} in database and parsed foodb_id {foodb_id}")
+                continue
+        else:
+            compound_id = compound_index.byFooDBId(foodb_id)
+        if compound_id is not None:
+            hmdb_updates.append((compound_id, hmdb_id))
+            resolved.append((compound_id, None, record))
+        else:
+            # Compounds FooDB doesn't know yet. A name or foodb_id repeated inside the batch maps to one row
+            index = new_by_key.get(name, new_by_key.get(foodb_id))
+            if index is None:
+                index = len(new_compounds)
+                new_compounds.append((name, hmdb_id, foodb_id))
+                new_by_key[name] = new_by_key[foodb_id] = index
+            resolved.append((None, index, record))
+    if skipped:
+        logger.warning(f" Skipped {skipped} of {len(batch)} HMDB metabolites in batch")
+
+    new_ids: List[int] = []
+    async with pool.connection() as conn:
+        async with conn.transaction(), conn.cursor() as cur:
+            if new_compounds:
+                new_ids = await allocateIds(cur, "compound", len(new_compounds))
+                async with cur.copy("COPY compound (id, name, hmdb_id, foodb_id) FROM STDIN") as copy:
+                    for compound_id, row in zip(new_ids, new_compounds):
+                        await copy.write_row((compound_id, *row))
+            if hmdb_updates:
+                await cur.execute("CREATE TEMP TABLE IF NOT EXISTS hmdb_update (compound_id INT, hmdb_id TEXT) ON COMMIT DELETE ROWS")
+                async with cur.copy("COPY hmdb_update (compound_id, hmdb_id) FROM STDIN") as copy:
+                    for row in hmdb_updates:
+                        await copy.write_row(row)
+                await cur.execute("UPDATE compound SET hmdb_id = u.hmdb_id FROM hmdb_update u WHERE compound.id = u.compound_id")
+
+    for compound_id, (name, hmdb_id, foodb_id) in zip(new_ids, new_compounds):
+        compound_index.add(compound_id, name, foodb_id, hmdb_id)
+    for compound_id, hmdb_id in hmdb_updates:
+        compound_index.add(compound_id, hmdb_id=hmdb_id)
+
+    for compound_id, index, record in resolved:
+        if compound_id is None:
+            compound_id = new_ids[index]
+        for biospec in record["biospecimens"] or []:
+            writer.addBiospecimen(compound_id, await insertBioSpecDatabase(pool, biospec))
+        for concentration in (record["concentrations"] or []) + (record["abconcentrations"] or []):
+            await writer.addConcentration(compound_id, concentration)
+    await writer.flushIfFull()
+
+async def importHMDB(pool: AsyncConnectionPool, hmdb_path: str):
+    async with pool.connection() as conn:
+        await populateCompoundIndex(conn)
+
+    writer = BatchWriter(pool)
+    batch = []
+    seen = kept = 0
+    for hmdb_id, record in iterHMDBRecords(hmdb_path):
+        seen += 1
+        if not _keepHMDBRecord(record):
+            continue
+        kept += 1
+        batch.append((hmdb_id, record))
+        if len(batch) >= settings.IMPORT_BATCH_SIZE:
+            await _writeHMDBBatch(pool, writer, batch)
+            batch = []
+            logger.info(f" Imported {kept} of {seen} HMDB metabolites")
+    if batch:
+        await _writeHMDBBatch(pool, writer, batch)
+    await writer.flush()
+    logger.info(f" Imported {kept} of {seen} HMDB metabolites")
+
+async def main():
+    parser = argparse.ArgumentParser(description="Build the database from local FooDB/HMDB dumps instead of crawling")
+    parser.add_argument("--foodb", help="Directory holding the FooDB CSV export (Food.csv, Compound.csv, Content.csv)")
+    parser.add_argument("--hmdb", help="Path to hmdb_metabolites.xml")
+    args = parser.parse_args()
+
+    load_dotenv()
+    async with createPool() as pool:
+        async with pool.connection() as conn:
+            await migrate(conn)
+        async with deferredIndexes(pool):
+            if args.foodb:
+                await importFooDB(pool, args.foodb)
+            if args.hmdb:
+                await importHMDB(pool, args.hmdb)
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,130 @@
+import asyncio
+import gzip
+import hashlib
+import json
+import os
+import tempfile
+import time
+from typing import Dict, Optional
+import settings
+
+from logger import logger
+
+cache_stats: Dict[str, int] = {"hits": 0, "revalidated": 0, "misses": 0, "stored": 0, "evicted": 0}
+_cache_size: Optional[int] = None
+
+class CacheMiss(Exception):
+    pass
+
+def _metaPath(url: str) -> str:
+    key = hashlib.sha256(url.encode()).hexdigest()
+    return os.path.join(settings.HTTP_CACHE_DIR, "urls", key[:2], key + ".json")
+
+def _objectPath(digest: str) -> str:
+    return os.path.join(settings.HTTP_CACHE_DIR, "objects", digest[:2], digest + ".gz")
+
+def _writeAtomic(path: str, data: bytes):
+    # A temp file of its own per write, as threads of one process can store the same URL or body at once
+    directory = os.path.dirname(path)
+    os.makedirs(directory, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=directory, prefix=os.path.basename(path) + ".", suffix=".tmp")
+    try:
+        with os.fdopen(fd, "wb") as file:
+            file.write(data)
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+
+def _lookup(url: str) -> Optional[Dict]:
+    try:
+        with open(_metaPath(url)) as file:
+            entry = json.load(file)
+        with open(_objectPath(entry["sha256"]), "rb") as file:
+            entry["text"] = gzip.decompress(file.read()).decode()
+    except (FileNotFoundError, ValueError, OSError):
+        return None
+    return entry
+
+def _store(url: str, text: str, etag: Optional[str], last_modified: Optional[str]) -> int:
+    body = text.encode()
+    digest = hashlib.sha256(body).hexdigest()
+    object_path = _objectPath(digest)
+    added = 0
+    if not os.path.exists(object_path):
+        compressed = gzip.compress(body, compresslevel=6)
+        _writeAtomic(object_path, compressed)
+        added = len(compressed)
+    entry = {
+        "url": url,
+        "sha256": digest,
+        "etag": etag,
+        "last_modified": last_modified,
+        "fetched_at": time.time(),
+    }
+    _writeAtomic(_metaPath(url), json.dumps(entry).encode())
+    return added
+
+def _touch(url: str, entry: Dict):
+    entry = {key: value for key, value in entry.items() if key != "text"}
+    entry["fetched_at"] = time.time()
+    _writeAtomic(_metaPath(url), json.dumps(entry).encode())
+    os.utime(_objectPath(entry["sha256"]))
+
+def _scanObjects():
+    objects = []
+    for root, _, files in os.walk(os.path.join(settings.HTTP_CACHE_DIR, "objects")):
+        for name in files:
+            if name.endswith(".tmp"):
+                continue
+            path = os.path.join(root, name)
+            stat = os.stat(path)
+            objects.append((stat.st_mtime, stat.st_size, path))
+    return objects
+
+def _evict() -> int:
+    # Entries whose object was evicted are treated as misses on the next lookup
+    objects = sorted(_scanObjects())
+    total = sum(size for _, size, _ in objects)
+    target = settings.HTTP_CACHE_MAX_BYTES * 0.9
+    evicted = 0
+    for _, size, path in objects:
+        if total <= target:
+            break
+        os.remove(path)
+        total -= size
+        evicted += 1
+    cache_stats["evicted"] += evicted
+    return total
+
+async def lookup(url: str) -> Optional[Dict]:
+    return await asyncio.to_thread(_lookup, url)
+
+async def store(url: str, text: str, etag: Optional[str] = None, last_modified: Optional[str] = None):
+    global _cache_size
+    if _cache_size is None:
+        _cache_size = sum(size for _, size, _ in await asyncio.to_thread(_scanObjects))
+    _cache_size += await asyncio.to_thread(_store, url, text, etag, last_modified)
+    cache_stats["stored"] += 1
+    if _cache_size > settings.HTTP_CACHE_MAX_BYTES:
+        logger.info(f" Response cache over {settings.HTTP_CACHE_MAX_BYTES} bytes. Evicting")
+        _cache_size = await asyncio.to_thread(_evict)
+
+async def touch(url: str, entry: Dict):
+    await asyncio.to_thread(_touch, url, entry)
+
+def isFresh(entry: Dict) -> bool:
+    return time.time() - entry["fetched_at"] < settings.HTTP_CACHE_TTL
+
+def conditionalHeaders(entry: Optional[Dict]) -> Dict[str, str]:
+    headers = {}
+    if entry:
+        if entry.get("etag"):
+            headers["If-None-Match"] = entry["etag"]
+        if entry.get("last_modified"):
+            headers["If-Modified-Since"] = entry["last_modified"]
+    return headers
+
+def logCacheStats():
+    logger.info(f" Response cache: {cache_stats['hits']} hits, {cache_stats['revalidated']} revalidated, "
+                f"{cache_stats['misses']} misses, {cache_stats['stored']} stored, {cache_stats['evicted']} evicted")
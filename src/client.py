@@ -0,0 +1,59 @@
+import aiohttp
+from types import SimpleNamespace
+from typing import Dict
+import settings
+
+from logger import logger
+
+connection_stats: Dict[str, Dict[str, int]] = {}
+
+def _hostStats(host: str) -> Dict[str, int]:
+    if host not in connection_stats:
+        connection_stats[host] = {"requests": 0, "created": 0, "reused": 0, "dns_hits": 0, "dns_misses": 0}
+    return connection_stats[host]
+
+async def _onRequestStart(session, ctx: SimpleNamespace, params: aiohttp.TraceRequestStartParams):
+    ctx.host = params.url.host
+    _hostStats(ctx.host)["requests"] += 1
+
+async def _onConnectionCreateEnd(session, ctx: SimpleNamespace, params):
+    _hostStats(ctx.host)["created"] += 1
+
+async def _onConnectionReuse(session, ctx: SimpleNamespace, params):
+    _hostStats(ctx.host)["reused"] += 1
+
+async def _onDnsCacheHit(session, ctx: SimpleNamespace, params: aiohttp.TraceDnsCacheHitParams):
+    _hostStats(params.host)["dns_hits"] += 1
+
+async def _onDnsCacheMiss(session, ctx: SimpleNamespace, params: aiohttp.TraceDnsCacheMissParams):
+    _hostStats(params.host)["dns_misses"] += 1
+
+def createSession() -> aiohttp.ClientSession:
+    connector = aiohttp.TCPConnector(
+        limit=settings.HTTP_CONNECTION_LIMIT,
+        limit_per_host=settings.HTTP_LIMIT_PER_HOST,
+        ttl_dns_cache=settings.HTTP_DNS_CACHE_TTL,
+        keepalive_timeout=settings.HTTP_KEEPALIVE_TIMEOUT,
+    )
+    trace_config = aiohttp.TraceConfig()
+    trace_config.on_request_start.append(_onRequestStart)
+    trace_config.on_connection_create_end.append(_onConnectionCreateEnd)
+    trace_config.on_connection_reuseconn.append(_onConnectionReuse)
+    trace_config.on_dns_cache_hit.append(_onDnsCacheHit)
+    trace_config.on_dns_cache_miss.append(_onDnsCacheMiss)
+
+    return aiohttp.ClientSession(
+        connector=connector,
+        timeout=aiohttp.ClientTimeout(
+            total=settings.HTTP_TIMEOUT,
+            sock_connect=settings.HTTP_CONNECT_TIMEOUT,
+            sock_read=settings.HTTP_READ_TIMEOUT,
+        ),
+        headers={"Accept-Encoding": "gzip, deflate"},
+        trace_configs=[trace_config],
+    )
+
+def logConnectionStats():
+    for host, stats in connection_stats.items():
+        logger.info(f" {host}: {stats['requests']} requests, {stats['created']} connections created, "
+                    f"{stats['reused']} reused, {stats['dns_misses']} DNS lookups")
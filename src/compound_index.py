@@ -0,0 +1,83 @@
+import asyncio
+from typing import Dict, List, Optional, Union
+
+Key = Union[int, str]
+
+def _key(accession: str) -> Key:
+    # FDB000123 / HMDB0000123 are held as their number, anything unexpected as the stripped string
+    accession = accession.strip()
+    digits = accession.lstrip("ABCDEFGHIJKLMNOPQRSTUVWXYZ")
+    return int(digits) if digits.isdigit() else accession
+
+class CompoundIndex:
+    # name, foodb_id and hmdb_id -> compound id, so reconciling HMDB against FooDB needs no queries.
+    # Entries are only added once the transaction that wrote them has committed.
+    LOCK_STRIPES = 64
+
+    def __init__(self):
+        self.clear()
+
+    def clear(self):
+        self.by_name: Dict[str, int] = {}
+        self.by_foodb: Dict[Key, int] = {}
+        self.by_hmdb: Dict[Key, int] = {}
+        self.names: Dict[int, str] = {}
+        self.foodb_ids: Dict[int, Key] = {}
+        self.hmdb_ids: Dict[int, Key] = {}
+        self.locks: Dict[str, List[asyncio.Lock]] = {}
+        self.loop = None
+
+    def __len__(self) -> int:
+        return len(self.names)
+
+    def _set(self, forward: Dict, reverse: Dict, compound_id: int, key):
+        old = reverse.get(compound_id)
+        if old is not None and old != key and forward.get(old) == compound_id:
+            del forward[old]
+        forward[key] = compound_id
+        reverse[compound_id] = key
+
+    def add(self, compound_id: int, name: Optional[str] = None, foodb_id: Optional[str] = None, hmdb_id: Optional[str] = None):
+        if name is not None:
+            self._set(self.by_name, self.names, compound_id, name)
+        if foodb_id:
+            self._set(self.by_foodb, self.foodb_ids, compound_id, _key(foodb_id))
+        if hmdb_id:
+            self._set(self.by_hmdb, self.hmdb_ids, compound_id, _key(hmdb_id))
+
+    def byName(self, name: str) -> Optional[int]:
+        return self.by_name.get(name)
+
+    def byFooDBId(self, foodb_id: str) -> Optional[int]:
+        return self.by_foodb.get(_key(foodb_id))
+
+    def byHMDBId(self, hmdb_id: str) -> Optional[int]:
+        return self.by_hmdb.get(_key(hmdb_id))
+
+    def hasFooDBId(self, compound_id: int, foodb_id: Optional[str]) -> bool:
+        return self.foodb_ids.get(compound_id) == (_key(foodb_id) if foodb_id else None)
+
+    def hasHMDBId(self, compound_id: int, hmdb_id: str) -> bool:
+        return self.hmdb_ids.get(compound_id) == _key(hmdb_id)
+
+    def fooDBId(self, compound_id: int) -> Optional[str]:
+        key = self.foodb_ids.get(compound_id)
+        return f"FDB{key:06d}" if isinstance(key, int) else key
+
+    def _stripe(self, kind: str, key) -> asyncio.Lock:
+        loop = asyncio.get_running_loop()
+        if self.loop is not loop:
+            self.locks = {stripes: [asyncio.Lock() for _ in range(self.LOCK_STRIPES)] for stripes in ("name", "foodb")}
+            self.loop = loop
+        return self.locks[kind][hash(key) % self.LOCK_STRIPES]
+
+    def lock(self, name: str) -> asyncio.Lock:
+        # Serializes the resolve-then-insert of records that share a name
+        return self._stripe("name", name)
+
+    def fooDBLock(self, foodb_id: str) -> asyncio.Lock:
+        # Serializes fetching a FooDB compound the index lacks, for records with different names but the
+        # same foodb_id. Only ever taken inside lock(), and from stripes of its own, so the two cannot deadlock
+        return self._stripe("foodb", _key(foodb_id))
+
+compound_index = CompoundIndex()
@@ -0,0 +1,92 @@
+import hashlib
+import json
+from psycopg.types.json import Jsonb
+from psycopg_pool import AsyncConnectionPool
+from typing import Dict, Optional, Set, Tuple
+import settings
+
+from logger import logger
+
+def hashPart(value) -> str:
+    return hashlib.sha256(json.dumps(value, sort_keys=True, default=str).encode()).hexdigest()[:32]
+
+def fooDBParts(record: Dict) -> Dict[str, str]:
+    return {
+        "compound": hashPart([record["name"], record["class"]]),
+        "foods": hashPart(record["foods"]),
+    }
+
+def hmdbParts(record: Dict) -> Dict[str, str]:
+    return {
+        "compound": hashPart([record["name"], record["foodb_id"]]),
+        "biospecimens": hashPart(record["biospecimens"]),
+        "concentrations": hashPart([record["concentrations"], record["abconcentrations"]]),
+    }
+
+class HashStore:
+    def __init__(self, pool: AsyncConnectionPool, source: str):
+        self.pool = pool
+        self.source = source
+        self.hashes: Dict[str, Tuple[int, Dict[str, str]]] = {}
+        self.staged: Dict[str, Tuple[int, Dict[str, str]]] = {}
+        self.updates: Dict[str, Tuple[int, Dict[str, str]]] = {}
+        self.stats = {"new": 0, "changed": 0, "unchanged": 0}
+
+    async def load(self):
+        hash_select = """
+            SELECT key, compound_id, parts FROM compound_hash
+            WHERE source = %s
+        """
+        async with self.pool.connection() as conn:
+            async for key, compound_id, parts in await conn.execute(hash_select, (self.source,)):
+                self.hashes[key] = (compound_id, parts)
+        logger.info(f" Loaded {len(self.hashes)} {self.source} content hashes")
+
+    def compoundId(self, key: str) -> Optional[int]:
+        return self.hashes[key][0] if key in self.hashes else None
+
+    def changed(self, key: str, parts: Dict[str, str]) -> Optional[Set[str]]:
+        # None for a compound we have no hash for, otherwise the names of the parts that differ
+        if key not in self.hashes:
+            self.stats["new"] += 1
+            return None
+        stored = self.hashes[key][1]
+        changed = {part for part, digest in parts.items() if stored.get(part) != digest}
+        self.stats["changed" if changed else "unchanged"] += 1
+        return changed
+
+    def stage(self, compound_id: int, key: str, parts: Dict[str, str]):
+        self.staged[key] = (compound_id, parts)
+
+    def confirm(self, key: str):
+        # Called once the compound's rows are committed, so a stored hash always matches the database
+        if key in self.staged:
+            self.updates[key] = self.hashes[key] = self.staged.pop(key)
+
+    def drop(self, key: str):
+        self.staged.pop(key, None)
+
+    async def flushIfFull(self):
+        if len(self.updates) >= settings.LEDGER_FLUSH_SIZE:
+            await self.flush()
+
+    async def flush(self):
+        if not self.updates:
+            return
+        hash_upsert = """
+            INSERT INTO compound_hash (source, key, compound_id, parts, updated_at)
+            VALUES (%s, %s, %s, %s, now())
+            ON CONFLICT (source, key) DO UPDATE SET
+                compound_id = EXCLUDED.compound_id,
+                parts = EXCLUDED.parts,
+                updated_at = EXCLUDED.updated_at
+        """
+        updates = self.updates
+        self.updates = {}
+        rows = [(self.source, key, compound_id, Jsonb(parts)) for key, (compound_id, parts) in updates.items()]
+        async with self.pool.connection() as conn, conn.cursor() as cur:
+            await cur.executemany(hash_upsert, rows)
+
+    def logStats(self):
+        logger.info(f" {self.source} refresh: {self.stats['new']} new, {self.stats['changed']} changed, "
+                    f"{self.stats['unchanged']} unchanged compounds")
@@ -1,40 +1,165 @@
 import os
-import pandas as pd
-from sqlalchemy import create_engine, Engine
+import re
+import argparse
+import datetime
+import hashlib
+from concurrent.futures import ThreadPoolExecutor
+from sqlalchemy import create_engine, Engine, Connection, TextClause, text
 import json
 from dotenv import load_dotenv
+from typing import Dict, Iterator, List, Tuple
+import settings
+from logger import logger
+
+try:
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+except ImportError:
+        pa = None
 
 load_dotenv()
 
-def get_engine() -> Engine:
+EXPORT_FORMATS = ("json", "ndjson", "parquet")
+
+def get_engine(pool_size: int = 5) -> Engine:
         user = os.getenv('PSQL_USERNAME')
         password = os.getenv('PSQL_PASSWORD')
         host = os.getenv('PSQL_HOST')
         database = os.getenv('PSQL_DATABASE')
 
-        engine = create_engine(f"postgresql+psycopg://{user}:{password}@{host}/{database}")
-        
+        engine = create_engine(f"postgresql+psycopg://{user}:{password}@{host}/{database}", pool_size=pool_size)
+
         return engine
 
-def export_to_json(engine: Engine):
-        
-        select_query = "SELECT reference.id, compound.name, COALESCE(compound.hmdb_id, '') AS hmdb_id, COALESCE(compound.foodb_id, '') AS foodb_id, value, units, age, COALESCE(sex, '') AS sex, COALESCE(condition, '') AS condition, COALESCE(comment, '') AS comment, COALESCE(reference.reference_text, '') AS reference_text, COALESCE(reference.pubmed_id, '') AS pubmed_id FROM compound_biospecimens AS cbs \
+# Concentrations of the compounds found in one biospecimen
+BIOSPECIMEN_QUERY = "SELECT reference.id, TRIM(compound.name) AS name, COALESCE(TRIM(compound.hmdb_id), '') AS hmdb_id, COALESCE(TRIM(compound.foodb_id), '') AS foodb_id, \
+        TRIM(value) AS value, TRIM(units) AS units, TRIM(age) AS age, COALESCE(TRIM(sex), '') AS sex, COALESCE(TRIM(condition), '') AS condition, COALESCE(TRIM(comment), '') AS comment, \
+        COALESCE(TRIM(reference.reference_text), '') AS reference_text, COALESCE(TRIM(reference.pubmed_id), '') AS pubmed_id FROM compound_biospecimens AS cbs \
         LEFT JOIN compound ON compound_id=compound.id \
-        LEFT JOIN concentration ON concentration.compound_id=compound.id \
+        LEFT JOIN concentration ON concentration.compound_id=compound.id AND concentration.biospecimen_id=cbs.biospecimen_id \
         LEFT JOIN reference ON concentration.id=reference.concentration_id \
-        WHERE cbs.biospecimen_id = 1"
+        WHERE cbs.biospecimen_id = {biospecimen}"
 
-        df = pd.read_sql_query(select_query, con=engine)
-        df = df.apply(lambda x: x.str.strip() if x.dtype == object else x)
-        result = df.to_json(orient="records")
-        parsed = json.loads(result)
-        with open("json.json", "w") as f:
-                json.dump(parsed, f, indent=4)
+# Compound contents of every food in one food category
+FOOD_CATEGORY_QUERY = "SELECT TRIM(compound.name) AS name, COALESCE(TRIM(compound.hmdb_id), '') AS hmdb_id, COALESCE(TRIM(compound.foodb_id), '') AS foodb_id, \
+        TRIM(food.name) AS food, fc.average_value, fc.max_value, fc.min_value FROM food_compounds AS fc \
+        JOIN food ON fc.food_id=food.id \
+        JOIN food_category ON food.category_id=food_category.id \
+        JOIN compound ON fc.compound_id=compound.id \
+        WHERE food_category.name = :name \
+        ORDER BY compound.id, food.id"
 
-def main():
-        engine = get_engine()
+PARTITIONS = {
+        "biospecimen": text(BIOSPECIMEN_QUERY.format(biospecimen="(SELECT id FROM biospecimen WHERE name = :name)")),
+        "food_category": text(FOOD_CATEGORY_QUERY),
+}
+
+def iter_rows(conn: Connection, query: TextClause, params: Dict) -> Tuple[List[str], Iterator[List[Dict]]]:
+        # Strings are trimmed by Postgres and rows come from a server-side cursor in chunks, so memory
+        # use does not grow with the size of the result
+        result = conn.execution_options(stream_results=True, yield_per=settings.EXPORT_CHUNK_SIZE).execute(query, params)
+        return list(result.keys()), ([dict(row) for row in partition] for partition in result.mappings().partitions())
+
+def write_json(columns: List[str], chunks: Iterator[List[Dict]], path: str) -> int:
+        count = 0
+        with open(path, "w") as f:
+                f.write("[")
+                for chunk in chunks:
+                        for row in chunk:
+                                f.write(("," if count else "") + json.dumps(row, separators=(",", ":")))
+                                count += 1
+                f.write("]")
+        return count
+
+def write_ndjson(columns: List[str], chunks: Iterator[List[Dict]], path: str) -> int:
+        count = 0
+        with open(path, "w") as f:
+                for chunk in chunks:
+                        f.writelines(json.dumps(row, separators=(",", ":")) + "\n" for row in chunk)
+                        count += len(chunk)
+        return count
+
+def write_parquet(columns: List[str], chunks: Iterator[List[Dict]], path: str) -> int:
+        if pa is None:
+                raise RuntimeError("Parquet export needs pyarrow (pip install pyarrow)")
+        types = {"id": pa.int32(), "average_value": pa.float32(), "max_value": pa.float32(), "min_value": pa.float32()}
+        schema = pa.schema([(column, types.get(column, pa.string())) for column in columns])
+        count = 0
+        with pq.ParquetWriter(path, schema) as writer:
+                # One row group per fetched chunk
+                for chunk in chunks:
+                        writer.write_table(pa.Table.from_pylist(chunk, schema=schema))
+                        count += len(chunk)
+        return count
+
+WRITERS = {
+        "json": write_json,
+        "ndjson": write_ndjson,
+        "parquet": write_parquet,
+}
+
+def export_to_json(conn: Connection, path: str = "json.json", export_format: str = "json", biospecimen_id: int = 1) -> int:
+        columns, chunks = iter_rows(conn, text(BIOSPECIMEN_QUERY.format(biospecimen=":biospecimen_id")), {"biospecimen_id": biospecimen_id})
+        return WRITERS[export_format](columns, chunks, path)
+
+def sha256(path: str) -> str:
+        digest = hashlib.sha256()
+        with open(path, "rb") as f:
+                for block in iter(lambda: f.read(1024 ** 2), b""):
+                        digest.update(block)
+        return digest.hexdigest()
+
+def partition_names(engine: Engine, kind: str, names: List[str]) -> List[str]:
+        # "all" expands to every row of the partition's table
+        if names != ["all"]:
+                return names
+        with engine.connect() as conn:
+                return [row[0] for row in conn.execute(text(f"SELECT name FROM {kind} ORDER BY id"))]
+
+def export_partition(engine: Engine, kind: str, name: str, directory: str, export_format: str) -> Dict:
+        file = f"{kind}-{re.sub(r'[^A-Za-z0-9]+', '_', name).strip('_').lower()}.{export_format}"
+        path = os.path.join(directory, file)
         with engine.connect() as conn, conn.begin():
-                export_to_json(conn)
-                
+                columns, chunks = iter_rows(conn, PARTITIONS[kind], {"name": name})
+                rows = WRITERS[export_format](columns, chunks, path)
+        logger.info(f" Exported {rows} rows for {kind} {name} to {path}")
+        return {"kind": kind, "name": name, "file": file, "format": export_format, "rows": rows, "sha256": sha256(path)}
+
+def export_partitions(engine: Engine, partitions: List[Tuple[str, str]], directory: str, export_format: str) -> List[Dict]:
+        # Each partition runs on its own pooled connection, so the whole set takes about as long as the largest one
+        os.makedirs(directory, exist_ok=True)
+        with ThreadPoolExecutor(max_workers=settings.EXPORT_CONCURRENCY) as executor:
+                files = list(executor.map(lambda partition: export_partition(engine, *partition, directory, export_format), partitions))
+        manifest = {
+                "created": datetime.datetime.now(datetime.timezone.utc).isoformat(),
+                "files": files,
+        }
+        with open(os.path.join(directory, "manifest.json"), "w") as f:
+                json.dump(manifest, f, indent=4)
+        return files
+
+def main():
+        parser = argparse.ArgumentParser(description="Export concentrations per biospecimen and compound contents per food category")
+        parser.add_argument("--format", choices=EXPORT_FORMATS, default="json")
+        parser.add_argument("--output", help="Output file, or the output directory when exporting partitions")
+        parser.add_argument("--biospecimen-id", type=int, default=1)
+        parser.add_argument("--biospecimen", action="append", default=[], help="Biospecimen name to export, repeatable, or all")
+        parser.add_argument("--food-category", action="append", default=[], help="Food category name to export, repeatable, or all")
+        args = parser.parse_args()
+
+        if not args.biospecimen and not args.food_category:
+                path = args.output or {"json": "json.json", "ndjson": "export.ndjson", "parquet": "export.parquet"}[args.format]
+                engine = get_engine()
+                with engine.connect() as conn, conn.begin():
+                        count = export_to_json(conn, path, args.format, args.biospecimen_id)
+                logger.info(f" Exported {count} rows to {path}")
+                return
+
+        engine = get_engine(pool_size=settings.EXPORT_CONCURRENCY)
+        partitions = [("biospecimen", name) for name in partition_names(engine, "biospecimen", args.biospecimen)]
+        partitions += [("food_category", name) for name in partition_names(engine, "food_category", args.food_category)]
+        files = export_partitions(engine, partitions, args.output or "export", args.format)
+        logger.info(f" Exported {sum(file['rows'] for file in files)} rows into {len(files)} files")
+
 if __name__ == "__main__":
-        main()
\ No newline at end of file
+        main()
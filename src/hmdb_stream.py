@@ -0,0 +1,137 @@
+import io
+from lxml import etree
+from typing import Dict, IO, Iterator, List, Optional, Tuple, Union
+
+from xpath_spec import Field, Rows, string, text
+from metrics import timed
+from logger import logger
+
+NULLS = ("Not Specified", "Not Quantified")
+
+# One concentration, read from its direct children. Repeated tags behave like the soup extractor's
+# dict assignment, where the last one wins.
+CONCENTRATION = {
+    "biospecimen": Field("biospecimen", nulls=NULLS, pick="last"),
+    "value": Field("concentration_value", nulls=NULLS, pick="last"),
+    "units": Field("concentration_units", nulls=NULLS, pick="last"),
+    "age": Field("subject_age|patient_age", nulls=NULLS, pick="last"),
+    "sex": Field("subject_sex|patient_sex", nulls=NULLS, pick="last"),
+    "condition": Field("subject_condition|patient_information", nulls=NULLS, pick="last"),
+    "comment": Field("comment", nulls=NULLS, pick="last"),
+    "references": Rows("references[last()]", "reference", {
+        "reference_text": Field("reference_text", value=text, nulls=None, pick="last"),
+        "pubmed_id": Field("pubmed_id", value=text, nulls=None, pick="last"),
+    }),
+}
+CONCENTRATIONS = Rows(None, "concentration", CONCENTRATION)
+BIOSPECIMENS = Field(".//biospecimen", value=text, nulls=None, pick="all")
+
+def _localName(el) -> str:
+    tag = el.tag
+    if not isinstance(tag, str):
+        return ""
+    return tag.rsplit("}", 1)[-1]
+
+def _name(el) -> str:
+    if el is None or not string(el):
+        logger.warning(" No name")
+        return ""
+    return string(el)
+
+@timed("extract.hmdb_stream")
+def _biospecimens(el) -> Optional[List[str]]:
+    if el is None:
+        logger.warning(" No biospecimen locations")
+        return
+    return BIOSPECIMENS.select(el)
+
+@timed("extract.hmdb_stream")
+def _concentrations(el, normal: bool) -> Optional[List[Dict]]:
+    if el is None:
+        logger.warning(f" {'Normal Concentrations' if normal else 'Abnormal Concentrations'} missing")
+        return
+    rows = CONCENTRATIONS.select(el)
+    if not rows:
+        logger.warning(f" {'Abnormal' if not normal else ''} Concentrations missing")
+        return
+
+    concentrations = []
+    for concentration in rows:
+        # A concentration without a value is dropped, a tag that is there but empty only gets a warning
+        if "value" in concentration and concentration["value"] is None:
+            continue
+        concentrations.append(concentration)
+        unquantified_values = [name for name, value in concentration.items() if value is None and name not in ("age", "sex")]
+        if unquantified_values:
+            logger.warning(f" {','.join(unquantified_values)} is not specified/quantified")
+    return concentrations
+
+EXTRACTORS = {
+    "accession": lambda el: string(el) if el is not None else None,
+    "name": _name,
+    "foodb_id": lambda el: (string(el) or None) if el is not None else None,
+    "biospecimen_locations": _biospecimens,
+    "normal_concentrations": lambda el: _concentrations(el, True),
+    "abnormal_concentrations": lambda el: _concentrations(el, False),
+}
+
+def _buildRecord(values: Dict) -> Tuple[Optional[str], Dict]:
+    for tag, extract in EXTRACTORS.items():
+        if tag not in values:
+            values[tag] = extract(None)
+    return values["accession"], {
+        "name": values["name"],
+        "foodb_id": values["foodb_id"],
+        "biospecimens": values["biospecimen_locations"],
+        "concentrations": values["normal_concentrations"],
+        "abconcentrations": values["abnormal_concentrations"],
+    }
+
+# Large sections of a metabolite entry that are never read. Their subtrees are freed as soon as they end.
+DISCARDED_SECTIONS = (
+    "secondary_accessions", "synonyms", "taxonomy", "ontology", "experimental_properties",
+    "predicted_properties", "spectra", "diseases", "general_references", "protein_associations",
+)
+
+def iterHMDBRecords(source: Union[str, IO[bytes]]) -> Iterator[Tuple[Optional[str], Dict]]:
+    # Yields (accession, record) for every <metabolite>, whether the source is a single metabolite
+    # document or the whole hmdb_metabolites.xml dump. Like soup.find, only the first occurrence of
+    # each wanted tag counts. Events are only raised for the tags we care about, so libxml2 skips
+    # over everything else without calling back into Python.
+    tags = [f"{{*}}{tag}" for tag in ("metabolite", *EXTRACTORS, *DISCARDED_SECTIONS)]
+    metabolite = None
+    claimed: Dict[str, etree._Element] = {}
+    values: Dict = {}
+
+    for event, el in etree.iterparse(source, events=("start", "end"), tag=tags, remove_comments=True, huge_tree=True):
+        name = _localName(el)
+        if event == "start":
+            if name == "metabolite" and metabolite is None:
+                metabolite = el
+                claimed = {}
+                values = {}
+            elif metabolite is not None and name in EXTRACTORS and name not in claimed:
+                claimed[name] = el
+            continue
+
+        if metabolite is None:
+            continue
+        if el is metabolite:
+            yield _buildRecord(values)
+            metabolite = None
+        elif claimed.get(name) is el:
+            values[name] = EXTRACTORS[name](el)
+        elif name not in DISCARDED_SECTIONS or len(values) != len(claimed):
+            continue
+
+        el.clear()
+        parent = el.getparent()
+        if parent is not None:
+            while el.getprevious() is not None:
+                del parent[0]
+
+@timed("extract.hmdb_stream")
+def extractHMDBRecordStreaming(page_text: str) -> Dict:
+    for _, record in iterHMDBRecords(io.BytesIO(page_text.encode())):
+        return record
+    raise ValueError("No metabolite in document")
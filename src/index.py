@@ -1,34 +1,56 @@
 
+import argparse
 import os
-import psycopg
 import json
 
 from dotenv import load_dotenv
 from HMDB import crawlHMDB
 from FooDB import crawlFooDB
 from utility import populate_databases
+from sql import createPool
+from client import createSession, logConnectionStats
+from cache import logCacheStats
+from ratelimit import logRateStats
+from pipeline import shutdownParseExecutor
+from ledger import CrawlLedger
+import metrics
 from logger import logger
 import asyncio
 
 repopulate_foodmap = False
+incremental_refresh = False
+fresh_crawl = False
 
 async def main():
     
     load_dotenv()
     
-    async with await psycopg.AsyncConnection.connect(dbname = os.getenv('PSQL_DATABASE'), 
-                        user = os.getenv('PSQL_USERNAME'), 
-                        host= os.getenv('PSQL_HOST'),
-                        password = os.getenv('PSQL_PASSWORD'),
-                        port = 5432) as conn:
+    async with createPool() as pool, createSession() as session, metrics.reporting():
         
+        async with pool.connection() as conn:
+            await populate_databases(conn, session, repopulate_foodmap)
         
-        populate_databases(conn, repopulate_foodmap)
+        # A finished crawl leaves every page written in the ledger, so later runs only crawl again after a reset
+        if fresh_crawl:
+            for source in ("FooDB", "HMDB"):
+                await CrawlLedger(pool, source).reset()
         
-        await crawlFooDB(conn)
-        await logger.info(" Finished crawling FooDB. Crawling HMDB")
-        await crawlHMDB(conn)
+        await crawlFooDB(pool, session, incremental_refresh)
+        logger.info(" Finished crawling FooDB. Crawling HMDB")
+        await crawlHMDB(pool, session, incremental_refresh)
+        shutdownParseExecutor()
+        logConnectionStats()
+        logRateStats()
+        logCacheStats()
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Crawl FooDB and HMDB into the database")
+    parser.add_argument("--repopulate-foodmap", action="store_true", help="Fetch the food catalog again before crawling")
+    parser.add_argument("--refresh", action="store_true", help="Crawl every page again, revalidating cached pages, and keep only changed records")
+    parser.add_argument("--fresh", action="store_true", help="Forget earlier crawls and start from the first page")
+    args = parser.parse_args()
+    repopulate_foodmap = repopulate_foodmap or args.repopulate_foodmap
+    incremental_refresh = incremental_refresh or args.refresh
+    fresh_crawl = fresh_crawl or args.fresh
     asyncio.run(main())
     
\ No newline at end of file
@@ -0,0 +1,89 @@
+from psycopg_pool import AsyncConnectionPool
+from typing import Dict, List, Optional, Set, Tuple
+import settings
+
+from logger import logger
+
+PENDING = "pending"
+FETCHED = "fetched"
+PARSED = "parsed"
+WRITTEN = "written"
+FAILED = "failed"
+
+class CrawlLedger:
+    def __init__(self, pool: AsyncConnectionPool, source: str):
+        self.pool = pool
+        self.source = source
+        self.status: Dict[Tuple[str, str], str] = {}
+        self.attempts: Dict[Tuple[str, str], int] = {}
+        self.resumed: Set[Tuple[str, str]] = set()
+        self.updates: Dict[Tuple[str, str], Tuple[str, Optional[str], int]] = {}
+
+    async def load(self):
+        ledger_select = """
+            SELECT kind, key, status, attempts FROM crawl_ledger
+            WHERE source = %s
+        """
+        async with self.pool.connection() as conn:
+            async for kind, key, status, attempts in await conn.execute(ledger_select, (self.source,)):
+                self.status[(kind, key)] = status
+                self.attempts[(kind, key)] = attempts
+                if status != WRITTEN:
+                    self.resumed.add((kind, key))
+        done = sum(1 for status in self.status.values() if status == WRITTEN)
+        logger.info(f" Loaded {self.source} crawl ledger: {len(self.status)} entries, {done} written")
+
+    def isDone(self, kind: str, key: str) -> bool:
+        return self.status.get((kind, key)) == WRITTEN
+
+    def isRetry(self, kind: str, key: str) -> bool:
+        # Left unfinished by an earlier run, so some of its rows may already be in the database
+        return (kind, key) in self.resumed
+
+    def unfinished(self, kind: str) -> List[str]:
+        return [
+            key for (entry_kind, key), status in self.status.items()
+            if entry_kind == kind and status != WRITTEN
+            and self.attempts.get((kind, key), 0) < settings.LEDGER_MAX_ATTEMPTS
+        ]
+
+    def mark(self, kind: str, key: str, status: str, error: Optional[str] = None):
+        entry = (kind, key)
+        self.status[entry] = status
+        attempts = 1 if status == FAILED else 0
+        if entry in self.updates:
+            attempts += self.updates[entry][2]
+        self.updates[entry] = (status, error, attempts)
+
+    async def flushIfFull(self):
+        if len(self.updates) >= settings.LEDGER_FLUSH_SIZE:
+            await self.flush()
+
+    async def flush(self):
+        if not self.updates:
+            return
+        ledger_upsert = """
+            INSERT INTO crawl_ledger (source, kind, key, status, error, attempts, updated_at)
+            VALUES (%s, %s, %s, %s, %s, %s, now())
+            ON CONFLICT (source, kind, key) DO UPDATE SET
+                status = EXCLUDED.status,
+                error = EXCLUDED.error,
+                attempts = crawl_ledger.attempts + EXCLUDED.attempts,
+                updated_at = EXCLUDED.updated_at
+        """
+        updates = self.updates
+        self.updates = {}
+        rows = [(self.source, kind, key, status, error, attempts) for (kind, key), (status, error, attempts) in updates.items()]
+        async with self.pool.connection() as conn, conn.cursor() as cur:
+            await cur.executemany(ledger_upsert, rows)
+        for (kind, key), (_, _, attempts) in updates.items():
+            self.attempts[(kind, key)] = self.attempts.get((kind, key), 0) + attempts
+
+    async def reset(self):
+        async with self.pool.connection() as conn:
+            await conn.execute("DELETE FROM crawl_ledger WHERE source = %s", (self.source,))
+        self.status.clear()
+        self.attempts.clear()
+        self.resumed.clear()
+        self.updates.clear()
+        logger.info(f" Cleared the {self.source} crawl ledger")
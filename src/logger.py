@@ -1,20 +1,40 @@
 from logging import Logger
+from logging.handlers import QueueHandler, QueueListener
+import atexit
 import os
+import queue
 import logging
 logger: Logger = None
 
 
 def createLogger(base_dir: str, log: str, error_log: str) -> Logger:
-    
+
     os.makedirs(base_dir, exist_ok=True)
 
     logger = logging.getLogger(__name__)
-    logging.basicConfig(filename=f'{base_dir}/{log}', level=logging.INFO)
 
+    file_handler = logging.FileHandler(f"{base_dir}/{log}")
+    file_handler.setFormatter(logging.Formatter(logging.BASIC_FORMAT))
     error_handler = logging.FileHandler(f"{base_dir}/{error_log}")
     error_handler.setLevel(logging.ERROR)
 
-    logger.addHandler(error_handler)
+    # Callers only enqueue the record, the file writes happen on the listener's thread
+    log_queue = queue.SimpleQueue()
+    queue_handler = QueueHandler(log_queue)
+    listener = QueueListener(log_queue, file_handler, error_handler, respect_handler_level=True)
+    listener.start()
+    atexit.register(listener.stop)
+
+    root = logging.getLogger()
+    root.setLevel(logging.INFO)
+    root.addHandler(queue_handler)
+
+    def afterFork():
+        # A forked parse worker has no listener thread, so it writes to the files itself
+        root.removeHandler(queue_handler)
+        root.addHandler(file_handler)
+        root.addHandler(error_handler)
+    os.register_at_fork(after_in_child=afterFork)
     return logger
 
 logger = createLogger("logs", "hmdb.log", "hmdb-error.log")
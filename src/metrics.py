@@ -0,0 +1,175 @@
+import asyncio
+import functools
+import json
+import os
+import time
+from contextlib import asynccontextmanager, contextmanager
+from typing import Callable, Dict, Optional
+import settings
+
+from logger import logger
+
+QUANTILES = (0.5, 0.9, 0.99, 0.999)
+
+class Histogram:
+    # HDR-style log-linear buckets over microseconds: every power of two is split into 2**SUB_BUCKET_BITS
+    # linear buckets, so any latency keeps about 1.5% precision in a few hundred counters at most
+    SUB_BUCKET_BITS = 7
+
+    def __init__(self):
+        self.counts: Dict[int, int] = {}
+        self.count = 0
+        self.sum = 0.0
+        self.min: Optional[float] = None
+        self.max = 0.0
+
+    def record(self, seconds: float):
+        micros = max(1, int(seconds * 1e6))
+        shift = max(0, micros.bit_length() - self.SUB_BUCKET_BITS)
+        bucket = (shift << self.SUB_BUCKET_BITS) | (micros >> shift)
+        self.counts[bucket] = self.counts.get(bucket, 0) + 1
+        self.count += 1
+        self.sum += seconds
+        self.min = seconds if self.min is None else min(self.min, seconds)
+        self.max = max(self.max, seconds)
+
+    def merge(self, other: "Histogram"):
+        for bucket, count in other.counts.items():
+            self.counts[bucket] = self.counts.get(bucket, 0) + count
+        self.count += other.count
+        self.sum += other.sum
+        if other.min is not None:
+            self.min = other.min if self.min is None else min(self.min, other.min)
+        self.max = max(self.max, other.max)
+
+    def _upper(self, bucket: int) -> float:
+        # Highest value that lands in the bucket, in seconds
+        shift, sub = bucket >> self.SUB_BUCKET_BITS, bucket & ((1 << self.SUB_BUCKET_BITS) - 1)
+        return (((sub + 1) << shift) - 1) / 1e6
+
+    def quantile(self, q: float) -> float:
+        if not self.count:
+            return 0.0
+        rank = q * self.count
+        seen = 0
+        for bucket in sorted(self.counts):
+            seen += self.counts[bucket]
+            if seen >= rank:
+                return min(self._upper(bucket), self.max)
+        return self.max
+
+    def summary(self) -> Dict:
+        summary = {"count": self.count, "sum": self.sum, "min": self.min or 0.0, "max": self.max}
+        summary.update({f"p{q * 100:g}": self.quantile(q) for q in QUANTILES})
+        return summary
+
+histograms: Dict[str, Histogram] = {}
+counters: Dict[str, int] = {}
+
+def observe(stage: str, seconds: float):
+    histogram = histograms.get(stage)
+    if histogram is None:
+        histogram = histograms[stage] = Histogram()
+    histogram.record(seconds)
+
+def increment(name: str, amount: int = 1):
+    counters[name] = counters.get(name, 0) + amount
+
+@contextmanager
+def timer(stage: str):
+    # Wall time, so awaits inside the block count: a slow stage shows up whether it waits or computes
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe(stage, time.perf_counter() - start)
+
+def timed(prefix: str) -> Callable:
+    def decorate(function: Callable) -> Callable:
+        stage = f"{prefix}.{function.__name__}"
+        if asyncio.iscoroutinefunction(function):
+            @functools.wraps(function)
+            async def wrapper(*args, **kwargs):
+                with timer(stage):
+                    return await function(*args, **kwargs)
+        else:
+            @functools.wraps(function)
+            def wrapper(*args, **kwargs):
+                with timer(stage):
+                    return function(*args, **kwargs)
+        return wrapper
+    return decorate
+
+def collect() -> Dict[str, Histogram]:
+    # Hands over and resets what this process recorded, which is how parse workers report back
+    collected = dict(histograms)
+    histograms.clear()
+    return collected
+
+def merge(collected: Dict[str, Histogram]):
+    for stage, histogram in collected.items():
+        histograms.setdefault(stage, Histogram()).merge(histogram)
+
+def clear():
+    histograms.clear()
+    counters.clear()
+
+def toJSON() -> Dict:
+    return {
+        "time": time.time(),
+        "stages": {stage: histogram.summary() for stage, histogram in sorted(histograms.items())},
+        "counters": dict(sorted(counters.items())),
+    }
+
+def _label(value: str) -> str:
+    return value.replace("\\", "\\\\").replace('"', '\\"')
+
+def toPrometheus() -> str:
+    lines = ["# TYPE crawler_stage_seconds summary"]
+    for stage, histogram in sorted(histograms.items()):
+        label = f'stage="{_label(stage)}"'
+        for q in QUANTILES:
+            lines.append(f'crawler_stage_seconds{{{label},quantile="{q:g}"}} {histogram.quantile(q):.6f}')
+        lines.append(f"crawler_stage_seconds_sum{{{label}}} {histogram.sum:.6f}")
+        lines.append(f"crawler_stage_seconds_count{{{label}}} {histogram.count}")
+    lines.append("# TYPE crawler_events_total counter")
+    for name, value in sorted(counters.items()):
+        lines.append(f'crawler_events_total{{name="{_label(name)}"}} {value}')
+    return "\n".join(lines) + "\n"
+
+def _writeAtomic(path: str, text: str):
+    with open(path + ".tmp", "w") as file:
+        file.write(text)
+    os.replace(path + ".tmp", path)
+
+def dump(directory: Optional[str] = None):
+    directory = directory or settings.METRICS_DIR
+    os.makedirs(directory, exist_ok=True)
+    _writeAtomic(os.path.join(directory, "metrics.json"), json.dumps(toJSON(), indent=2))
+    _writeAtomic(os.path.join(directory, "metrics.prom"), toPrometheus())
+
+def logStats():
+    for stage, histogram in sorted(histograms.items()):
+        summary = histogram.summary()
+        logger.info(f" {stage}: {summary['count']} calls, {summary['sum']:.1f}s total, p50 {summary['p50'] * 1000:.1f}ms, "
+                    f"p99 {summary['p99'] * 1000:.1f}ms, max {summary['max'] * 1000:.1f}ms")
+
+@asynccontextmanager
+async def reporting(interval: float = settings.METRICS_INTERVAL):
+    # Dumps every interval seconds while the block runs and once more at the end
+    async def dumpPeriodically():
+        while True:
+            await asyncio.sleep(interval)
+            dump()
+
+    task = asyncio.create_task(dumpPeriodically())
+    try:
+        yield
+    finally:
+        task.cancel()
+        try:
+            await task
+        except asyncio.CancelledError:
+            pass
+        dump()
+        logStats()
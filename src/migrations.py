@@ -0,0 +1,302 @@
+from contextlib import asynccontextmanager
+from psycopg import AsyncConnection, AsyncCursor, errors
+from psycopg_pool import AsyncConnectionPool
+from typing import Awaitable, Callable, List, Tuple, Union
+from units import normalizeConcentration
+
+from logger import logger
+
+DATABASES = {
+    "food_category":
+        """
+        CREATE TABLE IF NOT EXISTS food_category (
+        id SERIAL PRIMARY KEY,
+        name VARCHAR(50) NOT NULL UNIQUE
+        )
+        """,
+    "food":
+        """
+        CREATE TABLE IF NOT EXISTS food (
+        id SERIAL PRIMARY KEY,
+        category_id INT,
+        name VARCHAR(50) NOT NULL UNIQUE,
+        CONSTRAINT fk_category_id FOREIGN KEY (category_id)
+            REFERENCES food_category (id)
+            ON DELETE SET NULL
+        )
+        """,
+    "compound_class":
+        """
+        CREATE TABLE IF NOT EXISTS compound_class (
+        id SERIAL PRIMARY KEY,
+        name VARCHAR(50) NOT NULL UNIQUE
+        )
+        """,
+    "compound": 
+        """
+        CREATE TABLE IF NOT EXISTS compound (
+        id SERIAL PRIMARY KEY,
+        class_id INT,
+        name VARCHAR(100) NOT NULL UNIQUE,
+        hmdb_id CHAR(11) UNIQUE,
+        foodb_id CHAR(9) UNIQUE,
+        CONSTRAINT fk_class_id FOREIGN KEY (class_id)
+            REFERENCES compound_class (id)
+            ON DELETE CASCADE
+        )
+        """,
+    "food_compounds": 
+        """
+        CREATE TABLE IF NOT EXISTS food_compounds (
+        compound_id INT NOT NULL,
+        food_id INT NOT NULL,
+        average_value REAL,
+        max_value REAL,
+        min_value REAL,
+        PRIMARY KEY(compound_id, food_id),
+        CONSTRAINT fk_compound_id FOREIGN KEY (compound_id)
+            REFERENCES compound (id)
+            ON DELETE CASCADE,
+        CONSTRAINT fk_food_id FOREIGN KEY (food_id)
+            REFERENCES food (id)
+            ON DELETE CASCADE
+        )
+        """,
+    "biospecimen": 
+        """
+        CREATE TABLE IF NOT EXISTS biospecimen (
+        id SERIAL PRIMARY KEY,
+        name VARCHAR(50) NOT NULL UNIQUE
+        )
+        """,
+    "compound_biospecimens": 
+        """
+        CREATE TABLE IF NOT EXISTS compound_biospecimens (
+        compound_id INT NOT NULL,
+        biospecimen_id INT NOT NULL,
+        PRIMARY KEY(compound_id, biospecimen_id),
+        CONSTRAINT fk_compound_id FOREIGN KEY (compound_id)
+            REFERENCES compound (id)
+            ON DELETE CASCADE,
+        CONSTRAINT fk_biospecimen_id FOREIGN KEY (biospecimen_id)
+            REFERENCES biospecimen (id)
+            ON DELETE CASCADE
+        )
+        """,
+    "concentration": 
+        """
+        CREATE TABLE IF NOT EXISTS concentration (
+        id SERIAL PRIMARY KEY,
+        compound_id INT NOT NULL,
+        biospecimen_id INT NOT NULL,
+        value CHAR(50) NOT NULL,
+        units CHAR(35) NOT NULL,
+        age CHAR(35),
+        sex CHAR(15),
+        condition TEXT,
+        comment TEXT,
+        CONSTRAINT fk_compound_id FOREIGN KEY (compound_id)
+            REFERENCES compound (id)
+            ON DELETE CASCADE,
+        CONSTRAINT fk_biospecimen_id FOREIGN KEY (biospecimen_id)
+            REFERENCES biospecimen (id)
+            ON DELETE CASCADE
+        )
+        """,
+    "reference": 
+        """
+        CREATE TABLE IF NOT EXISTS reference (
+        id SERIAL PRIMARY KEY,
+        concentration_id INT NOT NULL,
+        reference_text TEXT,
+        pubmed_id CHAR(10),
+        CONSTRAINT fk_concentration_id FOREIGN KEY (concentration_id)
+            REFERENCES concentration (id)
+            ON DELETE CASCADE
+        )
+        """,
+    "crawl_ledger":
+        """
+        CREATE TABLE IF NOT EXISTS crawl_ledger (
+        source VARCHAR(10) NOT NULL,
+        kind VARCHAR(10) NOT NULL,
+        key VARCHAR(20) NOT NULL,
+        status VARCHAR(10) NOT NULL,
+        attempts INT NOT NULL DEFAULT 0,
+        error TEXT,
+        updated_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+        PRIMARY KEY(source, kind, key)
+        )
+        """,
+    "compound_hash":
+        """
+        CREATE TABLE IF NOT EXISTS compound_hash (
+        source VARCHAR(10) NOT NULL,
+        key VARCHAR(20) NOT NULL,
+        compound_id INT NOT NULL,
+        parts JSONB NOT NULL,
+        updated_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+        PRIMARY KEY(source, key),
+        CONSTRAINT fk_compound_id FOREIGN KEY (compound_id)
+            REFERENCES compound (id)
+            ON DELETE CASCADE
+        )
+        """,
+}
+
+# Secondary indexes for the foreign key columns the exports join on and the cascades filter by.
+# Bulk loaders drop them first and build them once the data is in (see deferredIndexes).
+INDEXES = {
+    "concentration_compound_id_idx": "CREATE INDEX IF NOT EXISTS concentration_compound_id_idx ON concentration (compound_id)",
+    "concentration_biospecimen_id_idx": "CREATE INDEX IF NOT EXISTS concentration_biospecimen_id_idx ON concentration (biospecimen_id)",
+    "reference_concentration_id_idx": "CREATE INDEX IF NOT EXISTS reference_concentration_id_idx ON reference (concentration_id)",
+    "compound_biospecimens_biospecimen_id_idx": "CREATE INDEX IF NOT EXISTS compound_biospecimens_biospecimen_id_idx ON compound_biospecimens (biospecimen_id)",
+    "food_compounds_food_id_idx": "CREATE INDEX IF NOT EXISTS food_compounds_food_id_idx ON food_compounds (food_id)",
+    # Range scans such as compounds above some uM in blood
+    "concentration_value_idx": "CREATE INDEX IF NOT EXISTS concentration_value_idx ON concentration (biospecimen_id, normalized_units, value_mean)",
+}
+
+# Work shared by the workers of a sharded crawl (see work_queue.py). Not part of DATABASES, as
+# snapshots and exports have no use for it.
+CRAWL_QUEUE = """
+    CREATE TABLE IF NOT EXISTS crawl_queue (
+    source VARCHAR(10) NOT NULL,
+    kind VARCHAR(10) NOT NULL,
+    key VARCHAR(20) NOT NULL,
+    status VARCHAR(10) NOT NULL,
+    attempts INT NOT NULL DEFAULT 0,
+    claimed_by TEXT,
+    claimed_at TIMESTAMPTZ,
+    error TEXT,
+    PRIMARY KEY(source, kind, key)
+    )
+"""
+
+SCHEMA_VERSION_TABLE = """
+    CREATE TABLE IF NOT EXISTS schema_version (
+    version INT PRIMARY KEY,
+    name TEXT NOT NULL,
+    applied_at TIMESTAMPTZ NOT NULL DEFAULT now()
+    )
+"""
+
+# Arbitrary key for the advisory lock that serializes migrations between processes
+MIGRATION_LOCK = 7405186
+
+async def backfillConcentrations(cur: AsyncCursor):
+    # Parses the value and units text of rows written before the numeric columns existed, or loaded
+    # from a dump taken before then
+    await cur.execute("SELECT id, value, units FROM concentration WHERE normalized_units IS NULL")
+    rows = await cur.fetchall()
+    if not rows:
+        return
+    await cur.execute("""
+        CREATE TEMP TABLE concentration_values (
+        id INT PRIMARY KEY,
+        value_mean DOUBLE PRECISION,
+        value_low DOUBLE PRECISION,
+        value_high DOUBLE PRECISION,
+        value_sd DOUBLE PRECISION,
+        normalized_units VARCHAR(35)
+        ) ON COMMIT DROP
+    """)
+    async with cur.copy("COPY concentration_values FROM STDIN") as copy:
+        for id, value, units in rows:
+            await copy.write_row((id, *normalizeConcentration(value.strip(), units.strip()).values()))
+    await cur.execute("""
+        UPDATE concentration AS c SET value_mean = v.value_mean, value_low = v.value_low, value_high = v.value_high,
+            value_sd = v.value_sd, normalized_units = v.normalized_units
+        FROM concentration_values AS v WHERE c.id = v.id
+    """)
+    logger.info(f" Parsed {len(rows)} concentration values")
+
+Statement = Union[str, Callable[[AsyncCursor], Awaitable[None]]]
+
+# Applied in order, each exactly once. Statements must also be safe on databases created before
+# versioning existed, so they use IF NOT EXISTS and the like. Later migrations never edit earlier ones.
+MIGRATIONS: List[Tuple[int, str, List[Statement]]] = [
+    (1, "initial schema", list(DATABASES.values())),
+    (2, "foreign key column indexes", [INDEXES[name] for name in (
+        "concentration_compound_id_idx", "concentration_biospecimen_id_idx", "reference_concentration_id_idx",
+        "compound_biospecimens_biospecimen_id_idx", "food_compounds_food_id_idx",
+    )]),
+    (3, "compound_biospecimens.biospecimen_id not null", [
+        "ALTER TABLE compound_biospecimens ALTER COLUMN biospecimen_id SET NOT NULL",
+    ]),
+    (4, "numeric concentration values", [
+        """
+        ALTER TABLE concentration
+            ADD COLUMN IF NOT EXISTS value_mean DOUBLE PRECISION,
+            ADD COLUMN IF NOT EXISTS value_low DOUBLE PRECISION,
+            ADD COLUMN IF NOT EXISTS value_high DOUBLE PRECISION,
+            ADD COLUMN IF NOT EXISTS value_sd DOUBLE PRECISION,
+            ADD COLUMN IF NOT EXISTS normalized_units VARCHAR(35)
+        """,
+        backfillConcentrations,
+        INDEXES["concentration_value_idx"],
+    ]),
+    (5, "crawl work queue", [
+        CRAWL_QUEUE,
+        "CREATE INDEX IF NOT EXISTS crawl_queue_status_idx ON crawl_queue (source, status)",
+    ]),
+]
+
+async def schemaVersion(conn: AsyncConnection) -> int:
+    try:
+        cur = await conn.execute("SELECT max(version) FROM schema_version")
+        return (await cur.fetchone())[0] or 0
+    except errors.UndefinedTable:
+        await conn.rollback()
+        return 0
+
+async def migrate(conn: AsyncConnection) -> None:
+    # A database that is up to date costs one query
+    version = await schemaVersion(conn)
+    if version >= MIGRATIONS[-1][0]:
+        await conn.commit()
+        return
+    try:
+        async with conn.cursor() as cur:
+            # Workers starting together wait here and then find the migrations already applied
+            await cur.execute("SELECT pg_advisory_xact_lock(%s)", (MIGRATION_LOCK,))
+            await cur.execute(SCHEMA_VERSION_TABLE)
+            await cur.execute("SELECT coalesce(max(version), 0) FROM schema_version")
+            version = (await cur.fetchone())[0]
+            for number, name, statements in MIGRATIONS:
+                if number <= version:
+                    continue
+                logger.info(f" Applying migration {number}: {name}")
+                for statement in statements:
+                    if callable(statement):
+                        await statement(cur)
+                    else:
+                        await cur.execute(statement)
+                await cur.execute("INSERT INTO schema_version (version, name) VALUES (%s, %s)", (number, name))
+        await conn.commit()
+    except Exception:
+        await conn.rollback()
+        raise
+
+async def createIndexes(cur: AsyncCursor) -> None:
+    for create_command in INDEXES.values():
+        await cur.execute(create_command)
+
+async def dropIndexes(cur: AsyncCursor) -> None:
+    for index_name in INDEXES:
+        await cur.execute(f"DROP INDEX IF EXISTS {index_name}")
+
+@asynccontextmanager
+async def deferredIndexes(pool: AsyncConnectionPool):
+    # Loading into unindexed tables and building each index once at the end beats
+    # updating every index row by row
+    async with pool.connection() as conn, conn.cursor() as cur:
+        await dropIndexes(cur)
+    try:
+        yield
+    finally:
+        async with pool.connection() as conn, conn.cursor() as cur:
+            await createIndexes(cur)
+            await cur.execute(f"ANALYZE {', '.join(DATABASES)}")
+
+
+
@@ -0,0 +1,255 @@
+import argparse
+import asyncio
+import csv
+import random
+import re
+from aiohttp import web
+from typing import Dict, List, Optional, Tuple
+from xml.sax.saxutils import escape
+import settings
+
+from snapshot import COPY_HEADER
+
+# Serves FooDB and HMDB lookalike pages built from the repo's SQL dump and HMDB id list, under the
+# same paths and query strings as the real sites, so the crawlers can run without touching the network
+CATALOG_PAGE_SIZE = 25
+FOOD_PAGE_SIZE = 50
+BIOSPECIMENS = ("Blood", "Urine", "Saliva", "Cerebrospinal Fluid (CSF)")
+COPY_ESCAPES = {"t": "\t", "n": "\n", "r": "\r", "b": "\b", "f": "\f", "v": "\v", "\\": "\\"}
+
+def _unescape(field: str) -> Optional[str]:
+    if field == "\\N":
+        return None
+    return re.sub(r"\\(.)", lambda match: COPY_ESCAPES.get(match.group(1), match.group(1)), field)
+
+def readDump(path: str) -> Dict[str, List[Dict]]:
+    # Every COPY block of a plain pg_dump as a list of rows per table
+    tables: Dict[str, List[Dict]] = {}
+    rows: Optional[List[Dict]] = None
+    columns: List[str] = []
+    with open(path, encoding="utf-8") as dump:
+        for line in dump:
+            line = line.rstrip("\n")
+            if rows is None:
+                match = COPY_HEADER.match(line)
+                if match:
+                    columns = [column.strip().strip('"') for column in match.group(2).split(",")]
+                    rows = tables.setdefault(match.group(1), [])
+            elif line == "\\.":
+                rows = None
+            else:
+                rows.append(dict(zip(columns, map(_unescape, line.split("\t")))))
+    return tables
+
+def _concentration(rng: random.Random, biospecimen: str) -> Dict:
+    mean = round(rng.lognormvariate(1, 1.5), 2)
+    value = rng.choice([
+        f"{mean}",
+        f"{mean} +/- {round(mean * rng.uniform(0.05, 0.4), 2)}",
+        f"{round(mean * 0.5, 2)}-{round(mean * 1.5, 2)}",
+        "Not Quantified",
+    ])
+    return {
+        "biospecimen": biospecimen,
+        "value": value,
+        "units": "umol/mmol creatinine" if biospecimen == "Urine" else "uM",
+        "age": rng.choice(["Adult (>18 years old)", "Children (1-13 years old)", "Not Specified"]),
+        "sex": rng.choice(["Both", "Male", "Female"]),
+        "condition": rng.choice(["Normal", "Not Specified"]),
+        "references": [{"reference_text": f"Reference {rng.randrange(10 ** 6)}", "pubmed_id": str(rng.randrange(10 ** 7, 10 ** 8))}]
+            if rng.random() < 0.7 else [],
+    }
+
+class Fixtures:
+    def __init__(self, dump_path: str, hmdb_ids_path: str, limit: Optional[int] = None, seed: int = 0):
+        tables = readDump(dump_path)
+        classes = {row["id"]: row["name"] for row in tables.get("compound_class", [])}
+        categories = {row["id"]: row["name"] for row in tables.get("food_category", [])}
+        foods = {row["id"]: row["name"] for row in tables.get("food", [])}
+        self.food_rows = [(row["name"], categories.get(row["category_id"], "UNKNOWN")) for row in tables.get("food", [])]
+
+        contents: Dict[str, List[Tuple[str, str, str, str]]] = {}
+        for row in tables.get("food_compounds", []):
+            contents.setdefault(row["compound_id"], []).append(
+                (foods[row["food_id"]], row["average_value"], row["max_value"], row["min_value"]))
+
+        # Every compound is served, the catalog only lists the first limit of them
+        self.foodb: Dict[str, Dict] = {}
+        by_name: Dict[str, str] = {}
+        hmdb_names: Dict[str, str] = {}
+        for row in tables.get("compound", []):
+            if row["foodb_id"]:
+                self.foodb[row["foodb_id"]] = {
+                    "name": row["name"],
+                    "class": classes.get(row["class_id"]),
+                    "foods": contents.get(row["id"], []),
+                }
+                by_name.setdefault(row["name"], row["foodb_id"])
+            if row["hmdb_id"]:
+                hmdb_names[row["hmdb_id"]] = row["name"]
+        self.foodb_ids = list(self.foodb)[:limit]
+
+        with open(hmdb_ids_path, newline="") as file:
+            for row in csv.DictReader(file):
+                hmdb_names.setdefault(row["hmdb_id"], row["name"] or f"Metabolite {row['hmdb_id']}")
+
+        self.hmdb: Dict[str, Dict] = {}
+        for hmdb_id, name in hmdb_names.items():
+            # Seeded per id, so every run serves the same documents
+            rng = random.Random(f"{seed}:{hmdb_id}")
+            biospecimens = rng.sample(BIOSPECIMENS, rng.randint(1, 3))
+            self.hmdb[hmdb_id] = {
+                "name": name,
+                "foodb_id": by_name.get(name),
+                "biospecimens": biospecimens,
+                "concentrations": [_concentration(rng, rng.choice(biospecimens)) for _ in range(rng.randint(1, 4))],
+                "abconcentrations": [_concentration(rng, rng.choice(biospecimens)) for _ in range(rng.randint(0, 2))],
+            }
+        self.hmdb_ids = list(self.hmdb)
+
+    def pages(self, ids: List) -> int:
+        return max(1, -(-len(ids) // CATALOG_PAGE_SIZE))
+
+    def foodPages(self) -> int:
+        return max(1, -(-len(self.food_rows) // FOOD_PAGE_SIZE))
+
+def _page(ids: List, page_num: int, size: int) -> List:
+    return ids[(page_num - 1) * size:page_num * size]
+
+def foodCatalogPage(fixtures: Fixtures, page_num: int) -> str:
+    # Same cell layout as foodb.ca/foods: the food name in the second cell and its group in the fifth
+    rows = "".join(
+        f"<tr><td><a class='btn-show' href='#'>Show</a></td><td>{escape(name)}</td><td></td><td></td><td>{escape(category)}</td></tr>"
+        for name, category in _page(fixtures.food_rows, page_num, FOOD_PAGE_SIZE))
+    return f"<html><body><table><tbody>{rows}</tbody></table></body></html>"
+
+def fooDBCatalogPage(fixtures: Fixtures, page_num: int) -> str:
+    rows = "".join(f"<tr><td><a class='btn-show' href='/compounds/{id}'>{id}</a></td></tr>"
+                   for id in _page(fixtures.foodb_ids, page_num, CATALOG_PAGE_SIZE))
+    return f"<html><body><table><tbody>{rows}</tbody></table></body></html>"
+
+def fooDBCompoundXml(fixtures: Fixtures, id: str) -> Optional[str]:
+    compound = fixtures.foodb.get(id)
+    if compound is None:
+        return None
+    foods = "".join(
+        f"<food><name>{escape(name)}</name><average_value>{average or ''}</average_value>"
+        f"<max_value>{maximum or ''}</max_value><min_value>{minimum or ''}</min_value></food>"
+        for name, average, maximum, minimum in compound["foods"])
+    met_class = f"<class>{escape(compound['class'])}</class>" if compound["class"] else "<class/>"
+    return (f"<?xml version='1.0' encoding='UTF-8'?><compound><accession>{id}</accession>"
+            f"<name>{escape(compound['name'])}</name>{met_class}<foods>{foods}</foods></compound>")
+
+def hmdbCatalogPage(fixtures: Fixtures, page_num: int) -> str:
+    rows = "".join(f"<tr><td class='metabolite-link'><a href='/metabolites/{id}'>{id}</a></td></tr>"
+                   for id in _page(fixtures.hmdb_ids, page_num, CATALOG_PAGE_SIZE))
+    return f"<html><body><table><tbody>{rows}</tbody></table></body></html>"
+
+def _concentrationsXml(concentrations: List[Dict]) -> str:
+    xml = []
+    for conc in concentrations:
+        references = "".join(
+            f"<reference><reference_text>{escape(ref['reference_text'])}</reference_text><pubmed_id>{ref['pubmed_id']}</pubmed_id></reference>"
+            for ref in conc["references"])
+        xml.append(
+            f"<concentration><biospecimen>{escape(conc['biospecimen'])}</biospecimen>"
+            f"<concentration_value>{escape(conc['value'])}</concentration_value><concentration_units>{escape(conc['units'])}</concentration_units>"
+            f"<subject_age>{escape(conc['age'])}</subject_age><subject_sex>{conc['sex']}</subject_sex>"
+            f"<subject_condition>{conc['condition']}</subject_condition><comment/><references>{references}</references></concentration>")
+    return "".join(xml)
+
+def hmdbMetaboliteXml(fixtures: Fixtures, id: str) -> Optional[str]:
+    metabolite = fixtures.hmdb.get(id)
+    if metabolite is None:
+        return None
+    foodb_id = f"<foodb_id>{metabolite['foodb_id']}</foodb_id>" if metabolite["foodb_id"] else "<foodb_id/>"
+    biospecimens = "".join(f"<biospecimen>{escape(biospecimen)}</biospecimen>" for biospecimen in metabolite["biospecimens"])
+    return (f"<?xml version='1.0' encoding='UTF-8'?><metabolite><version>5.0</version><accession>{id}</accession>"
+            f"<name>{escape(metabolite['name'])}</name>{foodb_id}<synonyms><synonym>{escape(metabolite['name'])}</synonym></synonyms>"
+            f"<biological_properties><biospecimen_locations>{biospecimens}</biospecimen_locations></biological_properties>"
+            f"<normal_concentrations>{_concentrationsXml(metabolite['concentrations'])}</normal_concentrations>"
+            f"<abnormal_concentrations>{_concentrationsXml(metabolite['abconcentrations'])}</abnormal_concentrations></metabolite>")
+
+def createApp(fixtures: Fixtures, latency: float = 0.0) -> web.Application:
+    async def respond(text: Optional[str], content_type: str) -> web.Response:
+        # latency stands in for the round trip to the real hosts
+        if latency:
+            await asyncio.sleep(latency)
+        if text is None:
+            raise web.HTTPNotFound()
+        return web.Response(text=text, content_type=content_type)
+
+    def pageNum(request: web.Request) -> int:
+        return int(request.query.get("page", 1))
+
+    async def foods(request: web.Request) -> web.Response:
+        return await respond(foodCatalogPage(fixtures, pageNum(request)), "text/html")
+
+    async def compounds(request: web.Request) -> web.Response:
+        return await respond(fooDBCatalogPage(fixtures, pageNum(request)), "text/html")
+
+    async def compound(request: web.Request) -> web.Response:
+        return await respond(fooDBCompoundXml(fixtures, request.match_info["id"]), "application/xml")
+
+    async def metabolites(request: web.Request) -> web.Response:
+        return await respond(hmdbCatalogPage(fixtures, pageNum(request)), "text/html")
+
+    async def metabolite(request: web.Request) -> web.Response:
+        return await respond(hmdbMetaboliteXml(fixtures, request.match_info["id"]), "application/xml")
+
+    app = web.Application()
+    app.router.add_get("/foods", foods)
+    app.router.add_get("/compounds", compounds)
+    app.router.add_get("/compounds/{id}", compound)
+    app.router.add_get("/metabolites", metabolites)
+    app.router.add_get("/metabolites/{id}.xml", metabolite)
+    return app
+
+async def startServer(fixtures: Fixtures, host: str = "127.0.0.1", port: int = 0, latency: float = 0.0) -> Tuple[web.AppRunner, str]:
+    runner = web.AppRunner(createApp(fixtures, latency))
+    await runner.setup()
+    site = web.TCPSite(runner, host, port)
+    await site.start()
+    port = runner.addresses[0][1]
+    return runner, f"http://{host}:{port}"
+
+def _rebase(url: str, base: str) -> str:
+    return re.sub(r"^https?://[^/]+", base, url)
+
+def pointSettings(fixtures: Fixtures, base: str):
+    # The crawlers read their URLs from settings, so this is all it takes to send them to the mock
+    settings.FOODB_CATALOG_PAGE = _rebase(settings.FOODB_CATALOG_PAGE, base)
+    settings.FOODB_MET_PAGE = _rebase(settings.FOODB_MET_PAGE, base)
+    settings.FOODB_START_PAGE = 1
+    settings.FOODB_TOTAL_PAGES = fixtures.pages(fixtures.foodb_ids)
+    settings.HMDB_CATALOG_PAGE = _rebase(settings.HMDB_CATALOG_PAGE, base)
+    settings.HMDB_MET_PAGE = _rebase(settings.HMDB_MET_PAGE, base)
+    settings.HMDB_START_PAGE = 1
+    settings.HMDB_TOTAL_PAGES = fixtures.pages(fixtures.hmdb_ids)
+    settings.FOODDB_FOOD_CATALOG_URL = _rebase(settings.FOODDB_FOOD_CATALOG_URL, base)
+    settings.FOODB_FOOD_TOTAL_PAGES = fixtures.foodPages()
+
+def addFixtureArguments(parser: argparse.ArgumentParser):
+    parser.add_argument("--dump", default="../sql/foodb_20250416.sql", help="pg_dump the FooDB fixtures are built from")
+    parser.add_argument("--hmdb-ids", default="../data/Missing_HMDB_IDS.csv", help="CSV of the HMDB ids to serve")
+    parser.add_argument("--compounds", type=int, help="Only list this many FooDB compounds in the catalog")
+    parser.add_argument("--seed", type=int, default=0, help="Seed for the synthetic HMDB concentrations")
+    parser.add_argument("--latency", type=float, default=0.0, help="Seconds added to every response")
+
+async def main():
+    parser = argparse.ArgumentParser(description="Serve FooDB and HMDB lookalike pages for offline crawls")
+    addFixtureArguments(parser)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8800)
+    args = parser.parse_args()
+
+    fixtures = Fixtures(args.dump, args.hmdb_ids, args.compounds, args.seed)
+    runner, base = await startServer(fixtures, args.host, args.port, args.latency)
+    print(f"Serving {len(fixtures.foodb_ids)} FooDB and {len(fixtures.hmdb_ids)} HMDB compounds on {base}")
+    try:
+        await asyncio.Event().wait()
+    finally:
+        await runner.cleanup()
+
+if __name__ == "__main__":
+    asyncio.run(main())
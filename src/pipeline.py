@@ -0,0 +1,166 @@
+import asyncio
+from aiohttp import ClientSession
+from concurrent.futures import ProcessPoolExecutor
+from typing import Any, Awaitable, Callable, Dict, Iterable, List, Optional, Set, Tuple
+import settings
+from utility import get_page_text
+import metrics
+from ledger import CrawlLedger, PENDING, FETCHED, PARSED, WRITTEN, FAILED
+from work_queue import WorkQueue
+
+from logger import logger
+
+_DONE = object()
+_parse_executor: Optional[ProcessPoolExecutor] = None
+
+Item = Tuple[Any, Any]
+
+def getParseExecutor() -> ProcessPoolExecutor:
+    global _parse_executor
+    if _parse_executor is None:
+        _parse_executor = ProcessPoolExecutor(max_workers=settings.PARSE_WORKERS)
+    return _parse_executor
+
+def shutdownParseExecutor():
+    global _parse_executor
+    if _parse_executor is not None:
+        _parse_executor.shutdown()
+        _parse_executor = None
+
+def _parseInWorker(parse: Callable[..., Any], *args) -> Tuple[Any, Dict[str, metrics.Histogram]]:
+    # Drops whatever the worker inherited or recorded before, then returns this call's timings with the result
+    metrics.collect()
+    result = parse(*args)
+    return result, metrics.collect()
+
+async def runParser(parse: Callable[..., Any], *args) -> Any:
+    # Soup extraction is CPU bound, so it runs in worker processes and hands back plain data.
+    # parse.<name> includes the wait for a free worker, the extract.* timings inside are the parse itself.
+    with metrics.timer(f"parse.{parse.__name__}"):
+        result, collected = await asyncio.get_running_loop().run_in_executor(getParseExecutor(), _parseInWorker, parse, *args)
+    metrics.merge(collected)
+    return result
+
+async def _runStage(crawl: str, name: str, concurrency: int, inbox: asyncio.Queue, outbox: Optional[asyncio.Queue],
+                    handle: Callable[[Any, Any], Awaitable[List[Item]]], stats: Dict[str, Dict[str, int]],
+                    onFailure: Optional[Callable[[Any, Exception], None]] = None):
+    stats[name] = {"done": 0, "failed": 0}
+
+    async def worker():
+        while True:
+            item = await inbox.get()
+            if item is _DONE:
+                # Hand the sentinel on to the next idle worker of this stage
+                await inbox.put(_DONE)
+                return
+            key, payload = item
+            try:
+                results = await handle(key, payload)
+            except Exception as e:
+                stats[name]["failed"] += 1
+                metrics.increment(f"{crawl}.{name}.failed")
+                logger.error(f" {key}: {name} failed: {e!r}")
+                if onFailure is not None:
+                    onFailure(key, e)
+                continue
+            stats[name]["done"] += 1
+            metrics.increment(f"{crawl}.{name}.done")
+            if outbox is not None:
+                for result in results:
+                    await outbox.put(result)
+
+    await asyncio.gather(*[worker() for _ in range(concurrency)])
+    if outbox is not None:
+        await outbox.put(_DONE)
+
+async def runCrawl(name: str, session: ClientSession, pages: Iterable[int],
+                   catalog_url: Callable[[int], str], getIds: Callable[[str], List[str]],
+                   detail_url: Callable[[str], str], extract: Callable[[str], Dict],
+                   write: Callable[[str, Dict], Awaitable[Any]],
+                   ledger: Optional[CrawlLedger] = None) -> Dict[str, Dict[str, int]]:
+    # Catalog pages -> compound ids -> page text -> extracted record -> database, each stage
+    # with its own worker count and a bounded queue in front of it for backpressure.
+    # write returns None when the record could not be stored. With a WorkQueue as the ledger, pages
+    # are claimed from the queue shared with the other workers instead of all being crawled here.
+    shared = isinstance(ledger, WorkQueue)
+    page_queue: asyncio.Queue = asyncio.Queue(settings.SHARD_CLAIM_SIZE if shared else 0)
+    # A sharded worker lists no more pages than it can start fetching, which leaves the rest to the others
+    id_queue: asyncio.Queue = asyncio.Queue(settings.FETCH_CONCURRENCY if shared else settings.PIPELINE_QUEUE_SIZE)
+    text_queue: asyncio.Queue = asyncio.Queue(settings.PIPELINE_QUEUE_SIZE)
+    record_queue: asyncio.Queue = asyncio.Queue(settings.PIPELINE_QUEUE_SIZE)
+
+    async def mark(kind: str, key, status: str, error: Optional[str] = None):
+        if ledger is not None:
+            ledger.mark(kind, str(key), status, error)
+            await ledger.flushIfFull()
+
+    queued: Set[str] = set()
+    if shared:
+        await ledger.seed(pages)
+    else:
+        if ledger is not None:
+            await ledger.load()
+            # Compounds an earlier run found but did not finish go straight to the fetch stage
+            for id in ledger.unfinished("compound"):
+                queued.add(id)
+                page_queue.put_nowait((id, "compound"))
+            pages = [page_num for page_num in pages if not ledger.isDone("page", str(page_num))]
+        for page_num in pages:
+            page_queue.put_nowait((page_num, "page"))
+        page_queue.put_nowait(_DONE)
+
+    async def claim():
+        # A few pages at a time, so whatever is left stays up for grabs by idle workers
+        while claimed := await ledger.claim(settings.SHARD_CLAIM_SIZE):
+            for kind, key in claimed:
+                await page_queue.put((int(key) if kind == "page" else key, kind))
+        await page_queue.put(_DONE)
+
+    async def listIds(key, kind):
+        if kind == "compound":
+            return [(key, None)]
+        page_text = await get_page_text(session, catalog_url(key))
+        ids = await runParser(getIds, page_text)
+        logger.debug(f" Got ID's for page {key}")
+        if shared:
+            ids = await ledger.own(ids)
+            await mark("page", key, WRITTEN)
+        elif ledger is not None:
+            # Those already queued from the ledger are left out, so a re-listed page does not fetch them twice
+            ids = [id for id in ids if id not in queued and not ledger.isDone("compound", id)]
+            for id in ids:
+                await mark("compound", id, PENDING)
+            await mark("page", key, WRITTEN)
+        return [(id, None) for id in ids]
+
+    async def fetch(id, _):
+        page_text = await get_page_text(session, detail_url(id))
+        await mark("compound", id, FETCHED)
+        return [(id, page_text)]
+
+    async def parse(id, page_text):
+        record = await runParser(extract, page_text)
+        await mark("compound", id, PARSED)
+        return [(id, record)]
+
+    async def store(id, record):
+        if await write(id, record) is None:
+            raise ValueError("record was not written")
+        return []
+
+    def failed(kind: str):
+        def onFailure(key, e: Exception):
+            if ledger is not None:
+                ledger.mark(kind, str(key), FAILED, repr(e))
+        return onFailure
+
+    stats: Dict[str, Dict[str, int]] = {}
+    await asyncio.gather(
+        *([claim()] if shared else []),
+        _runStage(name, "catalog", settings.CATALOG_CONCURRENCY, page_queue, id_queue, listIds, stats, failed("page")),
+        _runStage(name, "fetch", settings.FETCH_CONCURRENCY, id_queue, text_queue, fetch, stats, failed("compound")),
+        _runStage(name, "parse", settings.PARSE_CONCURRENCY, text_queue, record_queue, parse, stats, failed("compound")),
+        _runStage(name, "write", settings.WRITE_CONCURRENCY, record_queue, None, store, stats, failed("compound")),
+    )
+    logger.info(f" Finished crawling {name}: {stats}")
+    return stats
@@ -0,0 +1,167 @@
+import asyncio
+import random
+import time
+import aiohttp
+from email.utils import parsedate_to_datetime
+from typing import Dict, Optional, Tuple
+from yarl import URL
+import settings
+
+from logger import logger
+
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+
+class FetchError(Exception):
+    def __init__(self, url: str, status: Optional[int], reason: str):
+        super().__init__(f"{url}: {status or ''} {reason}".strip())
+        self.url = url
+        self.status = status
+
+class HostLimiter:
+    # Token bucket for the request rate plus an AIMD window on concurrent requests. Both back off
+    # multiplicatively on throttling, errors and slow responses and creep back up while the host is healthy.
+    def __init__(self, host: str):
+        self.host = host
+        self.rate = settings.HTTP_RATE_PER_HOST
+        self.tokens = float(settings.HTTP_BURST_PER_HOST)
+        self.updated = time.monotonic()
+        self.limit = float(settings.HTTP_INITIAL_CONCURRENCY)
+        self.in_flight = 0
+        self.paused_until = 0.0
+        self.last_decrease = 0.0
+        self.condition = asyncio.Condition()
+        self.loop = asyncio.get_running_loop()
+        self.first = self.last = None
+        self.stats = {"requests": 0, "ok": 0, "retried": 0, "throttled": 0, "errors": 0, "decreases": 0}
+
+    def _refill(self, now: float):
+        self.tokens = min(settings.HTTP_BURST_PER_HOST, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    async def acquire(self):
+        async with self.condition:
+            while True:
+                now = time.monotonic()
+                if self.paused_until > now:
+                    wait = self.paused_until - now
+                elif self.in_flight >= int(self.limit):
+                    await self.condition.wait()
+                    continue
+                else:
+                    self._refill(now)
+                    if self.tokens >= 1:
+                        self.tokens -= 1
+                        self.in_flight += 1
+                        self.stats["requests"] += 1
+                        return
+                    wait = (1 - self.tokens) / self.rate
+                try:
+                    await asyncio.wait_for(self.condition.wait(), wait)
+                except asyncio.TimeoutError:
+                    pass
+
+    async def release(self, latency: float, ok: bool, congested: bool, retry_after: Optional[float] = None):
+        async with self.condition:
+            self.in_flight -= 1
+            now = time.monotonic()
+            if ok:
+                self.stats["ok"] += 1
+                self.first = self.first or now
+                self.last = now
+            if retry_after:
+                self.paused_until = max(self.paused_until, now + retry_after)
+            if congested or latency > settings.HTTP_LATENCY_TARGET:
+                # One decrease per latency window, so a burst of failures from the same moment counts once
+                if now - self.last_decrease > latency:
+                    self.limit = max(settings.HTTP_MIN_CONCURRENCY, self.limit * settings.HTTP_AIMD_DECREASE)
+                    self.rate = max(settings.HTTP_MIN_RATE, self.rate * settings.HTTP_AIMD_DECREASE)
+                    self.last_decrease = now
+                    self.stats["decreases"] += 1
+            else:
+                self.limit = min(settings.HTTP_LIMIT_PER_HOST, self.limit + 1 / self.limit)
+                self.rate = min(settings.HTTP_RATE_PER_HOST, self.rate + settings.HTTP_RATE_INCREASE / self.rate)
+            self.condition.notify_all()
+
+    def requestsPerSecond(self) -> float:
+        if self.first is None or self.last == self.first:
+            return float(self.stats["ok"])
+        return self.stats["ok"] / (self.last - self.first)
+
+limiters: Dict[str, HostLimiter] = {}
+
+def getLimiter(url: str) -> HostLimiter:
+    host = URL(url).host or ""
+    # asyncio primitives belong to the loop that first waits on them, so a new event loop starts fresh limiters
+    loop = asyncio.get_running_loop()
+    if host not in limiters or limiters[host].loop is not loop:
+        limiters[host] = HostLimiter(host)
+    return limiters[host]
+
+def retryAfter(value: Optional[str]) -> Optional[float]:
+    # Retry-After is either a number of seconds or an HTTP date
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+def backoff(attempt: int) -> float:
+    # Full jitter: a random delay up to an exponentially growing cap
+    return random.uniform(0, min(settings.HTTP_BACKOFF_MAX, settings.HTTP_BACKOFF_BASE * 2 ** attempt))
+
+async def fetchText(session: aiohttp.ClientSession, url: str, headers: Dict[str, str]) -> Tuple[int, str, Dict[str, str]]:
+    # Returns (status, text, headers) for 2xx and 304 responses. Throttling, 5xx responses and network
+    # errors are retried, anything else raises FetchError instead of handing back an error page.
+    limiter = getLimiter(url)
+    reason = ""
+    status = None
+    for attempt in range(settings.HTTP_MAX_RETRIES + 1):
+        if attempt:
+            limiter.stats["retried"] += 1
+        await limiter.acquire()
+        start = time.monotonic()
+        ok = False
+        # Only throttling, 5xx responses, network errors and slow responses slow the host down
+        congested = True
+        wait = None
+        try:
+            async with session.get(url, headers=headers) as resp:
+                status = resp.status
+                if status < 400:
+                    text = await resp.text() if status != 304 else ""
+                    ok = True
+                    congested = False
+                    return status, text, dict(resp.headers)
+                reason = resp.reason or ""
+                if status not in RETRY_STATUSES:
+                    congested = False
+                    raise FetchError(url, status, reason)
+                if status == 429:
+                    limiter.stats["throttled"] += 1
+                wait = retryAfter(resp.headers.get("Retry-After"))
+                if wait is not None:
+                    wait = min(wait, settings.HTTP_BACKOFF_MAX)
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            limiter.stats["errors"] += 1
+            status = None
+            reason = repr(e)
+        finally:
+            await limiter.release(time.monotonic() - start, ok, congested, wait)
+        if attempt == settings.HTTP_MAX_RETRIES:
+            break
+        delay = wait if wait is not None else backoff(attempt)
+        logger.warning(f" {url}: {status or reason}, retrying in {delay:.1f}s (attempt {attempt + 1})")
+        await asyncio.sleep(delay)
+    raise FetchError(url, status, f"{reason} after {settings.HTTP_MAX_RETRIES} retries")
+
+def logRateStats():
+    for host, limiter in limiters.items():
+        stats = limiter.stats
+        logger.info(f" {host}: {limiter.requestsPerSecond():.1f} req/s, {stats['ok']} ok of {stats['requests']} requests, "
+                    f"{stats['retried']} retried, {stats['throttled']} throttled, {stats['errors']} errors, "
+                    f"concurrency {limiter.limit:.1f}, rate {limiter.rate:.1f}/s")
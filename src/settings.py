@@ -1,6 +1,7 @@
+import os
 from typing import Dict
 
-food_memo = {}
+food_memo: Dict[str, int] = {}
 class_memo: Dict[str, int] = {None: None}
 biospec_memo: Dict[str, int] = {}
 foodcat_memo: Dict[str, int] = {}
@@ -17,3 +18,71 @@ FOODB_TOTAL_PAGES = 151
 
 FOODDB_FOOD_CATALOG_URL = "https://foodb.ca/foods?button=&c=food_group&d=up&page="
 FOODB_FOOD_TOTAL_PAGES = 32
+FOOD_CATALOG_CONCURRENCY = 8
+FOOD_MAP_PATH = "cache/food_map"
+FOOD_MAP_MAX_AGE = 30 * 24 * 60 * 60
+
+HTTP_TIMEOUT = 240
+HTTP_CONNECT_TIMEOUT = 30
+HTTP_READ_TIMEOUT = 120
+HTTP_CONNECTION_LIMIT = 100
+HTTP_LIMIT_PER_HOST = 10
+HTTP_DNS_CACHE_TTL = 3600
+HTTP_KEEPALIVE_TIMEOUT = 60
+
+# Per-host token bucket and AIMD concurrency window. Concurrency starts at HTTP_INITIAL_CONCURRENCY
+# and is capped by HTTP_LIMIT_PER_HOST; responses slower than HTTP_LATENCY_TARGET seconds count as congestion
+HTTP_RATE_PER_HOST = 20.0
+HTTP_MIN_RATE = 0.5
+HTTP_RATE_INCREASE = 1.0
+HTTP_BURST_PER_HOST = 10
+HTTP_INITIAL_CONCURRENCY = 4
+HTTP_MIN_CONCURRENCY = 1
+HTTP_AIMD_DECREASE = 0.5
+HTTP_LATENCY_TARGET = 10.0
+HTTP_MAX_RETRIES = 5
+HTTP_BACKOFF_BASE = 1.0
+HTTP_BACKOFF_MAX = 120.0
+
+# "revalidate" always sends a conditional request, "ttl" serves entries younger than
+# HTTP_CACHE_TTL without asking, "offline" never touches the network and "off" disables caching
+HTTP_CACHE_POLICY = "ttl"
+HTTP_CACHE_DIR = "cache/http"
+HTTP_CACHE_TTL = 7 * 24 * 60 * 60
+HTTP_CACHE_MAX_BYTES = 2 * 1024 ** 3
+
+WRITE_BATCH_SIZE = 5000
+
+DB_POOL_MIN_SIZE = 2
+DB_POOL_MAX_SIZE = 20
+
+CATALOG_CONCURRENCY = 2
+FETCH_CONCURRENCY = 10
+PARSE_WORKERS = os.cpu_count() or 1
+PARSE_CONCURRENCY = 2 * PARSE_WORKERS
+WRITE_CONCURRENCY = 8
+PIPELINE_QUEUE_SIZE = 100
+
+HMDB_DUMP_BIOSPECIMEN = "Blood"
+IMPORT_BATCH_SIZE = 1000
+
+LEDGER_FLUSH_SIZE = 500
+LEDGER_MAX_ATTEMPTS = 3
+
+# Sharded crawls (shard.py). Workers claim SHARD_CLAIM_SIZE catalog pages at a time, and a claim
+# not finished within SHARD_LEASE seconds is handed to another worker.
+SHARD_WORKERS = os.cpu_count() or 1
+SHARD_CLAIM_SIZE = 2
+SHARD_LEASE = 900
+SHARD_POLL_INTERVAL = 5
+
+SNAPSHOT_CONCURRENCY = 4
+SNAPSHOT_CHUNK_SIZE = 1024 ** 2
+SNAPSHOT_COMPRESS_LEVEL = 6
+
+EXPORT_CHUNK_SIZE = 10000
+EXPORT_CONCURRENCY = 4
+
+# metrics.json and metrics.prom are rewritten every METRICS_INTERVAL seconds during a crawl
+METRICS_DIR = "logs"
+METRICS_INTERVAL = 60
@@ -0,0 +1,104 @@
+import argparse
+import asyncio
+import multiprocessing
+import os
+
+from dotenv import load_dotenv
+from HMDB import crawlHMDB
+from FooDB import crawlFooDB
+from utility import populate_databases
+from sql import createPool, populateCompoundIndex
+from client import createSession, logConnectionStats
+from cache import logCacheStats
+from ratelimit import logRateStats
+from pipeline import shutdownParseExecutor
+from work_queue import WorkQueue
+import metrics
+import settings
+from logger import logger
+
+# Runs the crawl in several processes, on this host and any other pointed at the same database.
+# Workers share the catalog pages through the crawl_queue table, and every HMDB worker waits for
+# the whole FooDB crawl, since HMDB records are matched against the FooDB compounds.
+
+CRAWLS = (("FooDB", crawlFooDB), ("HMDB", crawlHMDB))
+
+async def prepare(repopulate_foodmap: bool, reset: bool):
+    # Once per host before the workers start, so they do not all fetch the food map
+    load_dotenv()
+    async with createPool() as pool, createSession() as session:
+        async with pool.connection() as conn:
+            await populate_databases(conn, session, repopulate_foodmap)
+        if reset:
+            for source, _ in CRAWLS:
+                await WorkQueue(pool, source).reset()
+
+async def renewClaims(queue: WorkQueue):
+    while True:
+        await asyncio.sleep(settings.SHARD_LEASE / 3)
+        await queue.renew()
+
+async def crawlShard(worker: int):
+    load_dotenv()
+    async with createPool() as pool, createSession() as session, metrics.reporting():
+        async with pool.connection() as conn:
+            await populate_databases(conn, session, False)
+
+        for source, crawl in CRAWLS:
+            queue = WorkQueue(pool, source)
+            renewing = asyncio.create_task(renewClaims(queue))
+            try:
+                await crawl(pool, session, sharded=True)
+                # Pages still held by other workers, or given back by a failure or a dead worker
+                while remaining := await queue.remaining():
+                    if await queue.claimable():
+                        await crawl(pool, session, sharded=True)
+                        continue
+                    logger.info(f" Worker {worker}: waiting for {remaining} {source} entries claimed by other workers")
+                    await asyncio.sleep(settings.SHARD_POLL_INTERVAL)
+            finally:
+                renewing.cancel()
+            logger.info(f" Worker {worker}: {source} crawl complete")
+            async with pool.connection() as conn:
+                await populateCompoundIndex(conn)
+
+        shutdownParseExecutor()
+        logConnectionStats()
+        logRateStats()
+        logCacheStats()
+
+def runWorker(worker: int, parse_workers: int, rate: float):
+    settings.PARSE_WORKERS = parse_workers
+    settings.PARSE_CONCURRENCY = 2 * parse_workers
+    settings.HTTP_RATE_PER_HOST = rate
+    settings.METRICS_DIR = os.path.join(settings.METRICS_DIR, f"worker-{worker}")
+    asyncio.run(crawlShard(worker))
+
+def main():
+    parser = argparse.ArgumentParser(description="Crawl FooDB and HMDB with several worker processes sharing one work queue")
+    parser.add_argument("--workers", type=int, default=settings.SHARD_WORKERS, help="Worker processes to start on this host")
+    parser.add_argument("--rate", type=float, default=settings.HTTP_RATE_PER_HOST,
+                        help="Requests per second per site for all of this host's workers together")
+    parser.add_argument("--repopulate-foodmap", action="store_true", help="Fetch the food catalog again before crawling")
+    parser.add_argument("--reset", action="store_true", help="Forget earlier sharded crawls and start from the first page")
+    args = parser.parse_args()
+
+    asyncio.run(prepare(args.repopulate_foodmap, args.reset))
+    # Workers are spawned rather than forked, so each starts with its own logger thread and event loop
+    context = multiprocessing.get_context("spawn")
+    parse_workers = max(1, (os.cpu_count() or 1) // args.workers)
+    processes = [
+        context.Process(target=runWorker, args=(worker, parse_workers, args.rate / args.workers), name=f"crawl-worker-{worker}")
+        for worker in range(args.workers)
+    ]
+    for process in processes:
+        process.start()
+    for process in processes:
+        process.join()
+    failed = [process.name for process in processes if process.exitcode]
+    if failed:
+        logger.error(f" Workers exited with errors: {failed}")
+        raise SystemExit(1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,260 @@
+import argparse
+import asyncio
+import datetime
+import gzip
+import hashlib
+import json
+import os
+import re
+from dotenv import load_dotenv
+from psycopg import AsyncConnection, sql
+from psycopg_pool import AsyncConnectionPool
+from typing import Dict, IO, List, Optional, Tuple
+import settings
+
+from logger import logger
+from sql import createPool
+from migrations import DATABASES, backfillConcentrations, migrate
+
+# A snapshot is a directory holding manifest.json and one gzipped COPY text file per table, so every
+# table can be dumped and loaded on its own connection
+MANIFEST = "manifest.json"
+SNAPSHOT_FORMAT = 1
+
+COPY_HEADER = re.compile(r"^COPY (?:\w+\.)?(\w+) \(([^)]*)\) FROM stdin;$")
+
+def _tableFile(table: str) -> str:
+    return f"{table}.copy.gz"
+
+def _sha256(path: str) -> str:
+    digest = hashlib.sha256()
+    with open(path, "rb") as file:
+        for chunk in iter(lambda: file.read(settings.SNAPSHOT_CHUNK_SIZE), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def writeManifest(directory: str, source: str, tables: List[Dict]):
+    manifest = {
+        "format": SNAPSHOT_FORMAT,
+        "created": datetime.datetime.now(datetime.timezone.utc).isoformat(),
+        "source": source,
+        "tables": tables,
+    }
+    with open(os.path.join(directory, MANIFEST), "w") as file:
+        json.dump(manifest, file, indent=2)
+
+def readManifest(directory: str) -> Dict:
+    with open(os.path.join(directory, MANIFEST)) as file:
+        manifest = json.load(file)
+    if manifest.get("format") != SNAPSHOT_FORMAT:
+        raise ValueError(f"Unsupported snapshot format {manifest.get('format')}")
+    return manifest
+
+async def _tableColumns(conn: AsyncConnection, table: str) -> List[str]:
+    column_select = """
+        SELECT column_name FROM information_schema.columns
+        WHERE table_schema = current_schema() AND table_name = %s
+        ORDER BY ordinal_position
+    """
+    cur = await conn.execute(column_select, (table,))
+    return [row[0] for row in await cur.fetchall()]
+
+async def _exportTable(pool: AsyncConnectionPool, directory: str, table: str, snapshot: str) -> Dict:
+    path = os.path.join(directory, _tableFile(table))
+    rows = 0
+    async with pool.connection() as conn, conn.transaction():
+        # Every table is read from the same snapshot, so the files agree with each other like a pg_dump would
+        await conn.execute("SET TRANSACTION ISOLATION LEVEL REPEATABLE READ")
+        await conn.execute(sql.SQL("SET TRANSACTION SNAPSHOT {}").format(sql.Literal(snapshot)))
+        columns = await _tableColumns(conn, table)
+        with gzip.open(path, "wb", compresslevel=settings.SNAPSHOT_COMPRESS_LEVEL) as file:
+            buffer = bytearray()
+            async with conn.cursor().copy(f"COPY {table} ({', '.join(columns)}) TO STDOUT") as copy:
+                async for data in copy:
+                    buffer += data
+                    if len(buffer) >= settings.SNAPSHOT_CHUNK_SIZE:
+                        rows += buffer.count(b"\n")
+                        # Compression runs in a thread so the other tables keep streaming meanwhile
+                        await asyncio.to_thread(file.write, bytes(buffer))
+                        buffer.clear()
+            rows += buffer.count(b"\n")
+            await asyncio.to_thread(file.write, bytes(buffer))
+    logger.info(f" Exported {rows} rows from {table}")
+    return {"name": table, "columns": columns, "rows": rows, "file": _tableFile(table), "sha256": await asyncio.to_thread(_sha256, path)}
+
+async def exportSnapshot(pool: AsyncConnectionPool, directory: str):
+    os.makedirs(directory, exist_ok=True)
+    semaphore = asyncio.Semaphore(settings.SNAPSHOT_CONCURRENCY)
+
+    async def export(table: str, snapshot: str) -> Dict:
+        async with semaphore:
+            return await _exportTable(pool, directory, table, snapshot)
+
+    async with pool.connection() as conn, conn.transaction():
+        await conn.execute("SET TRANSACTION ISOLATION LEVEL REPEATABLE READ")
+        cur = await conn.execute("SELECT pg_export_snapshot()")
+        snapshot = (await cur.fetchone())[0]
+        tables = await asyncio.gather(*[export(table, snapshot) for table in DATABASES])
+    writeManifest(directory, "database", list(tables))
+
+def convertDump(dump_path: str, directory: str):
+    # Streams a plain pg_dump: each COPY block goes straight to its table file, nothing else is kept
+    os.makedirs(directory, exist_ok=True)
+    tables = []
+    table: Optional[Dict] = None
+    file: Optional[IO[bytes]] = None
+    with open(dump_path, "rb") as dump:
+        for line in dump:
+            if table is None:
+                match = COPY_HEADER.match(line.decode("utf-8").rstrip("\n"))
+                if match:
+                    name = match.group(1)
+                    columns = [column.strip().strip('"') for column in match.group(2).split(",")]
+                    table = {"name": name, "columns": columns, "rows": 0, "file": _tableFile(name)}
+                    file = gzip.open(os.path.join(directory, table["file"]), "wb", compresslevel=settings.SNAPSHOT_COMPRESS_LEVEL)
+            elif line.rstrip(b"\r\n") == b"\\.":
+                file.close()
+                table["sha256"] = _sha256(os.path.join(directory, table["file"]))
+                logger.info(f" Converted {table['rows']} rows of {table['name']}")
+                tables.append(table)
+                table = None
+            else:
+                file.write(line)
+                table["rows"] += 1
+    if table is not None:
+        raise ValueError(f"{dump_path} ends inside the COPY block of {table['name']}")
+    order = list(DATABASES)
+    tables.sort(key=lambda t: order.index(t["name"]) if t["name"] in order else len(order))
+    writeManifest(directory, os.path.basename(dump_path), tables)
+
+async def _tableConstraints(conn: AsyncConnection, tables: List[str]) -> Tuple[List[Tuple[str, str, str]], List[Tuple[str, str, str]], List[Tuple[str, str]]]:
+    constraint_select = """
+        SELECT conrelid::regclass::text, conname, contype, pg_get_constraintdef(oid) FROM pg_constraint
+        WHERE conrelid = ANY(%s::regclass[]) AND contype IN ('p', 'u', 'f')
+    """
+    # Plain indexes, the ones backing a primary key or unique constraint come back with the constraint
+    index_select = """
+        SELECT indexrelid::regclass::text, pg_get_indexdef(indexrelid) FROM pg_index
+        WHERE indrelid = ANY(%s::regclass[])
+        AND NOT EXISTS (SELECT 1 FROM pg_constraint WHERE conindid = indexrelid)
+    """
+    keys, foreign_keys = [], []
+    cur = await conn.execute(constraint_select, (tables,))
+    for table, name, kind, definition in await cur.fetchall():
+        (foreign_keys if kind == "f" else keys).append((table, name, definition))
+    cur = await conn.execute(index_select, (tables,))
+    indexes = [(index, definition) for index, definition in await cur.fetchall()]
+    return keys, foreign_keys, indexes
+
+async def _loadTable(pool: AsyncConnectionPool, directory: str, table: Dict):
+    path = os.path.join(directory, table["file"])
+    if "sha256" in table and await asyncio.to_thread(_sha256, path) != table["sha256"]:
+        raise ValueError(f"{path} does not match the checksum in the manifest")
+    async with pool.connection() as conn:
+        async with conn.transaction(), conn.cursor() as cur:
+            with gzip.open(path, "rb") as file:
+                async with cur.copy(f"COPY {table['name']} ({', '.join(table['columns'])}) FROM STDIN") as copy:
+                    while True:
+                        data = await asyncio.to_thread(file.read, settings.SNAPSHOT_CHUNK_SIZE)
+                        if not data:
+                            break
+                        await copy.write(data)
+    logger.info(f" Loaded {table['rows']} rows into {table['name']}")
+
+async def _runAll(pool: AsyncConnectionPool, statements: List[str]):
+    semaphore = asyncio.Semaphore(settings.SNAPSHOT_CONCURRENCY)
+
+    async def run(statement: str):
+        async with semaphore, pool.connection() as conn:
+            try:
+                await conn.execute(statement)
+            except Exception as e:
+                logger.error(f" {statement}: {e}")
+                raise
+
+    results = await asyncio.gather(*[run(statement) for statement in statements], return_exceptions=True)
+    failed = [result for result in results if isinstance(result, Exception)]
+    if failed:
+        raise failed[0]
+
+async def restoreSnapshot(pool: AsyncConnectionPool, directory: str, clean: bool = False):
+    manifest = readManifest(directory)
+    tables = [table for table in manifest["tables"] if table["name"] in DATABASES]
+    names = [table["name"] for table in tables]
+    async with pool.connection() as conn:
+        await migrate(conn)
+        async with conn.transaction():
+            if clean:
+                await conn.execute(f"TRUNCATE {', '.join(names)} RESTART IDENTITY CASCADE")
+            else:
+                for name in names:
+                    cur = await conn.execute(f"SELECT EXISTS (SELECT 1 FROM {name})")
+                    if (await cur.fetchone())[0]:
+                        raise ValueError(f"{name} is not empty, restore with --clean to replace its rows")
+            # Tables outside the snapshot can still hold foreign keys into it
+            keys, foreign_keys, indexes = await _tableConstraints(conn, list(DATABASES))
+            # Loading into bare tables is much faster than maintaining indexes and checking FKs per row
+            for table, name, _ in foreign_keys + keys:
+                await conn.execute(f"ALTER TABLE {table} DROP CONSTRAINT {name}")
+            for index, _ in indexes:
+                await conn.execute(f"DROP INDEX {index}")
+    logger.info(f" Restoring {len(tables)} tables from {manifest['source']} snapshot of {manifest['created']}")
+
+    semaphore = asyncio.Semaphore(settings.SNAPSHOT_CONCURRENCY)
+
+    async def load(table: Dict):
+        async with semaphore:
+            await _loadTable(pool, directory, table)
+
+    try:
+        # Largest tables first so the longest COPY is not the one left running alone at the end
+        await asyncio.gather(*[load(table) for table in sorted(tables, key=lambda t: -t["rows"])])
+    finally:
+        # Keys before foreign keys, which need the referenced unique index
+        await _runAll(pool, [f"ALTER TABLE {table} ADD CONSTRAINT {name} {definition}" for table, name, definition in keys]
+                      + [definition for _, definition in indexes])
+        await _runAll(pool, [f"ALTER TABLE {table} ADD CONSTRAINT {name} {definition}" for table, name, definition in foreign_keys])
+
+    sequence_select = """
+        SELECT table_name, column_name, pg_get_serial_sequence(quote_ident(table_name), column_name) FROM information_schema.columns
+        WHERE table_schema = current_schema() AND table_name = ANY(%s) AND column_default LIKE 'nextval(%%'
+    """
+    async with pool.connection() as conn:
+        async with conn.transaction():
+            cur = await conn.execute(sequence_select, (names,))
+            for table, column, sequence in await cur.fetchall():
+                await conn.execute(f"SELECT setval(%s, coalesce(max({column}), 1), max({column}) IS NOT NULL) FROM {table}", (sequence,))
+        if "concentration" in names:
+            # migrate() ran before the load, so rows from older dumps still lack the parsed numeric values
+            async with conn.transaction(), conn.cursor() as cur:
+                await backfillConcentrations(cur)
+        await conn.set_autocommit(True)
+        await conn.execute(f"ANALYZE {', '.join(names)}")
+    logger.info(f" Restored {sum(table['rows'] for table in tables)} rows")
+
+async def main():
+    parser = argparse.ArgumentParser(description="Export, restore and convert per-table database snapshots")
+    commands = parser.add_subparsers(dest="command", required=True)
+    export_parser = commands.add_parser("export", help="Dump every crawler table into a snapshot directory")
+    export_parser.add_argument("directory")
+    restore_parser = commands.add_parser("restore", help="Load a snapshot directory into the database")
+    restore_parser.add_argument("directory")
+    restore_parser.add_argument("--clean", action="store_true", help="Empty the tables before loading")
+    convert_parser = commands.add_parser("convert", help="Turn a plain pg_dump file into a snapshot directory")
+    convert_parser.add_argument("dump")
+    convert_parser.add_argument("directory")
+    args = parser.parse_args()
+
+    if args.command == "convert":
+        convertDump(args.dump, args.directory)
+        return
+
+    load_dotenv()
+    async with createPool() as pool:
+        if args.command == "export":
+            await exportSnapshot(pool, args.directory)
+        else:
+            await restoreSnapshot(pool, args.directory, args.clean)
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -1,8 +1,22 @@
 from psycopg import AsyncConnection, AsyncCursor, sql
-from typing import Dict, List
+from psycopg.conninfo import make_conninfo
+from psycopg_pool import AsyncConnectionPool
+from typing import Dict, Iterable, List, Tuple
+import os
 import settings
+from compound_index import compound_index
+from metrics import timed
 from logger import logger
 
+def createPool() -> AsyncConnectionPool:
+    conninfo = make_conninfo(dbname = os.getenv('PSQL_DATABASE'), 
+                        user = os.getenv('PSQL_USERNAME'), 
+                        host= os.getenv('PSQL_HOST'),
+                        password = os.getenv('PSQL_PASSWORD'),
+                        port = 5432)
+    return AsyncConnectionPool(conninfo, min_size=settings.DB_POOL_MIN_SIZE, max_size=settings.DB_POOL_MAX_SIZE, open=False)
+
+@timed("sql")
 async def insertFoodCategoryDatabase(conn: AsyncConnection, cur: AsyncCursor, name: str) -> int:
     cat_insert =   """
     INSERT INTO food_category (name)
@@ -11,55 +25,56 @@ async def insertFoodCategoryDatabase(conn: AsyncConnection, cur: AsyncCursor, na
     RETURNING id
     """
     await cur.execute(cat_insert, (name,))
-    await conn.commit()
     row = await cur.fetchone()
     
     if row is None:
         raise ValueError("No row returned")
     return row[0]
     
-async def insertFoodDatabase(conn: AsyncConnection, cur: AsyncCursor, cat_id: int, food_name: str) -> int:
-    food_insert = """
-    INSERT INTO food (category_id, name)
-    VALUES (%s, %s)
-    returning id
+@timed("sql")
+async def insertFoodsDatabase(cur: AsyncCursor, foods: List[Tuple[int, str]]) -> Tuple[Dict[str, int], List[str]]:
+    # One statement for any number of (category_id, name) rows. Existing foods keep their category.
+    foods_insert = """
+        INSERT INTO food (category_id, name)
+        SELECT * FROM unnest(%s::int[], %s::text[])
+        ON CONFLICT (name) DO UPDATE SET name = EXCLUDED.name
+        RETURNING id, name, xmax = 0
     """
-    await cur.execute(food_insert, (cat_id, food_name))
-    await conn.commit()
-    row = await cur.fetchone()
-    
-    if row is None:
-        raise ValueError("No row returned")
-    return row[0]
+    await cur.execute(foods_insert, ([cat_id for cat_id, _ in foods], [name for _, name in foods]))
+    food_ids = {}
+    created = []
+    async for id, name, inserted in cur:
+        food_ids[name] = id
+        if inserted:
+            created.append(name)
+    return food_ids, created
 
+@timed("sql")
 async def populateFoodDatabase(conn: AsyncConnection, food_map : Dict[str, List[str]]):
+    categories_insert = """
+        INSERT INTO food_category (name)
+        SELECT unnest(%s::text[])
+        ON CONFLICT (name) DO UPDATE SET name = EXCLUDED.name
+        RETURNING id, name
+    """
     cur = conn.cursor()
     
-    for category, foods in food_map.items():
-        if category not in settings.foodcat_memo:
-            cat_id = await insertFoodCategoryDatabase(conn, cur, category)
-            settings.foodcat_memo[category] = cat_id
-            
-
-        for food in foods:
-            await insertFoodDatabase(conn, cur, settings.foodcat_memo[category], food)
-    await insertFoodCategoryDatabase(conn, cur, "UNKNOWN")
+    # The food map can already hold UNKNOWN, and one statement may not touch a row twice
+    await cur.execute(categories_insert, (list(dict.fromkeys([*food_map, "UNKNOWN"])),))
+    async for id, name in cur:
+        settings.foodcat_memo[name] = id
+    
+    # A food listed under several categories keeps the first, as row-by-row inserts did
+    foods: Dict[str, int] = {}
+    for category, names in food_map.items():
+        for food in names:
+            foods.setdefault(food, settings.foodcat_memo[category])
+    food_ids, _ = await insertFoodsDatabase(cur, [(cat_id, food) for food, cat_id in foods.items()])
+    settings.food_memo.update(food_ids)
     await conn.commit()
     await cur.close()
     
-async def getFoodCatDatabase(conn: AsyncConnection, cur: AsyncCursor, cat_name: str) -> int:
-    food_get = """
-        SELECT id FROM food_category
-        WHERE name= %s
-    """
-    
-    await cur.execute(food_get, (cat_name,))
-    row = await cur.fetchone()
-    
-    if row is None:
-        raise ValueError("No row returned")
-    return row[0]
-    
+@timed("sql")
 async def getCompoundDatabase(conn: AsyncConnection, cur: AsyncCursor, id: str, is_hmdb: None):
     if is_hmdb is None:
         logger.error(" Must input isHMDB")
@@ -74,7 +89,8 @@ async def getCompoundDatabase(conn: AsyncConnection, cur: AsyncCursor, id: str,
     return cur.fetchone()
     
     
-async def insertClassDatabase(conn: AsyncConnection, cur: AsyncCursor, met_class: str):
+@timed("sql")
+async def insertClassDatabase(pool: AsyncConnectionPool, met_class: str):
     compound_class_insert = """
         INSERT INTO compound_class (name)
         VALUES (%s)
@@ -82,14 +98,16 @@ async def insertClassDatabase(conn: AsyncConnection, cur: AsyncCursor, met_class
         RETURNING id
     """
     if met_class not in settings.class_memo:
-        await cur.execute(compound_class_insert, (met_class,))
-        row = await cur.fetchone()
+        async with pool.connection() as conn:
+            cur = await conn.execute(compound_class_insert, (met_class,))
+            row = await cur.fetchone()
         if row is None:
             raise ValueError("No row returned")
         settings.class_memo[met_class] = row[0]
-        await conn.commit()
             
-async def insertCompoundDatabase(conn: AsyncConnection, cur: AsyncCursor, met_id: str, name: str, met_class: str, isHMDB=None, insertClass=True) -> int:
+@timed("sql")
+async def insertCompoundDatabase(conn: AsyncConnection, cur: AsyncCursor, met_id: str, name: str, met_class: str, isHMDB=None) -> Tuple[int, bool]:
+    # Also returns whether the row is new, an existing compound may still hold rows from an earlier crawl
     if isHMDB == None:
         logger.error(" Must input isHMDB")
         raise
@@ -97,19 +115,18 @@ async def insertCompoundDatabase(conn: AsyncConnection, cur: AsyncCursor, met_id
     compound_insert = f"""
         INSERT INTO compound (class_id, name, {id_type})
         VALUES (%s, %s, %s)
-        returning id
+        ON CONFLICT ({id_type}) DO UPDATE SET class_id = EXCLUDED.class_id, name = EXCLUDED.name
+        returning id, xmax = 0
     """
-    if insertClass:
-        await insertClassDatabase(conn, cur, met_class)
     data = (settings.class_memo[met_class], name, met_id)
     await cur.execute(compound_insert, data)
-    await conn.commit()
     row = await cur.fetchone()
     if row is None:
         raise ValueError("No row returned")
-    return row[0]
+    return row[0], row[1]
 
-async def insertBioSpecDatabase(conn: AsyncConnection, cur: AsyncCursor, compound_id: int, biospec: str):
+@timed("sql")
+async def insertBioSpecDatabase(pool: AsyncConnectionPool, biospec: str) -> int:
     biospec_insert = """
         INSERT INTO biospecimen (name)
         VALUES (%s)
@@ -117,113 +134,88 @@ async def insertBioSpecDatabase(conn: AsyncConnection, cur: AsyncCursor, compoun
         RETURNING id
     """
     if biospec not in settings.biospec_memo:
-        await cur.execute(biospec_insert, (biospec,))
-        row = await cur.fetchone()
+        async with pool.connection() as conn:
+            cur = await conn.execute(biospec_insert, (biospec,))
+            row = await cur.fetchone()
         
         if row is None:
             raise ValueError("No row returned")
         settings.biospec_memo[biospec] = row[0]
-        await conn.commit()
-    
-    biospec_connect = """
-        INSERT INTO compound_biospecimens (compound_id, biospecimen_id)
-        VALUES (%s, %s)
-    """
-    await cur.execute(biospec_connect, (compound_id, settings.biospec_memo[biospec]))
-    await conn.commit()
-    
-async def insertConcentrationDatabase(conn: AsyncConnection, cur: AsyncCursor, compound_id: int, concentration: Dict):
-    concentration_insert = """
-        INSERT INTO concentration ({fields})
-        VALUES ({placeholders})
-        returning id
-    """
-    reference_insert = """
-        INSERT INTO reference ({fields})
-        VALUES ({placeholders})
-    """
-    references = None
-    if "references" in concentration:
-        references = concentration["references"]
-        del concentration["references"]
-        
-    concentration["biospecimen_id"] = settings.biospec_memo[concentration["biospecimen"]]
-    del concentration["biospecimen"]
-    concentration["compound_id"] = compound_id
-    
-    
-    cols = list(concentration.keys())
-    values = [concentration[col] for col in cols]
-    
-    query = sql.SQL(concentration_insert).format(
-        fields=sql.SQL(', ').join(map(sql.Identifier, cols)),
-        placeholders=sql.SQL(', ').join(sql.Placeholder() * len(values))
-    )
-    await cur.execute(query, values)
-    row = await cur.fetchone()
-    
-    if row is None:
-        raise ValueError("No row returned")
-    conc_id = row[0]
-    await conn.commit()
-    
-    if references:
-        for reference in references:
-            reference["concentration_id"] = conc_id
-            cols = list(reference.keys())
-            values = [reference[col] for col in cols]
+    return settings.biospec_memo[biospec]
             
-            query = sql.SQL(reference_insert).format(
-                fields=sql.SQL(", ").join(map(sql.Identifier, cols)),
-                placeholders=sql.SQL(", ").join(sql.Placeholder() * len(values)),
-            )
-            await cur.execute(query, values)
-            await conn.commit()
-            
-async def connectFoodDatabase(conn: AsyncConnection, cur: AsyncCursor, compound_id: int, food: str, average_value, max_value, min_value):
-    food_select = """
-        SELECT id FROM food
-        WHERE name = %s
+@timed("sql")
+async def getFoodIdsDatabase(pool: AsyncConnectionPool, foods: Iterable[str]) -> Dict[str, int]:
+    # food_memo is preloaded, so only foods missing from the food catalog reach the database,
+    # all of a compound's in one round trip
+    foods = list(foods)
+    missing = [food for food in dict.fromkeys(foods) if food not in settings.food_memo]
+    if missing:
+        async with pool.connection() as conn, conn.cursor() as cur:
+            if "UNKNOWN" not in settings.foodcat_memo:
+                settings.foodcat_memo["UNKNOWN"] = await insertFoodCategoryDatabase(conn, cur, "UNKNOWN")
+            unknown_cat_id = settings.foodcat_memo["UNKNOWN"]
+            food_ids, created = await insertFoodsDatabase(cur, [(unknown_cat_id, food) for food in missing])
+        for food in created:
+            logger.warning(f" food_id for {food} does not exist. Item created with category UNKNOWN.")
+        settings.food_memo.update(food_ids)
+    return {food: settings.food_memo[food] for food in foods}
+    
+@timed("sql")
+async def deleteCompoundRows(conn: AsyncConnection, cur: AsyncCursor, compound_id: int, tables: List[str]):
+    for table in tables:
+        compound_delete = sql.SQL("""
+            DELETE FROM {table}
+            WHERE compound_id = %s
+        """).format(table=sql.Identifier(table))
+        await cur.execute(compound_delete, (compound_id,))
+    
+@timed("sql")
+async def getFoodCompoundRows(conn: AsyncConnection, cur: AsyncCursor, compound_id: int) -> Dict[int, tuple]:
+    food_compound_select = """
+        SELECT food_id, average_value, max_value, min_value FROM food_compounds
+        WHERE compound_id = %s
     """
-    food_connect = """
+    await cur.execute(food_compound_select, (compound_id,))
+    return {row[0]: row[1:] for row in await cur.fetchall()}
+
+@timed("sql")
+async def upsertFoodCompounds(conn: AsyncConnection, cur: AsyncCursor, rows: List[tuple]):
+    food_compound_upsert = """
         INSERT INTO food_compounds (compound_id, food_id, average_value, max_value, min_value)
         VALUES (%s, %s, %s, %s, %s)
+        ON CONFLICT (compound_id, food_id) DO UPDATE SET
+            average_value = EXCLUDED.average_value,
+            max_value = EXCLUDED.max_value,
+            min_value = EXCLUDED.min_value
     """
-    if food not in settings.food_memo:
-        await cur.execute(food_select, (food,))
-        row = await cur.fetchone()
-        if row is None:
-            raise ValueError("No row returned")
-        food_id = row[0]
-        if not food_id:
-            unknown_cat_id = await getFoodCatDatabase(conn, cur, "UNKNOWN")
-            food_id = await insertFoodDatabase(conn, cur, unknown_cat_id, food)
-            logger.warning(f" food_id for {food} does not exist. Item created with category UNKNOWN.")
-            
-        settings.food_memo[food] = food_id
-    
-    food_data = (compound_id, settings.food_memo[food], average_value, max_value, min_value)
-    
-    await cur.execute(food_connect, food_data)
-    
-    await conn.commit()
-    
-async def getCompoundIdAndFooDBIdFromName(conn: AsyncConnection, cur: AsyncCursor, name: str) -> int:
-    compound_select = """
-        SELECT id, foodb_id FROM compound
-        WHERE name = %s
+    await cur.executemany(food_compound_upsert, rows)
+
+@timed("sql")
+async def deleteFoodCompounds(conn: AsyncConnection, cur: AsyncCursor, compound_id: int, food_ids: List[int]):
+    food_compound_delete = """
+        DELETE FROM food_compounds
+        WHERE compound_id = %s AND food_id = ANY(%s)
     """
-    await cur.execute(compound_select, (name,))
-    return await cur.fetchone()
+    await cur.execute(food_compound_delete, (compound_id, food_ids))
 
-async def getCompoundIdFromFooDBId(conn: AsyncConnection, cur: AsyncCursor, foodb_id: str) -> int:
-    compound_select = """
-        SELECT id FROM compound
-        WHERE foodb_id = %s
+@timed("sql")
+async def getBiospecimenIds(conn: AsyncConnection, cur: AsyncCursor, compound_id: int) -> List[int]:
+    biospec_select = """
+        SELECT biospecimen_id FROM compound_biospecimens
+        WHERE compound_id = %s
     """
-    await cur.execute(compound_select, (foodb_id,))
-    return await cur.fetchone()
+    await cur.execute(biospec_select, (compound_id,))
+    return [row[0] for row in await cur.fetchall()]
 
+@timed("sql")
+async def deleteBiospecimens(conn: AsyncConnection, cur: AsyncCursor, compound_id: int, biospec_ids: List[int]):
+    biospec_delete = """
+        DELETE FROM compound_biospecimens
+        WHERE compound_id = %s AND biospecimen_id = ANY(%s)
+    """
+    await cur.execute(biospec_delete, (compound_id, biospec_ids))
+
+@timed("sql")
 async def updateHmdbId(conn: AsyncConnection, cur: AsyncCursor, compound_id: int, hmdb_id: str):
     compound_update = """
         UPDATE compound
@@ -232,9 +224,9 @@ async def updateHmdbId(conn: AsyncConnection, cur: AsyncCursor, compound_id: int
     """
     
     await cur.execute(compound_update, (hmdb_id, compound_id))
-    await conn.commit()
     
     
+@timed("sql")
 async def populateBiospecimenMemo(conn: AsyncConnection):
     biospecimen_select = """
         SELECT id, name FROM biospecimen
@@ -247,6 +239,7 @@ async def populateBiospecimenMemo(conn: AsyncConnection):
     
     await cur.close()
     
+@timed("sql")
 async def populateFoodCatMemo(conn: AsyncConnection):
     foodcat_select = """
         SELECT id, name FROM food_category
@@ -259,6 +252,7 @@ async def populateFoodCatMemo(conn: AsyncConnection):
     
     await cur.close()
     
+@timed("sql")
 async def populateClassMemo(conn: AsyncConnection):
     class_select = """
         SELECT id, name FROM compound_class
@@ -269,4 +263,32 @@ async def populateClassMemo(conn: AsyncConnection):
     async for id, name in cur:
         settings.class_memo[name] = id
     
-    await cur.close()
\ No newline at end of file
+    await cur.close()
+    
+@timed("sql")
+async def populateCompoundIndex(conn: AsyncConnection):
+    compound_select = """
+        SELECT id, name, foodb_id, hmdb_id FROM compound
+    """
+    compound_index.clear()
+    cur = conn.cursor()
+    await cur.execute(compound_select)
+    
+    async for id, name, foodb_id, hmdb_id in cur:
+        compound_index.add(id, name, foodb_id, hmdb_id)
+    
+    await cur.close()
+    logger.info(f" Loaded {len(compound_index)} compounds into the resolution index")
+    
+@timed("sql")
+async def populateFoodMemo(conn: AsyncConnection):
+    food_select = """
+        SELECT id, name FROM food
+    """
+    cur = conn.cursor()
+    await cur.execute(food_select)
+    
+    async for id, name in cur:
+        settings.food_memo[name] = id
+    
+    await cur.close()
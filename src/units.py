@@ -0,0 +1,73 @@
+import re
+from typing import Dict, Optional, Tuple
+
+NUMBER = r"(\d+(?:\.\d+)?(?:[eE][-+]?\d+)?)"
+SD = r"\s*(?:\+/-|\+-|±)\s*"
+RANGE = r"\s*(?:-|–|to)\s*"
+
+# HMDB writes values as "12.3", "12.3 +/- 4.1", "5.0-10.0", "2.5 (1.0-4.0)", "12.3 +/- 4.1 (5.0-20.0)", "<0.5" or "> 10"
+VALUE_PATTERNS = [
+    (re.compile(rf"^{NUMBER}$"), ("mean",)),
+    (re.compile(rf"^{NUMBER}{SD}{NUMBER}$"), ("mean", "sd")),
+    (re.compile(rf"^{NUMBER}{RANGE}{NUMBER}$"), ("low", "high")),
+    (re.compile(rf"^{NUMBER}\s*\(\s*{NUMBER}{RANGE}{NUMBER}\s*\)$"), ("mean", "low", "high")),
+    (re.compile(rf"^{NUMBER}{SD}{NUMBER}\s*\(\s*{NUMBER}{RANGE}{NUMBER}\s*\)$"), ("mean", "sd", "low", "high")),
+    (re.compile(rf"^(?:<|<=|≤)\s*{NUMBER}$"), ("high",)),
+    (re.compile(rf"^(?:>|>=|≥)\s*{NUMBER}$"), ("low",)),
+]
+
+# Lower-cased units -> (canonical unit, factor to multiply values by). Mass units would need the
+# molecular weight and units missing here are kept as they are, unscaled.
+UNITS: Dict[str, Tuple[str, float]] = {
+    "pm": ("uM", 1e-6),
+    "pmol/l": ("uM", 1e-6),
+    "nm": ("uM", 1e-3),
+    "nmol/l": ("uM", 1e-3),
+    "um": ("uM", 1.0),
+    "umol/l": ("uM", 1.0),
+    "mm": ("uM", 1e3),
+    "mmol/l": ("uM", 1e3),
+    "nmol/mmol creatinine": ("umol/mmol creatinine", 1e-3),
+    "umol/mol creatinine": ("umol/mmol creatinine", 1e-3),
+    "umol/mmol creatinine": ("umol/mmol creatinine", 1.0),
+    "mmol/mol creatinine": ("umol/mmol creatinine", 1.0),
+    "mmol/mmol creatinine": ("umol/mmol creatinine", 1e3),
+    "nmol/g": ("nmol/g", 1.0),
+    "nmol/g wet tissue": ("nmol/g", 1.0),
+    "umol/g": ("nmol/g", 1e3),
+    "umol/g wet tissue": ("nmol/g", 1e3),
+}
+
+def parseValue(value: Optional[str]) -> Dict[str, Optional[float]]:
+    # mean is the reported value, or the middle of the range when only a range is given
+    parsed = {"mean": None, "low": None, "high": None, "sd": None}
+    if not value:
+        return parsed
+    value = re.sub(r"(?<=\d),(?=\d{3}\b)", "", value.strip())
+    for pattern, fields in VALUE_PATTERNS:
+        match = pattern.match(value)
+        if match:
+            parsed.update(zip(fields, map(float, match.groups())))
+            break
+    if parsed["mean"] is None and parsed["low"] is not None and parsed["high"] is not None:
+        parsed["mean"] = (parsed["low"] + parsed["high"]) / 2
+    return parsed
+
+def normalizeUnits(units: Optional[str]) -> Tuple[Optional[str], float]:
+    if not units:
+        return None, 1.0
+    units = " ".join(units.split())
+    key = units.replace("µ", "u").replace("μ", "u").lower()
+    return UNITS.get(key, (units, 1.0))
+
+def normalizeConcentration(value: Optional[str], units: Optional[str]) -> Dict:
+    # The numeric columns stored next to the raw value and units text
+    parsed = parseValue(value)
+    normalized_units, factor = normalizeUnits(units)
+    return {
+        "value_mean": parsed["mean"] * factor if parsed["mean"] is not None else None,
+        "value_low": parsed["low"] * factor if parsed["low"] is not None else None,
+        "value_high": parsed["high"] * factor if parsed["high"] is not None else None,
+        "value_sd": parsed["sd"] * factor if parsed["sd"] is not None else None,
+        "normalized_units": normalized_units,
+    }
@@ -1,180 +1,127 @@
 import os
 import logging
-from bs4 import BeautifulSoup as bs
+import asyncio
+import time
 import aiohttp
+import lxml.html
+from contextlib import contextmanager
+from lxml import etree
 import settings
+import cache
+from ratelimit import fetchText
+from metrics import timed
 
-from psycopg import AsyncConnection, AsyncCursor
+from psycopg import AsyncConnection
 
 
-from sql import populateFoodDatabase, populateBiospecimenMemo, populateClassMemo, populateFoodCatMemo
+from migrations import migrate
+from sql import populateFoodDatabase, populateBiospecimenMemo, populateClassMemo, populateFoodCatMemo, populateFoodMemo, populateCompoundIndex
 
 import json
 from psycopg import AsyncConnection
-from typing import Dict, List
-
-DATABASES = {
-    "food_category":
-        """
-        CREATE TABLE food_category (
-        id SERIAL PRIMARY KEY,
-        name VARCHAR(50) NOT NULL UNIQUE
-        )
-        """,
-    "food":
-        """
-        CREATE TABLE food (
-        id SERIAL PRIMARY KEY,
-        category_id INT,
-        name VARCHAR(50) NOT NULL UNIQUE,
-        CONSTRAINT fk_category_id FOREIGN KEY (category_id)
-            REFERENCES food_category (id)
-            ON DELETE SET NULL
-        )
-        """,
-    "compound_class":
-        """
-        CREATE TABLE compound_class (
-        id SERIAL PRIMARY KEY,
-        name VARCHAR(50) NOT NULL UNIQUE
-        )
-        """,
-    "compound": 
-        """
-        CREATE TABLE compound (
-        id SERIAL PRIMARY KEY,
-        class_id INT,
-        name VARCHAR(100) NOT NULL UNIQUE,
-        hmdb_id CHAR(11) UNIQUE,
-        foodb_id CHAR(9) UNIQUE,
-        CONSTRAINT fk_class_id FOREIGN KEY (class_id)
-            REFERENCES compound_class (id)
-            ON DELETE CASCADE
-        )
-        """,
-    "food_compounds": 
-        """
-        CREATE TABLE food_compounds (
-        compound_id INT NOT NULL,
-        food_id INT NOT NULL,
-        average_value REAL,
-        max_value REAL,
-        min_value REAL,
-        PRIMARY KEY(compound_id, food_id),
-        CONSTRAINT fk_compound_id FOREIGN KEY (compound_id)
-            REFERENCES compound (id)
-            ON DELETE CASCADE,
-        CONSTRAINT fk_food_id FOREIGN KEY (food_id)
-            REFERENCES food (id)
-            ON DELETE CASCADE
-        )
-        """,
-    "biospecimen": 
-        """
-        CREATE TABLE biospecimen (
-        id SERIAL PRIMARY KEY,
-        name VARCHAR(50) NOT NULL UNIQUE
-        )
-        """,
-    "compound_biospecimens": 
-        """
-        CREATE TABLE compound_biospecimens (
-        compound_id INT NOT NULL,
-        biospecimen_id INT,
-        PRIMARY KEY(compound_id, biospecimen_id),
-        CONSTRAINT fk_compound_id FOREIGN KEY (compound_id)
-            REFERENCES compound (id)
-            ON DELETE CASCADE,
-        CONSTRAINT fk_biospecimen_id FOREIGN KEY (biospecimen_id)
-            REFERENCES biospecimen (id)
-            ON DELETE CASCADE
-        )
-        """,
-    "concentration": 
-        """
-        CREATE TABLE concentration (
-        id SERIAL PRIMARY KEY,
-        compound_id INT NOT NULL,
-        biospecimen_id INT NOT NULL,
-        value CHAR(50) NOT NULL,
-        units CHAR(35) NOT NULL,
-        age CHAR(35),
-        sex CHAR(15),
-        condition TEXT,
-        comment TEXT,
-        CONSTRAINT fk_compound_id FOREIGN KEY (compound_id)
-            REFERENCES compound (id)
-            ON DELETE CASCADE,
-        CONSTRAINT fk_biospecimen_id FOREIGN KEY (biospecimen_id)
-            REFERENCES biospecimen (id)
-            ON DELETE CASCADE
-        )
-        """,
-    "reference": 
-        """
-        CREATE TABLE reference (
-        id SERIAL PRIMARY KEY,
-        concentration_id INT NOT NULL,
-        reference_text TEXT,
-        pubmed_id CHAR(10),
-        CONSTRAINT fk_concentration_id FOREIGN KEY (concentration_id)
-            REFERENCES concentration (id)
-            ON DELETE CASCADE
-        )
-        """,
-}
-
-async def check_and_create(cur: AsyncCursor, name, creation_command) -> None:
-    await cur.execute("SELECT EXISTS(SELECT * from information_schema.tables WHERE table_name=%s)", (name,))
-    row = await cur.fetchone()
-    if not row:
-        raise ValueError("No row returned")
-    if not row[0]:
-        await cur.execute(creation_command)
-        
+from typing import Dict, List, Optional, Tuple
 
-async def createDatabases(conn: AsyncConnection) -> None:
-    cursor = conn.cursor()
-    for database_name, create_command in DATABASES.items():
-        await check_and_create(cursor, database_name, create_command)
-    await conn.commit()
-    await cursor.close()
+from logger import logger
 
+@timed("http")
+async def get_page_text(session: aiohttp.ClientSession, url: str):
+    policy = settings.HTTP_CACHE_POLICY
+    entry = None
+    if policy != "off":
+        entry = await cache.lookup(url)
+        if entry and (policy == "offline" or (policy == "ttl" and cache.isFresh(entry))):
+            cache.cache_stats["hits"] += 1
+            return entry["text"]
+        if policy == "offline":
+            raise cache.CacheMiss(url)
 
+    status, page_text, headers = await fetchText(session, url, cache.conditionalHeaders(entry))
+    if entry and status == 304:
+        cache.cache_stats["revalidated"] += 1
+        await cache.touch(url, entry)
+        return entry["text"]
+    if policy != "off":
+        cache.cache_stats["misses"] += 1
+        if status == 200:
+            await cache.store(url, page_text, headers.get("ETag"), headers.get("Last-Modified"))
+    return page_text
 
-async def get_page_text(url: str):
-    timeout = aiohttp.ClientTimeout(total=240)
-    async with aiohttp.ClientSession(timeout=timeout) as session:
-        async with session.get(url) as resp:
-            page_text = await resp.text()
-            return page_text
+@contextmanager
+def revalidating(refresh: bool = True):
+    # A refresh is looking for changes, so under the "ttl" policy cached pages would hide every change
+    # made within HTTP_CACHE_TTL. Switches to "revalidate" for its duration, a conditional request still
+    # goes out for every page and only unchanged ones come from the cache.
+    policy = settings.HTTP_CACHE_POLICY
+    if refresh and policy == "ttl":
+        settings.HTTP_CACHE_POLICY = "revalidate"
+    try:
+        yield
+    finally:
+        settings.HTTP_CACHE_POLICY = policy
         
 
-async def getFoodMap() -> Dict[str, List[str]]:
+FOOD_LINKS = etree.XPath("//a[contains(concat(' ', normalize-space(@class), ' '), ' btn-show ')]")
+
+def _string(el) -> Optional[str]:
+    # Same as BeautifulSoup's .string: the text of an element whose only content is text
+    if len(el) == 0:
+        return el.text
+    if len(el) == 1 and not el.text and not el[0].tail:
+        return _string(el[0])
+    return None
+
+def getFoodCatalogRows(page_text: str) -> List[Tuple[str, str]]:
+    rows = []
+    for food_link in FOOD_LINKS(lxml.html.fromstring(page_text)):
+        row_elements = [el for el in food_link.getparent().getparent() if isinstance(el.tag, str)]
+        rows.append((_string(row_elements[4]), _string(row_elements[1])))
+    return rows
+
+async def getFoodMap(session: aiohttp.ClientSession) -> Dict[str, List[str]]:
+    semaphore = asyncio.Semaphore(settings.FOOD_CATALOG_CONCURRENCY)
+
+    async def getPage(page_num: int) -> List[Tuple[str, str]]:
+        async with semaphore:
+            page_text = await get_page_text(session, settings.FOODDB_FOOD_CATALOG_URL + str(page_num))
+        return getFoodCatalogRows(page_text)
+
+    pages = await asyncio.gather(*[getPage(page_num) for page_num in range(1, settings.FOODB_FOOD_TOTAL_PAGES+1)])
     food_map: Dict[str, List[str]] = {}
-    for page_num in range(1, settings.FOODB_FOOD_TOTAL_PAGES+1):
-        url = settings.FOODDB_FOOD_CATALOG_URL + str(page_num)
-        page_text = await get_page_text(url)
-        soup = bs(page_text, "html.parser")
-        food_links = soup.find_all("a", class_="btn-show")
-        for food_link in food_links:
-            row = food_link.parent.parent
-            row_elements = row.find_all(True, recursive=False)
-            category = row_elements[4].string
+    for rows in pages:
+        for category, food in rows:
             if category not in food_map:
                 food_map[category] = []
-            food_map[category].append(row_elements[1].string)
+            food_map[category].append(food)
     return food_map
 
+def loadFoodMap() -> Optional[Dict[str, List[str]]]:
+    path = settings.FOOD_MAP_PATH
+    try:
+        age = time.time() - os.path.getmtime(path)
+        if age > settings.FOOD_MAP_MAX_AGE:
+            logger.info(f" {path} is {age / 86400:.0f} days old. Rebuilding the food map")
+            return
+        with open(path) as file:
+            food_map = json.load(file)
+    except FileNotFoundError:
+        return
+    except (OSError, ValueError) as e:
+        logger.warning(f" Could not read {path}: {e}")
+        return
+    return food_map or None
 
-async def populate_databases(conn: AsyncConnection, repopulate_foodmap: bool):
-    await createDatabases(conn)
+async def populate_databases(conn: AsyncConnection, session: aiohttp.ClientSession, repopulate_foodmap: bool):
+    await migrate(conn)
     if repopulate_foodmap:
-        os.makedirs("cache", exist_ok=True)
-        with open("cache/food_map", "w") as file:
-            food_map = await getFoodMap()
-            json.dump(food_map, file, indent=2)
+        food_map = loadFoodMap()
+        if food_map is None:
+            food_map = await getFoodMap(session)
+            os.makedirs(os.path.dirname(settings.FOOD_MAP_PATH), exist_ok=True)
+            with open(settings.FOOD_MAP_PATH, "w") as file:
+                json.dump(food_map, file, indent=2)
         await populateFoodDatabase(conn, food_map)
     await populateBiospecimenMemo(conn)
     await populateClassMemo(conn)
     await populateFoodCatMemo(conn)
+    await populateFoodMemo(conn)
+    await populateCompoundIndex(conn)
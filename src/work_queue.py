@@ -0,0 +1,147 @@
+import os
+import socket
+from psycopg_pool import AsyncConnectionPool
+from typing import Iterable, List, Optional, Tuple
+import settings
+from ledger import CrawlLedger, WRITTEN, FAILED
+
+from logger import logger
+
+CLAIMED = "claimed"
+
+class WorkQueue(CrawlLedger):
+    # The crawl ledger of a sharded crawl, shared through Postgres by every worker on every host.
+    # Workers claim catalog pages with SKIP LOCKED, so no page goes to two of them, and take over the
+    # compounds listed on their pages. Claims not finished within SHARD_LEASE seconds, because their
+    # worker died, are handed out again, and failures go back to pending until LEDGER_MAX_ATTEMPTS.
+    def __init__(self, pool: AsyncConnectionPool, source: str, worker: Optional[str] = None):
+        super().__init__(pool, source)
+        self.worker = worker or f"{socket.gethostname()}:{os.getpid()}"
+
+    def _params(self, **params):
+        return {"source": self.source, "worker": self.worker, "lease": settings.SHARD_LEASE,
+                "max_attempts": settings.LEDGER_MAX_ATTEMPTS, **params}
+
+    async def seed(self, pages: Iterable[int]):
+        # Every worker seeds the same pages, only the first insert of each counts
+        page_insert = """
+            INSERT INTO crawl_queue (source, kind, key, status)
+            SELECT %(source)s, 'page', unnest(%(keys)s::text[]), 'pending'
+            ON CONFLICT (source, kind, key) DO NOTHING
+        """
+        async with self.pool.connection() as conn:
+            await conn.execute(page_insert, self._params(keys=[str(page) for page in pages]))
+
+    async def claim(self, limit: int) -> List[Tuple[str, str]]:
+        # Compounds come first, they are only up for grabs after their worker failed or died
+        queue_claim = """
+            UPDATE crawl_queue AS q
+            SET status = 'claimed', claimed_by = %(worker)s, claimed_at = now(), attempts = q.attempts + 1
+            FROM (
+                SELECT kind, key FROM crawl_queue
+                WHERE source = %(source)s AND attempts < %(max_attempts)s
+                AND (status = 'pending' OR (status = 'claimed' AND claimed_at < now() - make_interval(secs => %(lease)s)))
+                ORDER BY kind, length(key), key
+                LIMIT %(limit)s
+                FOR UPDATE SKIP LOCKED
+            ) AS next
+            WHERE q.source = %(source)s AND q.kind = next.kind AND q.key = next.key
+            RETURNING q.kind, q.key, q.attempts
+        """
+        async with self.pool.connection() as conn:
+            cur = await conn.execute(queue_claim, self._params(limit=limit))
+            rows = await cur.fetchall()
+        claimed = []
+        for kind, key, attempts in sorted(rows, key=lambda row: (row[0], len(row[1]), row[1])):
+            self._claimed(kind, key, attempts)
+            claimed.append((kind, key))
+        return claimed
+
+    async def own(self, ids: List[str]) -> List[str]:
+        # Claims the compounds listed on one of our pages, leaving out those already written, failed
+        # for good or held by a live worker
+        compound_claim = """
+            INSERT INTO crawl_queue (source, kind, key, status, attempts, claimed_by, claimed_at)
+            SELECT %(source)s, 'compound', unnest(%(keys)s::text[]), 'claimed', 1, %(worker)s, now()
+            ON CONFLICT (source, kind, key) DO UPDATE SET
+                status = 'claimed',
+                claimed_by = EXCLUDED.claimed_by,
+                claimed_at = EXCLUDED.claimed_at,
+                attempts = crawl_queue.attempts + 1
+            WHERE crawl_queue.attempts < %(max_attempts)s
+            AND (crawl_queue.status = 'pending'
+                OR (crawl_queue.status = 'claimed' AND crawl_queue.claimed_at < now() - make_interval(secs => %(lease)s)))
+            RETURNING key, attempts
+        """
+        async with self.pool.connection() as conn:
+            cur = await conn.execute(compound_claim, self._params(keys=list(dict.fromkeys(ids))))
+            owned = {}
+            async for key, attempts in cur:
+                owned[key] = attempts
+        for key, attempts in owned.items():
+            self._claimed("compound", key, attempts)
+        return [id for id in dict.fromkeys(ids) if id in owned]
+
+    def _claimed(self, kind: str, key: str, attempts: int):
+        self.status[(kind, key)] = CLAIMED
+        if attempts > 1:
+            self.resumed.add((kind, key))
+
+    def mark(self, kind: str, key: str, status: str, error: Optional[str] = None):
+        # Fetched and parsed compounds stay claimed, only the outcome is shared
+        if status in (WRITTEN, FAILED):
+            super().mark(kind, key, status, error)
+
+    async def flush(self):
+        if not self.updates:
+            return
+        queue_update = """
+            UPDATE crawl_queue AS q SET
+                status = CASE WHEN v.status = 'failed' AND q.attempts < %(max_attempts)s THEN 'pending' ELSE v.status END,
+                error = v.error
+            FROM unnest(%(kinds)s::text[], %(keys)s::text[], %(statuses)s::text[], %(errors)s::text[]) AS v(kind, key, status, error)
+            WHERE q.source = %(source)s AND q.kind = v.kind AND q.key = v.key
+        """
+        updates = self.updates
+        self.updates = {}
+        entries = list(updates)
+        async with self.pool.connection() as conn:
+            await conn.execute(queue_update, self._params(
+                kinds=[kind for kind, _ in entries], keys=[key for _, key in entries],
+                statuses=[updates[entry][0] for entry in entries], errors=[updates[entry][1] for entry in entries],
+            ))
+
+    async def renew(self):
+        # Keeps the claims of a live worker from expiring however long its share takes
+        async with self.pool.connection() as conn:
+            await conn.execute(
+                "UPDATE crawl_queue SET claimed_at = now() WHERE source = %(source)s AND claimed_by = %(worker)s AND status = 'claimed'",
+                self._params(),
+            )
+
+    async def remaining(self) -> int:
+        # Entries still pending or held by a live worker, i.e. everything before the crawl is complete
+        queue_remaining = """
+            SELECT count(*) FROM crawl_queue
+            WHERE source = %(source)s
+            AND (status = 'pending' OR (status = 'claimed'
+                AND (attempts < %(max_attempts)s OR claimed_at >= now() - make_interval(secs => %(lease)s))))
+        """
+        async with self.pool.connection() as conn:
+            cur = await conn.execute(queue_remaining, self._params())
+            return (await cur.fetchone())[0]
+
+    async def claimable(self) -> int:
+        claimable_select = """
+            SELECT count(*) FROM crawl_queue
+            WHERE source = %(source)s AND attempts < %(max_attempts)s
+            AND (status = 'pending' OR (status = 'claimed' AND claimed_at < now() - make_interval(secs => %(lease)s)))
+        """
+        async with self.pool.connection() as conn:
+            cur = await conn.execute(claimable_select, self._params())
+            return (await cur.fetchone())[0]
+
+    async def reset(self):
+        async with self.pool.connection() as conn:
+            await conn.execute("DELETE FROM crawl_queue WHERE source = %s", (self.source,))
+        logger.info(f" Cleared the {self.source} work queue")
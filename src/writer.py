@@ -0,0 +1,169 @@
+from psycopg import AsyncCursor, OperationalError, DatabaseError
+from psycopg_pool import AsyncConnectionPool
+from typing import Dict, List, Optional, Tuple
+import settings
+from ledger import CrawlLedger, WRITTEN, FAILED
+from delta import HashStore
+from sql import insertBioSpecDatabase
+from units import normalizeConcentration
+import metrics
+
+from logger import logger
+
+FOOD_COMPOUND_COLUMNS = ("compound_id", "food_id", "average_value", "max_value", "min_value")
+COMPOUND_BIOSPECIMEN_COLUMNS = ("compound_id", "biospecimen_id")
+CONCENTRATION_COLUMNS = ("id", "compound_id", "biospecimen_id", "value", "units", "age", "sex", "condition", "comment",
+                         "value_mean", "value_low", "value_high", "value_sd", "normalized_units")
+REFERENCE_COLUMNS = ("concentration_id", "reference_text", "pubmed_id")
+# Keys of the tables a second writer of the same compound can collide on, and what to do when it does
+UPSERTS = {
+    "food_compounds": ("(compound_id, food_id)", "DO UPDATE SET average_value = EXCLUDED.average_value, "
+                       "max_value = EXCLUDED.max_value, min_value = EXCLUDED.min_value"),
+    "compound_biospecimens": ("(compound_id, biospecimen_id)", "DO NOTHING"),
+}
+
+def _copyStatement(table: str, columns: Tuple[str, ...]) -> str:
+    return f"COPY {table} ({', '.join(columns)}) FROM STDIN"
+
+async def allocateIds(cur: AsyncCursor, table: str, count: int) -> List[int]:
+    await cur.execute(
+        "SELECT nextval(pg_get_serial_sequence(%s, 'id')) FROM generate_series(1, %s)",
+        (table, count),
+    )
+    return [row[0] for row in await cur.fetchall()]
+
+class BatchWriter:
+    def __init__(self, pool: AsyncConnectionPool, batch_size: int = settings.WRITE_BATCH_SIZE,
+                 ledger: Optional[CrawlLedger] = None, hashes: Optional[HashStore] = None, upsert: bool = False):
+        # upsert is for sharded crawls, where another worker may already have written some of the rows
+        self.pool = pool
+        self.batch_size = batch_size
+        self.upsert = upsert
+        self.ledger = ledger
+        self.hashes = hashes
+        self._reset()
+
+    def _reset(self):
+        # Keyed like the tables' primary keys, a pair written twice before a flush keeps its last values
+        self.food_compounds: Dict[Tuple[int, int], Tuple] = {}
+        self.compound_biospecimens: Dict[Tuple[int, int], None] = {}
+        self.concentrations: List[Dict] = []
+        self.completed: Dict[int, List[str]] = {}
+
+    def __len__(self) -> int:
+        return len(self.food_compounds) + len(self.compound_biospecimens) + len(self.concentrations)
+
+    def addFoodCompound(self, compound_id: int, food_id: int, average_value, max_value, min_value):
+        self.food_compounds[(compound_id, food_id)] = (compound_id, food_id, average_value, max_value, min_value)
+
+    def addBiospecimen(self, compound_id: int, biospecimen_id: int):
+        self.compound_biospecimens[(compound_id, biospecimen_id)] = None
+
+    async def addConcentration(self, compound_id: int, concentration: Dict):
+        if not concentration.get("biospecimen"):
+            logger.warning(f" Compound {compound_id}: Skipping concentration {concentration.get('value')} without a biospecimen")
+            return
+        concentration = dict(concentration)
+        concentration["compound_id"] = compound_id
+        # Not every biospecimen a concentration names is among the compound's biospecimen_locations
+        concentration["biospecimen_id"] = await insertBioSpecDatabase(self.pool, concentration["biospecimen"])
+        concentration.update(normalizeConcentration(concentration.get("value"), concentration.get("units")))
+        self.concentrations.append(concentration)
+
+    def complete(self, compound_id: int, key: str):
+        # The ledger entry and content hash for key are recorded once this compound's rows are committed
+        self.completed.setdefault(compound_id, []).append(key)
+
+    def _markCompleted(self, completed: Dict[int, List[str]], compound_ids, status: str, error: Optional[str] = None):
+        for compound_id in compound_ids:
+            for key in completed.get(compound_id, []):
+                if self.ledger is not None:
+                    self.ledger.mark("compound", key, status, error)
+                if self.hashes is not None:
+                    if status == WRITTEN:
+                        self.hashes.confirm(key)
+                    else:
+                        self.hashes.drop(key)
+
+    async def flushIfFull(self):
+        if len(self) >= self.batch_size:
+            await self.flush()
+
+    async def flush(self):
+        if not len(self) and not self.completed:
+            return
+        food_compounds = list(self.food_compounds.values())
+        compound_biospecimens = list(self.compound_biospecimens)
+        concentrations = self.concentrations
+        batch = (food_compounds, compound_biospecimens, concentrations)
+        compound_ids = {row[0] for row in food_compounds} | {row[0] for row in compound_biospecimens} \
+            | {conc["compound_id"] for conc in concentrations} | set(self.completed)
+        completed = self.completed
+        self._reset()
+
+        try:
+            with metrics.timer("sql.flushBatch"):
+                await self._write(*batch)
+            metrics.increment("rows.food_compounds", len(food_compounds))
+            metrics.increment("rows.compound_biospecimens", len(compound_biospecimens))
+            metrics.increment("rows.concentration", len(concentrations))
+            logger.info(f" Flushed {len(food_compounds)} food, {len(compound_biospecimens)} biospecimen "
+                        f"and {len(concentrations)} concentration rows")
+            self._markCompleted(completed, compound_ids, WRITTEN)
+        except (OperationalError, DatabaseError) as e:
+            logger.error(f" Batch of {len(compound_ids)} compounds failed ({e}). Retrying per compound")
+            await self._writePerCompound(compound_ids, completed, *batch)
+
+    async def _writePerCompound(self, compound_ids, completed, food_compounds, compound_biospecimens, concentrations):
+        for compound_id in compound_ids:
+            try:
+                await self._write(
+                    [row for row in food_compounds if row[0] == compound_id],
+                    [row for row in compound_biospecimens if row[0] == compound_id],
+                    [conc for conc in concentrations if conc["compound_id"] == compound_id],
+                )
+                self._markCompleted(completed, [compound_id], WRITTEN)
+            except (OperationalError, DatabaseError) as e:
+                logger.error(f" Compound {compound_id}: {e}")
+                self._markCompleted(completed, [compound_id], FAILED, str(e))
+
+    async def _copyRows(self, cur: AsyncCursor, table: str, columns: Tuple[str, ...], rows: List[Tuple]):
+        if not self.upsert:
+            async with cur.copy(_copyStatement(table, columns)) as copy:
+                for row in rows:
+                    await copy.write_row(row)
+            return
+        # COPY has no ON CONFLICT, so the rows go through a staging table that lives as long as the connection
+        key, action = UPSERTS[table]
+        await cur.execute(f"CREATE TEMP TABLE IF NOT EXISTS {table}_staging (LIKE {table}) ON COMMIT DELETE ROWS")
+        async with cur.copy(_copyStatement(f"{table}_staging", columns)) as copy:
+            for row in rows:
+                await copy.write_row(row)
+        await cur.execute(f"""
+            INSERT INTO {table} ({', '.join(columns)})
+            SELECT DISTINCT ON {key} {', '.join(columns)} FROM {table}_staging
+            ON CONFLICT {key} {action}
+        """)
+
+    async def _write(self, food_compounds: List[Tuple], compound_biospecimens: List[Tuple], concentrations: List[Dict]):
+        async with self.pool.connection() as conn, conn.transaction(), conn.cursor() as cur:
+            references = []
+            if concentrations:
+                conc_ids = await allocateIds(cur, "concentration", len(concentrations))
+                for conc_id, concentration in zip(conc_ids, concentrations):
+                    concentration["id"] = conc_id
+                    for reference in concentration.get("references") or []:
+                        references.append((conc_id, reference.get("reference_text"), reference.get("pubmed_id")))
+
+            if food_compounds:
+                await self._copyRows(cur, "food_compounds", FOOD_COMPOUND_COLUMNS, food_compounds)
+            if compound_biospecimens:
+                await self._copyRows(cur, "compound_biospecimens", COMPOUND_BIOSPECIMEN_COLUMNS, compound_biospecimens)
+            if concentrations:
+                async with cur.copy(_copyStatement("concentration", CONCENTRATION_COLUMNS)) as copy:
+                    for concentration in concentrations:
+                        await copy.write_row(tuple(concentration.get(col) for col in CONCENTRATION_COLUMNS))
+            if references:
+                async with cur.copy(_copyStatement("reference", REFERENCE_COLUMNS)) as copy:
+                    for row in references:
+                        await copy.write_row(row)
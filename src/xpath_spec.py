@@ -0,0 +1,138 @@
+from lxml import etree
+from typing import Any, Callable, Dict, List, Optional, Tuple, Union
+import re
+
+# Declarative extraction: a spec maps output keys to Fields and Rows, whose paths are compiled once
+# into lxml XPath objects. Keys whose path matches nothing are left out of the result, the same way
+# the soup extractors only set keys for tags that exist.
+
+def _normalize(text: Optional[str]) -> Optional[str]:
+    # BeautifulSoup collapses whitespace-only strings to a single newline or space
+    if not text:
+        return None
+    if text.isspace():
+        return "\n" if "\n" in text else " "
+    return text
+
+def _nodes(el) -> List[Union[str, etree._Element]]:
+    nodes = []
+    text = _normalize(el.text)
+    if text:
+        nodes.append(text)
+    for child in el:
+        if isinstance(child.tag, str):
+            nodes.append(child)
+        tail = _normalize(child.tail)
+        if tail:
+            nodes.append(tail)
+    return nodes
+
+def string(el) -> Optional[str]:
+    # BeautifulSoup's .string: the text of an element whose only content is text
+    nodes = _nodes(el)
+    if len(nodes) != 1:
+        return None
+    if isinstance(nodes[0], str):
+        return nodes[0]
+    return string(nodes[0])
+
+def text(el) -> str:
+    # BeautifulSoup's .text
+    return "".join(node if isinstance(node, str) else text(node) for node in _nodes(el))
+
+_STEP = re.compile(r"^(\s*)([A-Za-z_][\w.-]*)(\s*)$")
+
+def _localStep(step: str) -> str:
+    match = _STEP.match(step)
+    if not match:
+        return step
+    return f"{match.group(1)}*[local-name()='{match.group(2)}']{match.group(3)}"
+
+def localPath(path: str) -> str:
+    # Rewrites every tag name step to match on local-name(), so specs work with or without the HMDB
+    # namespace. Predicates and function calls are left alone.
+    parts: List[str] = []
+    step = ""
+    depth = 0
+    for char in path:
+        if char == "[":
+            if depth == 0:
+                parts.append(_localStep(step))
+                step = ""
+            depth += 1
+        elif char == "]":
+            depth -= 1
+        elif depth == 0 and char in "/|()":
+            parts.append(step if char == "(" else _localStep(step))
+            parts.append(char)
+            step = ""
+            continue
+        step += char
+    parts.append(_localStep(step) if depth == 0 and not step.startswith("[") else step)
+    return "".join(parts)
+
+class Field:
+    # The value of the first (or last, or every) element path matches. value turns the element into
+    # a string, nulls are texts that mean "no value", and a matched element with no value gives None.
+    # With nulls=None the value is kept as it is, empty or not.
+    def __init__(self, path: str, value: Callable[[Any], Any] = string, transform: Optional[Callable[[str], Any]] = None,
+                 nulls: Optional[Tuple[str, ...]] = (), pick: str = "first"):
+        self.path = path
+        self.xpath = etree.XPath(localPath(path))
+        self.value = value
+        self.transform = transform
+        self.nulls = nulls
+        self.pick = pick
+
+    def _convert(self, el) -> Any:
+        value = self.value(el)
+        if self.nulls is not None and (not value or (self.nulls and text(el) in self.nulls)):
+            return None
+        return self.transform(value) if self.transform is not None else value
+
+    def select(self, el) -> Any:
+        matches = self.xpath(el)
+        if self.pick == "all":
+            return [self._convert(match) for match in matches]
+        if not matches:
+            return None
+        return self._convert(matches[0] if self.pick == "first" else matches[-1])
+
+    def extract(self, el, result: Dict, key: str):
+        matches = self.xpath(el)
+        if self.pick == "all":
+            result[key] = [self._convert(match) for match in matches]
+        elif matches:
+            result[key] = self._convert(matches[0] if self.pick == "first" else matches[-1])
+
+class Rows:
+    # One record per element item matches inside the element container matches. Without a container
+    # match the key is left out, with one the key holds a list, empty or not.
+    def __init__(self, container: Optional[str], item: str, fields: Dict[str, Union[Field, "Rows"]]):
+        self.container = etree.XPath(localPath(container)) if container else None
+        self.item = etree.XPath(localPath(item))
+        self.fields = fields
+
+    def select(self, el) -> Optional[List[Dict]]:
+        if self.container is not None:
+            containers = self.container(el)
+            if not containers:
+                return None
+            el = containers[0]
+        return [apply(self.fields, item) for item in self.item(el)]
+
+    def extract(self, el, result: Dict, key: str):
+        rows = self.select(el)
+        if rows is not None:
+            result[key] = rows
+
+Spec = Dict[str, Union[Field, Rows]]
+
+def apply(spec: Spec, el) -> Dict:
+    result: Dict = {}
+    for key, field in spec.items():
+        field.extract(el, result, key)
+    return result
+
+def parse(page_text: str):
+    return etree.fromstring(page_text.encode(), etree.XMLParser(remove_comments=True, huge_tree=True))